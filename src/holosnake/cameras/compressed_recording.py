@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+"""
+Lossless compressed recording of raw holograms.
+
+Frames are written as a multi-page TIFF in which each page is split into
+tiles that are compressed separately (zstd if imagecodecs is installed,
+otherwise deflate, at a fast level with a horizontal predictor), so that
+the file is much smaller than an uncompressed recording but any frame can
+still be decoded on its own. Compression is done by a writer thread which
+takes frames from a bounded queue, so the GUI thread only has to queue
+each frame, and the tiles of each frame are compressed in parallel.
+
+The description of each page is JSON holding the frame number, its index
+in the recording counting any frames dropped, and the time it was acquired
+(see TimestampQueue). The description of the first page also holds the
+processing settings at the start of the recording (see
+processors.holo_settings), without any images such as the background, any
+calibration needed to interpret the frames, and once the recording has
+finished, the number of frames in the recording including those dropped.
+Frames can be transformed on the writer thread before they are written,
+e.g. to keep only the off-axis sideband (see sideband_recording).
+
+Recordings are read by MappedFrames like any other multi-page TIFF, so they
+can be loaded as a file source or processed by holosnake_batch and
+holosnake_track. recording_metadata returns the timestamps and settings.
+
+"""
+
+import json
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
+try:
+    import imagecodecs
+except ImportError:
+    imagecodecs = None
+
+from processors.holo_settings import apply_settings
+
+
+# Settings which only make sense for the session they were recorded in
+SESSION_SETTINGS = {"telemetryShare", "telemetryLog", "reuseBuffers", "cuda"}
+
+
+def fast_codec():
+    """Returns the fastest lossless compression available to tifffile."""
+    if imagecodecs is not None and hasattr(imagecodecs, "zstd_encode"):
+        return "zstd"
+    return "zlib"
+
+
+def to_json(value):
+    """Returns value with tuples as lists and numpy scalars as Python types,
+    or None if it cannot be stored as JSON (e.g. an image).
+    """
+    if isinstance(value, (list, tuple)):
+        return [to_json(item) for item in value]
+    if isinstance(value, np.generic):
+        return value.item()
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    return None
+
+
+def from_json(value):
+    if isinstance(value, list):
+        return tuple(from_json(item) for item in value)
+    return value
+
+
+def json_settings(settings):
+    """Returns the processing settings which can be stored with a recording.
+    Images and settings specific to the current session are left out.
+    """
+    stored = {}
+    for name, value in settings.items():
+        if name in SESSION_SETTINGS or isinstance(value, np.ndarray):
+            continue
+        stored[name] = to_json(value)
+    return stored
+
+
+class TimestampQueue(queue.Queue):
+    """Queue which records the time each item is put, for use as the
+    auxillary queue of the image acquisition thread, so that frames are
+    timed when they are acquired rather than when they are taken from the
+    queue. Items are returned as for a Queue, and the time the last item
+    taken was put is then lastTimestamp (seconds since the epoch).
+
+    Keyword Arguments:
+        maxsize      : int
+                       see queue.Queue (default 0)
+        frameCounter : callable
+                       if given, returns the camera frame number when each
+                       item is put, which is then lastFrameNumber, so that
+                       frames dropped because the queue was full can be
+                       counted (default None)
+    """
+
+    lastTimestamp = np.nan
+    lastFrameNumber = None
+
+    def __init__(self, maxsize=0, frameCounter=None):
+        super().__init__(maxsize=maxsize)
+        self.frameCounter = frameCounter
+
+    def _put(self, item):
+        frameNumber = self.frameCounter() if self.frameCounter is not None else None
+        self.queue.append((item, time.time(), frameNumber))
+
+    def _get(self):
+        item, self.lastTimestamp, self.lastFrameNumber = self.queue.popleft()
+        return item
+
+
+class RecordingWriter:
+    """Writes frames to a compressed multi-page TIFF on a background thread.
+
+    Arguments:
+        filename    : str
+                      .tif file to write
+
+    Keyword Arguments:
+        settings    : dict
+                      processing settings to store with the recording, see
+                      json_settings (default None)
+        maxQueue    : int
+                      maximum number of frames waiting to be written
+                      (default 64)
+        level       : int
+                      compression level, 1 is fastest (default 1)
+        tileSize    : int
+                      size of the separately compressed tiles (default 256)
+        compress    : boolean
+                      if False frames are written uncompressed, so that they
+                      can be memory-mapped when read (default True)
+        codec       : str
+                      tifffile compression, see fast_codec (default None to
+                      use the fastest available)
+        maxWorkers  : int
+                      threads compressing the tiles of a frame (default None
+                      to use one per CPU core)
+        transform   : callable
+                      if given, each frame is replaced by transform(frame)
+                      on the writer thread (default None)
+        calibration : dict
+                      JSON serialisable values stored with the recording,
+                      see recording_calibration (default None)
+    """
+
+    def __init__(self, filename, settings=None, maxQueue=64, level=1, tileSize=256, compress=True,
+                 transform=None, calibration=None, codec=None, maxWorkers=None):
+        if tifffile is None:
+            raise ImportError("tifffile is required for compressed recording.")
+        self.filename = filename
+        self.settings = json_settings(settings) if settings is not None else None
+        self.level = int(level)
+        self.tileSize = max(int(tileSize) // 16 * 16, 16)
+        self.compress = compress
+        self.codec = codec or fast_codec()
+        self.maxWorkers = maxWorkers or os.cpu_count() or 1
+        self.transform = transform
+        self.calibration = calibration
+        self.frames = queue.Queue(maxsize=max(int(maxQueue), 1))
+        self.thread = None
+        self.numWritten = 0
+        self.numFrames = 0
+        self.firstFrameNumber = None
+        self.error = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def full(self):
+        return self.frames.full()
+
+    def num_waiting(self):
+        return self.frames.qsize()
+
+    def num_dropped(self):
+        """Returns the number of frames in the recording which have been
+        dropped, i.e. which are not written or waiting to be written.
+        """
+        return self.numFrames - self.numWritten - self.num_waiting()
+
+    def put(self, frame, timestamp=None, block=False, frameNumber=None):
+        """Queues frame to be written, with timestamp in seconds since the
+        epoch (default now). If the queue is full, the frame is dropped and
+        False is returned, unless block is True, in which case this waits
+        for space. frameNumber is the camera frame number, if known, so that
+        frames dropped before they were passed here are counted, otherwise
+        frames are numbered in the order they are passed here.
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        if frameNumber is None:
+            frameNumber = (self.firstFrameNumber or 0) + self.numFrames
+        if self.firstFrameNumber is None:
+            self.firstFrameNumber = frameNumber
+        index = frameNumber - self.firstFrameNumber
+        self.numFrames = max(self.numFrames, index + 1)
+        try:
+            self.frames.put((np.array(frame), timestamp, index), block=block)
+        except queue.Full:
+            return False
+        return True
+
+    def stop(self):
+        """Writes any frames still queued, then closes the file."""
+        if self.thread is not None:
+            self.frames.put(None)
+            self.thread.join()
+            self.thread = None
+            if self.numWritten > 0 and self.error is None:
+                self.write_counts()
+
+    def write_counts(self):
+        """Adds the number of frames in the recording, and the number of
+        these dropped, to the description of the first page.
+        """
+        description = first_description(self.filename)
+        description["numFrames"] = self.numFrames
+        description["numDropped"] = self.num_dropped()
+        try:
+            tifffile.tiffcomment(self.filename, json.dumps(description), pageindex=0)
+        except Exception as e:
+            self.error = str(e)
+
+    def run(self):
+        try:
+            with tifffile.TiffWriter(self.filename, bigtiff=True) as writer:
+                while True:
+                    item = self.frames.get()
+                    if item is None:
+                        return
+                    self.write(writer, *item)
+        except Exception as e:
+            self.error = str(e)
+            # Keep taking frames so that put and stop do not block
+            while self.frames.get() is not None:
+                pass
+
+    def write(self, writer, frame, timestamp, index):
+        if self.transform is not None:
+            frame = self.transform(frame)
+        description = {"frame": self.numWritten, "index": index, "timestamp": timestamp}
+        if self.numWritten == 0:
+            if self.settings is not None:
+                description["settings"] = self.settings
+            if self.calibration is not None:
+                description["calibration"] = self.calibration
+        if not self.compress:
+            writer.write(frame, description=json.dumps(description), metadata=None)
+        else:
+            tile = (self.tileSize, self.tileSize) if min(np.shape(frame)[:2]) >= self.tileSize else None
+            writer.write(
+                frame,
+                compression=self.codec,
+                compressionargs={"level": self.level},
+                predictor=np.issubdtype(frame.dtype, np.integer),
+                tile=tile,
+                maxworkers=self.maxWorkers,
+                description=json.dumps(description),
+                metadata=None,
+            )
+        self.numWritten += 1
+
+
+def first_description(filename):
+    """Returns the JSON description of the first page of a recording as a
+    dictionary, which is empty if there is none.
+    """
+    if tifffile is None:
+        raise ImportError("tifffile is required to read recordings.")
+    with tifffile.TiffFile(filename) as tif:
+        try:
+            return json.loads(tif.pages[0].description)
+        except (ValueError, TypeError, IndexError):
+            return {}
+
+
+def recording_calibration(filename):
+    """Returns the calibration stored with a recording, or None."""
+    return first_description(filename).get("calibration", None)
+
+
+def recording_metadata(filename):
+    """Returns (timestamps, settings) for a recording made by
+    RecordingWriter. timestamps is an array with the time of each frame in
+    seconds since the epoch (NaN if unknown), settings is a dictionary of
+    processing settings, which is empty if none were stored.
+    """
+    if tifffile is None:
+        raise ImportError("tifffile is required to read recordings.")
+    timestamps = []
+    settings = {}
+    with tifffile.TiffFile(filename) as tif:
+        for idx, page in enumerate(tif.pages):
+            try:
+                description = json.loads(page.description)
+            except (ValueError, TypeError):
+                description = {}
+            timestamps.append(description.get("timestamp", np.nan))
+            if idx == 0:
+                settings = {name: from_json(value) for name, value in description.get("settings", {}).items()}
+    return np.array(timestamps, dtype="float64"), settings
+
+
+def configure_from_recording(processor, filename):
+    """Applies the processing settings stored with a recording to
+    processor (a HoloProcessor). Returns the settings applied.
+    """
+    timestamps, settings = recording_metadata(filename)
+    apply_settings(processor, settings)
+    return settings
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+"""
+Memory-mapped file source for long multi-frame recordings.
+
+Frames are read from multi-page TIFF, .npy or raw frame dumps without loading
+the file into memory. Uncompressed TIFF pages, .npy arrays and raw dumps are
+memory-mapped, so any frame can be accessed in constant time. Compressed TIFF
+pages are decoded individually on demand. A background thread prefetches the
+frames after the most recently requested frame so that stepping through a
+recording is not limited by disk reads.
+
+"""
+
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
+from cas_gui.cameras.FileInterface import FileInterface
+
+
+class MappedFrames:
+    """Random access to the frames of a multi-frame file.
+
+    Arguments:
+        filename   : str
+                     .tif/.tiff, .npy or raw frame dump
+
+    Keyword Arguments:
+        shape      : tuple of (int, int)
+                     (height, width) of each frame, required for raw files
+        dtype      : str or numpy dtype
+                     pixel type of raw files (default 'uint16')
+        headerBytes : int
+                     bytes to skip at the start of raw files (default 0)
+    """
+
+    def __init__(self, filename, **kwargs):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.tif = None
+        self.pages = None
+        self.stack = None
+        self.fileMap = None
+
+        ext = os.path.splitext(filename)[1].lower()
+        if ext == ".npy":
+            self.stack = np.load(filename, mmap_mode="r")
+            if self.stack.ndim == 2:
+                self.stack = self.stack[np.newaxis]
+        elif ext in (".tif", ".tiff"):
+            self.open_tif(filename)
+        else:
+            shape = kwargs.get("shape", None)
+            if shape is None:
+                raise ValueError("Frame shape is required to open raw files.")
+            dtype = np.dtype(kwargs.get("dtype", "uint16"))
+            headerBytes = int(kwargs.get("headerBytes", 0))
+            frameBytes = int(np.prod(shape)) * dtype.itemsize
+            numFrames = (os.path.getsize(filename) - headerBytes) // frameBytes
+            self.stack = np.memmap(
+                filename,
+                dtype=dtype,
+                mode="r",
+                offset=headerBytes,
+                shape=(numFrames,) + tuple(shape),
+            )
+
+    def open_tif(self, filename):
+        if tifffile is None:
+            raise ImportError("tifffile is required to memory-map tif files.")
+
+        # Whole file is one contiguous array, e.g. written by tifffile
+        try:
+            stack = tifffile.memmap(filename, mode="r")
+            self.stack = stack if stack.ndim == 3 else stack.reshape((-1,) + stack.shape[-2:])
+            return
+        except ValueError:
+            pass
+
+        # Otherwise map or decode each page separately. Uncompressed pages
+        # are views on a single map of the whole file, as a map for each page
+        # would hold a file descriptor for each page. Pages are not cached,
+        # which would keep every page of a long file in memory.
+        self.tif = tifffile.TiffFile(filename)
+        self.pages = self.tif.pages
+        self.pages.cache = False
+        self.fileMap = np.memmap(filename, dtype="uint8", mode="r")
+        # Counting the pages reads every IFD, so do this once here rather
+        # than from the prefetch thread while a frame is being read
+        self.numPages = len(self.pages)
+
+    def __len__(self):
+        if self.stack is not None:
+            return np.shape(self.stack)[0]
+        return self.numPages
+
+    def frame_shape(self):
+        if self.stack is not None:
+            return np.shape(self.stack)[1:]
+        with self.lock:
+            return self.pages[0].shape
+
+    def get(self, idx):
+        """Returns frame idx. For memory-mapped files this is a view on the
+        file, which is only read when the data is accessed.
+        """
+        if self.stack is not None:
+            return self.stack[idx]
+
+        with self.lock:
+            page = self.pages[idx]
+            if not page.is_memmappable:
+                return page.asarray()
+            dtype = page.dtype.newbyteorder(self.tif.byteorder)
+            offset = page.dataoffsets[0]
+            numBytes = int(np.prod(page.shape)) * dtype.itemsize
+            return self.fileMap[offset : offset + numBytes].view(dtype).reshape(page.shape)
+
+    def close(self):
+        if self.tif is not None:
+            self.tif.close()
+        self.stack = None
+        self.fileMap = None
+
+
+class FramePrefetcher:
+    """Reads frames into memory on a background thread ahead of the frame
+    most recently requested.
+
+    Arguments:
+        frames      : MappedFrames
+        numPrefetch : int
+                      number of frames to read ahead (default 8)
+    """
+
+    def __init__(self, frames, numPrefetch=8):
+        self.frames = frames
+        self.numPrefetch = max(int(numPrefetch), 0)
+        self.cache = OrderedDict()
+        self.cacheLock = threading.Lock()
+        self.wanted = threading.Condition()
+        self.currentIdx = 0
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def load(self, idx):
+        return np.array(self.frames.get(idx))
+
+    def get(self, idx):
+        """Returns frame idx as an in-memory array, and prefetches the frames
+        that follow it.
+        """
+        with self.cacheLock:
+            frame = self.cache.get(idx)
+        if frame is None:
+            frame = self.load(idx)
+            self.store(idx, frame)
+
+        with self.wanted:
+            self.currentIdx = idx
+            self.wanted.notify()
+        return frame
+
+    def store(self, idx, frame):
+        with self.cacheLock:
+            self.cache[idx] = frame
+            self.cache.move_to_end(idx)
+            # Keep the current frame, the prefetched frames and one previous
+            while len(self.cache) > self.numPrefetch + 2:
+                self.cache.popitem(last=False)
+
+    def next_missing(self):
+        """Returns the index of the next frame after the current frame which
+        is not yet cached, or None.
+        """
+        with self.cacheLock:
+            for idx in range(self.currentIdx + 1, min(self.currentIdx + 1 + self.numPrefetch, len(self.frames))):
+                if idx not in self.cache:
+                    return idx
+        return None
+
+    def run(self):
+        while True:
+            with self.wanted:
+                while not self.stopped and self.next_missing() is None:
+                    self.wanted.wait()
+                if self.stopped:
+                    return
+                idx = self.next_missing()
+            self.store(idx, self.load(idx))
+
+    def stop(self):
+        with self.wanted:
+            self.stopped = True
+            self.wanted.notify()
+
+
+class MappedFileInterface(FileInterface):
+    """CAS file interface which memory-maps the file and prefetches frames,
+    used in place of FileInterface for multi-frame recordings.
+
+    Keyword Arguments are as for FileInterface, plus:
+        numPrefetch : int
+                      number of frames to read ahead (default 8)
+        shape, dtype, headerBytes : see MappedFrames, for raw files
+    """
+
+    frames = None
+    prefetcher = None
+
+    def __init__(self, **kwargs):
+        self.filename = kwargs.pop("filename", None)
+        numPrefetch = kwargs.pop("numPrefetch", 8)
+        self.lastImageTime = 0
+        self.fps = 30
+        self.frameRateEnabled = False
+        self.is_array = True
+        try:
+            self.frames = MappedFrames(self.filename, **kwargs)
+            self.prefetcher = FramePrefetcher(self.frames, numPrefetch)
+            self.fileOpen = True
+        except Exception:
+            self.fileOpen = False
+
+    def dispose(self):
+        if self.prefetcher is not None:
+            self.prefetcher.stop()
+        if self.frames is not None:
+            self.frames.close()
+
+    def get_image(self):
+        if self.currentImageIdx == self.lastImageIdx:
+            return self.lastImage
+
+        self.lastImage = self.prefetcher.get(self.currentImageIdx)
+        self.lastImageIdx = self.currentImageIdx
+        return self.lastImage
+
+    def get_all_images(self):
+        return np.stack([self.frames.get(idx) for idx in range(len(self.frames))])
+
+    def get_number_images(self):
+        return len(self.frames)
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+Off-axis sideband recording.
+
+For off-axis holography only the sideband around the modulation frequency
+is needed to reconstruct the field, which is usually a small fraction of
+the camera frame. Rather than the raw holograms, a sideband recording holds
+the demodulated complex field of each frame (2 x crop radius square,
+complex64), written by a RecordingWriter which demodulates on its writer
+thread. The calibration (crop centre and radius, camera frame shape,
+wavelength and pixel size) is stored with the recording, and the
+demodulated background, if there is one, is saved alongside it with
+_background added to the filename.
+
+SidebandReader gives random access to the recorded fields, corrected with
+the background in the same way as live off-axis reconstruction, and
+refocuses them to any depth using cached
+angular spectrum propagators.
+
+"""
+
+import os
+
+import numpy as np
+import scipy.fft
+
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
+import pyholoscope as pyh
+
+from cameras.compressed_recording import RecordingWriter, recording_calibration
+from cameras.mapped_file_interface import MappedFrames
+from processors.propagator_cache import PropagatorCache, angular_spectrum_propagator
+
+
+def background_filename(filename):
+    root, ext = os.path.splitext(filename)
+    return root + "_background" + (ext or ".tif")
+
+
+class SidebandExtractor:
+    """Callable returning the demodulated sideband of a hologram as a
+    complex64 array, used as the transform of a RecordingWriter.
+
+    Arguments:
+        cropCentre : tuple of (int, int)
+                     location of the modulation frequency in the FFT
+        cropRadius : int or tuple of (int, int)
+                     semi-diameter of the sideband
+    """
+
+    def __init__(self, cropCentre, cropRadius):
+        self.cropCentre = cropCentre
+        self.cropRadius = cropRadius
+
+    def __call__(self, hologram):
+        return pyh.off_axis_demod(hologram, self.cropCentre, self.cropRadius).astype("complex64")
+
+
+def sideband_writer(filename, holo, hologramShape, settings=None, compress=True, maxQueue=64):
+    """Returns a RecordingWriter (not yet started) which records the
+    sidebands of holograms of hologramShape demodulated with the settings
+    of holo (a PyHoloscope Holo in off-axis mode). The demodulated
+    background of holo, if any, is saved immediately.
+    """
+    cropCentre = tuple(int(value) for value in pyh.dimensions(holo.crop_centre))
+    cropRadius = tuple(int(value) for value in pyh.dimensions(holo.crop_radius))
+    extractor = SidebandExtractor(cropCentre, cropRadius)
+
+    backgroundFile = None
+    if holo.background is not None:
+        if tifffile is None:
+            raise ImportError("tifffile is required for sideband recording.")
+        backgroundFile = background_filename(filename)
+        tifffile.imwrite(backgroundFile, extractor(holo.background))
+
+    calibration = {
+        "type": "sideband",
+        "hologramShape": [int(size) for size in hologramShape[:2]],
+        "cropCentre": list(cropCentre),
+        "cropRadius": list(cropRadius),
+        "wavelength": holo.wavelength,
+        "pixelSize": holo.pixel_size,
+        "background": os.path.basename(backgroundFile) if backgroundFile is not None else None,
+    }
+    return RecordingWriter(
+        filename,
+        settings=settings,
+        maxQueue=maxQueue,
+        compress=compress,
+        transform=extractor,
+        calibration=calibration,
+    )
+
+
+class SidebandReader:
+    """Reconstructs and refocuses fields from a sideband recording.
+
+    Arguments:
+        filename      : str
+                        recording made by a sideband_writer
+
+    Keyword Arguments:
+        relativePhase : boolean
+                        if True, and a background was recorded, the phase of
+                        the background is removed from each field
+                        (default True)
+        cacheSize     : float
+                        maximum memory used for propagators in MB
+                        (default 256)
+    """
+
+    def __init__(self, filename, relativePhase=True, cacheSize=256):
+        calibration = recording_calibration(filename)
+        if calibration is None or calibration.get("type") != "sideband":
+            raise ValueError(f"{filename} is not a sideband recording.")
+        self.filename = filename
+        self.hologramShape = tuple(calibration["hologramShape"])
+        self.cropCentre = tuple(calibration["cropCentre"])
+        self.cropRadius = tuple(calibration["cropRadius"])
+        self.wavelength = calibration["wavelength"]
+        self.cameraPixelSize = calibration["pixelSize"]
+        self.relativePhase = relativePhase
+        self.frames = MappedFrames(filename)
+        self.propagatorCache = PropagatorCache(cacheSize * 1024**2)
+
+        self.backgroundField = None
+        self.backgroundAbs = None
+        if calibration.get("background") is not None:
+            backgroundFile = os.path.join(os.path.dirname(filename), calibration["background"])
+            if os.path.exists(backgroundFile):
+                self.backgroundField = tifffile.imread(backgroundFile)
+                self.backgroundAbs = np.abs(self.backgroundField)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def pixel_size(self):
+        """Returns the (y, x) pixel size of the recorded fields."""
+        fieldShape = self.frames.frame_shape()
+        return (
+            self.cameraPixelSize * self.hologramShape[0] / fieldShape[0],
+            self.cameraPixelSize * self.hologramShape[1] / fieldShape[1],
+        )
+
+    def field(self, idx):
+        """Returns the demodulated field of frame idx, corrected with the
+        background as for off-axis reconstruction in HoloProcessor.
+        """
+        field = np.array(self.frames.get(idx), dtype="complex64")
+        if self.backgroundField is None:
+            return field
+        if self.relativePhase:
+            field = pyh.relative_phase(field, self.backgroundField)
+        return pyh.pre_process(field, background=self.backgroundAbs)
+
+    def refocus(self, idx, depth):
+        """Returns the field of frame idx refocused by depth (m)."""
+        field = self.field(idx)
+        shape = np.shape(field)
+        pixelSize = self.pixel_size()
+        prop = self.propagatorCache.get(
+            (shape, self.wavelength, pixelSize, depth),
+            lambda: angular_spectrum_propagator(shape, self.wavelength, pixelSize, depth, dtype="complex64"),
+        )
+        return scipy.fft.ifft2(scipy.fft.fft2(field) * prop)
+
+    def close(self):
+        self.frames.close()
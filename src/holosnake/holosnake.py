@@ -48,6 +48,25 @@ import cv2 as cv
 
 from cas_gui.base import CAS_GUI
 from processors.holo_processor import HoloProcessor
+from threads.auto_focus_thread import AutoFocusThread
+from threads.stack_export_thread import StackExportThread
+from processors.stack_export import DepthStackExport
+from processors.edof import AllInFocusExport, METRICS as EDOF_METRICS
+from cameras.mapped_file_interface import MappedFileInterface
+from threads.queue_policy import QueuePolicy, estimate_latency
+from processors.stage_timer import TelemetryReader, dominant_stage
+from processors.phase_unwrap import PhaseUnwrapper
+from processors.background_builder import BackgroundBuilder
+from processors.focus_tracker import FocusTracker
+from processors.display import decimation_factor
+from cameras.compressed_recording import RecordingWriter, TimestampQueue
+from cameras.sideband_recording import sideband_writer
+from processors.holo_settings import (
+    SettingsTracker,
+    local_changes,
+    remote_changes,
+    remote_only_changes,
+)
 import pyholoscope
 
 
@@ -73,6 +92,26 @@ class HoloGUI(CAS_GUI):
     studyRoot = "../studies"
     studyPath = "../studies/default"
     restoreMethod = 1
+    autoFocusThread = None
+    stackExportThread = None
+    queuePolicy = None
+    telemetryReader = None
+    telemetryLogName = "processing_times.csv"
+    liveBackgroundName = "live_background.tif"
+    backgroundBuilder = None
+    lastBackgroundFrame = None
+    focusTracker = None
+    lastFocusFrame = None
+    WRITER = 2  # Record type for a RecordingWriter, in addition to CAS_GUI TIF and AVI
+    recordCompressedCheck = None
+    recordSidebandCheck = None
+    recordWriter = None
+    recordQueueSize = 64
+    displayDecimation = 1
+    displayActive = False
+    pendingDisplayShape = None
+    settingsDelay = 30
+    autoFocusDisplaySlowdown = 4  # GUI refresh interval multiplier during auto focus
 
     if cuda is True:
         try:
@@ -95,6 +134,9 @@ class HoloGUI(CAS_GUI):
         
         super().create_layout()
 
+        # The ROI is used for unwrapping
+        self.mainDisplay.roiChanged.connect(self.processing_options_changed)
+
         # Create the additional menu buttons needed
         self.focusMenuButton = self.create_menu_button(
             "Numerical Focusing",
@@ -128,6 +170,14 @@ class HoloGUI(CAS_GUI):
             False,
             11,
         )
+        self.allInFocusButton = self.create_menu_button(
+            "All-in-Focus Image",
+            QIcon("res/icons/layers_white.svg"),
+            self.all_in_focus_clicked,
+            False,
+            False,
+            12,
+        )
         
         self.saveRawButton = self.create_menu_button(
             "Save Raw As",
@@ -138,6 +188,20 @@ class HoloGUI(CAS_GUI):
             9,
         )
 
+        # Lossless compressed and off-axis sideband recording are options
+        # for raw recordings
+        self.recordCompressedCheck = QCheckBox("Compressed (Lossless)", objectName="RecordCompressed")
+        self.recordLayout.insertWidget(
+            self.recordLayout.indexOf(self.recordTifCheck) + 1, self.recordCompressedCheck
+        )
+        self.recordCompressedCheck.stateChanged.connect(self.record_options_changed)
+        self.recordSidebandCheck = QCheckBox("Off-Axis Sideband Only", objectName="RecordSideband")
+        self.recordLayout.insertWidget(
+            self.recordLayout.indexOf(self.recordCompressedCheck) + 1, self.recordSidebandCheck
+        )
+        self.recordSidebandCheck.stateChanged.connect(self.record_options_changed)
+        self.record_options_changed()
+
         # Create the additional menu panels needed
         self.oaPanel = self.create_oa_panel()
         self.phasePanel = self.create_phase_panel()
@@ -189,6 +253,115 @@ class HoloGUI(CAS_GUI):
         self.holoAutoFocusROIMarginInput.setMaximum(10**6)
         self.holoAutoFocusROIMarginInput.setMinimum(0)
 
+        self.holoAutoFocusThreadsInput = QSpinBox(objectName="holoAutoFocusThreadsInput")
+        self.holoAutoFocusThreadsInput.setMaximum(256)
+        self.holoAutoFocusThreadsInput.setMinimum(0)
+        self.holoAutoFocusThreadsInput.setValue(0)
+        self.holoAutoFocusThreadsInput.setSpecialValueText("Auto")
+
+        self.focusTracker = FocusTracker()
+
+        self.holoFocusTrackCheck = QCheckBox(
+            "Track Focus (Live)", objectName="holoFocusTrackCheck"
+        )
+        self.holoFocusTrackCheck.setToolTip(
+            "Periodically searches around the current depth, within the ROI if set, and follows the best focus."
+        )
+
+        self.holoFocusTrackIntervalInput = QSpinBox(
+            objectName="holoFocusTrackIntervalInput"
+        )
+        self.holoFocusTrackIntervalInput.setMaximum(10000)
+        self.holoFocusTrackIntervalInput.setMinimum(1)
+        self.holoFocusTrackIntervalInput.setValue(10)
+
+        self.holoFocusTrackRangeInput = QDoubleSpinBox(
+            objectName="holoFocusTrackRangeInput"
+        )
+        self.holoFocusTrackRangeInput.setMaximum(10**6)
+        self.holoFocusTrackRangeInput.setMinimum(1)
+        self.holoFocusTrackRangeInput.setValue(50)
+
+        self.holoPropagatorCacheInput = QSpinBox(objectName="holoPropagatorCacheInput")
+        self.holoPropagatorCacheInput.setMaximum(65536)
+        self.holoPropagatorCacheInput.setMinimum(0)
+        self.holoPropagatorCacheInput.setValue(512)
+        self.holoPropagatorCacheInput.setKeyboardTracking(False)
+
+        self.holoScrubModeCheck = QCheckBox(
+            "Scrub Mode (Precompute Stack)", objectName="holoScrubModeCheck"
+        )
+        self.holoScrubInterpolateCheck = QCheckBox(
+            "Interpolate Between Planes", objectName="holoScrubInterpolateCheck"
+        )
+        self.holoScrubPlanesInput = QSpinBox(objectName="holoScrubPlanesInput")
+        self.holoScrubPlanesInput.setMaximum(1000)
+        self.holoScrubPlanesInput.setMinimum(2)
+        self.holoScrubPlanesInput.setValue(64)
+        self.holoScrubPlanesInput.setKeyboardTracking(False)
+
+        self.holoMultiPlaneCheck = QCheckBox(
+            "Multi-Plane View", objectName="holoMultiPlaneCheck"
+        )
+        self.holoMultiPlaneCheck.setToolTip(
+            "Shows several planes, centred on the current depth, tiled side by side."
+        )
+        self.holoMultiPlaneNumInput = QSpinBox(objectName="holoMultiPlaneNumInput")
+        self.holoMultiPlaneNumInput.setMaximum(16)
+        self.holoMultiPlaneNumInput.setMinimum(2)
+        self.holoMultiPlaneNumInput.setValue(3)
+        self.holoMultiPlaneNumInput.setKeyboardTracking(False)
+
+        self.holoMultiPlaneSpacingInput = QDoubleSpinBox(
+            objectName="holoMultiPlaneSpacingInput"
+        )
+        self.holoMultiPlaneSpacingInput.setMaximum(10**6)
+        self.holoMultiPlaneSpacingInput.setMinimum(0)
+        self.holoMultiPlaneSpacingInput.setValue(10)
+        self.holoMultiPlaneSpacingInput.setKeyboardTracking(False)
+
+        self.holoEDOFCheck = QCheckBox(
+            "All-in-Focus (EDOF) View", objectName="holoEDOFCheck"
+        )
+        self.holoEDOFCheck.setToolTip(
+            "Shows the sharpest of several planes over the depth slider range at each pixel."
+        )
+        self.holoEDOFPlanesInput = QSpinBox(objectName="holoEDOFPlanesInput")
+        self.holoEDOFPlanesInput.setMaximum(1000)
+        self.holoEDOFPlanesInput.setMinimum(2)
+        self.holoEDOFPlanesInput.setValue(5)
+        self.holoEDOFPlanesInput.setKeyboardTracking(False)
+
+        self.holoEDOFDepthMapCheck = QCheckBox(
+            "Show Depth Map", objectName="holoEDOFDepthMapCheck"
+        )
+
+        self.holoEDOFMetricCombo = QComboBox(objectName="holoEDOFMetricCombo")
+        self.holoEDOFMetricCombo.addItems(EDOF_METRICS)
+
+        self.holoEDOFWindowInput = QSpinBox(objectName="holoEDOFWindowInput")
+        self.holoEDOFWindowInput.setMaximum(1000)
+        self.holoEDOFWindowInput.setMinimum(1)
+        self.holoEDOFWindowInput.setValue(15)
+        self.holoEDOFWindowInput.setKeyboardTracking(False)
+
+        self.holoEDOFTiledCheck = QCheckBox(
+            "Focus by Tile (Faster)", objectName="holoEDOFTiledCheck"
+        )
+
+        # Refreshes the display while the scrub stack fills in
+        self.scrubTimer = QTimer()
+        self.scrubTimer.timeout.connect(self.scrub_timer_tick)
+        self.scrubLastProgress = None
+
+        # Changes to processing options are applied once they pause for
+        # settingsDelay ms
+        self.settingsTracker = SettingsTracker()
+        self.settingsTimer = QTimer()
+        self.settingsTimer.setSingleShot(True)
+        self.settingsTimer.setInterval(self.settingsDelay)
+        self.settingsTimer.timeout.connect(self.apply_processing_settings)
+
         self.holoRefocusCheck.stateChanged.connect(self.processing_options_changed)
         
         self.holoSourceDistanceSpin.valueChanged[float].connect(self.processing_options_changed)
@@ -199,6 +372,35 @@ class HoloGUI(CAS_GUI):
         self.holoSliderMinInput.valueChanged[float].connect(
             self.processing_options_changed
         )
+        self.holoPropagatorCacheInput.valueChanged[int].connect(
+            self.processing_options_changed
+        )
+        self.holoScrubModeCheck.stateChanged.connect(self.processing_options_changed)
+        self.holoScrubInterpolateCheck.stateChanged.connect(
+            self.processing_options_changed
+        )
+        self.holoScrubPlanesInput.valueChanged[int].connect(
+            self.processing_options_changed
+        )
+        self.holoMultiPlaneCheck.stateChanged.connect(self.processing_options_changed)
+        self.holoMultiPlaneNumInput.valueChanged[int].connect(
+            self.processing_options_changed
+        )
+        self.holoMultiPlaneSpacingInput.valueChanged[float].connect(
+            self.processing_options_changed
+        )
+        self.holoEDOFCheck.stateChanged.connect(self.processing_options_changed)
+        self.holoEDOFPlanesInput.valueChanged[int].connect(
+            self.processing_options_changed
+        )
+        self.holoEDOFDepthMapCheck.stateChanged.connect(self.processing_options_changed)
+        self.holoEDOFMetricCombo.currentIndexChanged[int].connect(
+            self.processing_options_changed
+        )
+        self.holoEDOFWindowInput.valueChanged[int].connect(
+            self.processing_options_changed
+        )
+        self.holoEDOFTiledCheck.stateChanged.connect(self.processing_options_changed)
 
         layout.addWidget(self.holoRefocusCheck)
         
@@ -217,6 +419,34 @@ class HoloGUI(CAS_GUI):
         layout.addWidget(QLabel("Depth Slider Max (microns):"))
         layout.addWidget(self.holoSliderMaxInput)
 
+        layout.addWidget(QLabel("Propagator Cache (MB):"))
+        layout.addWidget(self.holoPropagatorCacheInput)
+
+        layout.addWidget(self.holoScrubModeCheck)
+        layout.addWidget(self.holoScrubInterpolateCheck)
+        layout.addWidget(QLabel("Scrub Mode Planes:"))
+        layout.addWidget(self.holoScrubPlanesInput)
+
+        layout.addWidget(self.holoMultiPlaneCheck)
+        layout.addWidget(QLabel("Multi-Plane Planes:"))
+        layout.addWidget(self.holoMultiPlaneNumInput)
+        layout.addWidget(QLabel("Multi-Plane Spacing (microns):"))
+        layout.addWidget(self.holoMultiPlaneSpacingInput)
+
+        header = QLabel("All-in-Focus")
+        header.setProperty("subheader", "true")
+        layout.addWidget(header)
+
+        layout.addWidget(self.holoEDOFCheck)
+        layout.addWidget(QLabel("All-in-Focus Planes:"))
+        layout.addWidget(self.holoEDOFPlanesInput)
+        layout.addWidget(self.holoEDOFDepthMapCheck)
+        layout.addWidget(QLabel("Focus Metric:"))
+        layout.addWidget(self.holoEDOFMetricCombo)
+        layout.addWidget(QLabel("Focus Window (px):"))
+        layout.addWidget(self.holoEDOFWindowInput)
+        layout.addWidget(self.holoEDOFTiledCheck)
+
         header = QLabel("Auto Focus")
         header.setProperty("subheader", "true")
         layout.addWidget(header)
@@ -233,6 +463,15 @@ class HoloGUI(CAS_GUI):
         layout.addWidget(QLabel("Autofocus ROI Margin (px):"))
         layout.addWidget(self.holoAutoFocusROIMarginInput)
 
+        layout.addWidget(QLabel("Autofocus Threads:"))
+        layout.addWidget(self.holoAutoFocusThreadsInput)
+
+        layout.addWidget(self.holoFocusTrackCheck)
+        layout.addWidget(QLabel("Focus Tracking Interval (frames):"))
+        layout.addWidget(self.holoFocusTrackIntervalInput)
+        layout.addWidget(QLabel("Focus Tracking Range (+/- microns):"))
+        layout.addWidget(self.holoFocusTrackRangeInput)
+
         layout.addStretch()
 
         return widget
@@ -343,6 +582,28 @@ class HoloGUI(CAS_GUI):
         layout.addWidget(self.holoUnWrapPhaseCheck)
         self.holoUnWrapPhaseCheck.stateChanged.connect(self.processing_options_changed)
 
+        self.holoUnwrapMethodCombo = QComboBox(objectName="holoUnwrapMethodCombo")
+        self.holoUnwrapMethodCombo.addItems(PhaseUnwrapper.METHODS)
+        layout.addWidget(QLabel("Unwrap Method:"))
+        layout.addWidget(self.holoUnwrapMethodCombo)
+        self.holoUnwrapMethodCombo.currentIndexChanged[int].connect(
+            self.processing_options_changed
+        )
+
+        self.holoUnwrapROICheck = QCheckBox(
+            "Unwrap ROI Only", objectName="holoUnwrapROICheck"
+        )
+        layout.addWidget(self.holoUnwrapROICheck)
+        self.holoUnwrapROICheck.stateChanged.connect(self.processing_options_changed)
+
+        self.holoTemporalUnwrapCheck = QCheckBox(
+            "Temporal Unwrapping (Live)", objectName="holoTemporalUnwrapCheck"
+        )
+        layout.addWidget(self.holoTemporalUnwrapCheck)
+        self.holoTemporalUnwrapCheck.stateChanged.connect(
+            self.processing_options_changed
+        )
+
         lab = QLabel("Tilt Removal")
         lab.setProperty("subheader", "true")
         layout.addWidget(lab)
@@ -353,7 +614,22 @@ class HoloGUI(CAS_GUI):
 
         self.holoDetectTiltBtn = QPushButton("Detect Tilt")
         layout.addWidget(self.holoDetectTiltBtn)
-        self.holoUnWrapPhaseCheck.clicked.connect(self.detect_tilt_clicked)
+        self.holoDetectTiltBtn.clicked.connect(self.detect_tilt_clicked)
+
+        self.holoTiltOrderInput = QSpinBox(objectName="holoTiltOrderInput")
+        self.holoTiltOrderInput.setMinimum(1)
+        self.holoTiltOrderInput.setMaximum(3)
+        layout.addWidget(QLabel("Tilt Model Order (1 = Plane):"))
+        layout.addWidget(self.holoTiltOrderInput)
+        self.holoTiltOrderInput.valueChanged[int].connect(
+            self.processing_options_changed
+        )
+
+        self.holoAutoTiltCheck = QCheckBox(
+            "Update Tilt from Live Frames", objectName="holoAutoTiltCheck"
+        )
+        layout.addWidget(self.holoAutoTiltCheck)
+        self.holoAutoTiltCheck.stateChanged.connect(self.processing_options_changed)
 
         lab = QLabel("Phase Visualisation")
         lab.setProperty("subheader", "true")
@@ -405,7 +681,12 @@ class HoloGUI(CAS_GUI):
         )
         self.autoFocusButton = QPushButton("Auto")
         self.autoFocusButton.clicked.connect(self.auto_focus_clicked)
-       # self.longFocusWidgetLayout.addWidget(self.autoFocusButton)
+        self.longFocusWidgetLayout.addWidget(self.autoFocusButton)
+        self.autoFocusStatus = QLabel("")
+        self.autoFocusStatus.setWordWrap(True)
+        self.longFocusWidgetLayout.addWidget(
+            self.autoFocusStatus, alignment=QtCore.Qt.AlignHCenter
+        )
         self.longFocusWidget.setStyleSheet(
             "QWidget{padding:0px; margin:0px;background-color:rgba(30, 30, 60, 255)}"
         )
@@ -462,6 +743,64 @@ class HoloGUI(CAS_GUI):
         self.holoDownsampleInput.setMinimum(1)
         self.holoDownsampleInput.setKeyboardTracking(False)
 
+        self.queuePolicy = QueuePolicy(maxDepth=self.rawImageBufferSize)
+
+        self.holoQueuePolicyCombo = QComboBox(objectName="holoQueuePolicyCombo")
+        self.holoQueuePolicyCombo.addItems(QueuePolicy.POLICIES)
+
+        self.holoQueueDepthInput = QSpinBox(objectName="holoQueueDepthInput")
+        self.holoQueueDepthInput.setMaximum(self.rawImageBufferSize)
+        self.holoQueueDepthInput.setMinimum(1)
+        self.holoQueueDepthInput.setValue(self.rawImageBufferSize)
+
+        self.holoProcessEveryNInput = QSpinBox(objectName="holoProcessEveryNInput")
+        self.holoProcessEveryNInput.setMaximum(1000)
+        self.holoProcessEveryNInput.setMinimum(1)
+        self.holoProcessEveryNInput.setValue(2)
+
+        self.holoTelemetryLogCheck = QCheckBox(
+            "Log Processing Times", objectName="holoTelemetryLogCheck"
+        )
+
+        self.holoFastDisplayCheck = QCheckBox(
+            "Fast Display", objectName="holoFastDisplayCheck"
+        )
+        self.holoFastDisplayCheck.setToolTip(
+            "Live images are reduced to the display size and converted to 8 bit by the processor. Processed images saved or recorded while this is checked are also the reduced display images."
+        )
+
+        self.holoAdaptiveDownsampleCheck = QCheckBox(
+            "Adaptive Downsampling", objectName="holoAdaptiveDownsampleCheck"
+        )
+        self.holoAdaptiveDownsampleCheck.setToolTip(
+            "Live images are downsampled further when needed to keep up with the target frame rate, and shown at the set downsample factor when paused."
+        )
+
+        self.holoTargetFPSInput = QDoubleSpinBox(objectName="holoTargetFPSInput")
+        self.holoTargetFPSInput.setMaximum(1000)
+        self.holoTargetFPSInput.setMinimum(1)
+        self.holoTargetFPSInput.setValue(20)
+        self.holoTargetFPSInput.setKeyboardTracking(False)
+
+        self.holoMaxDownsampleInput = QSpinBox(objectName="holoMaxDownsampleInput")
+        self.holoMaxDownsampleInput.setMaximum(16)
+        self.holoMaxDownsampleInput.setMinimum(1)
+        self.holoMaxDownsampleInput.setValue(4)
+
+        self.holoROIReconstructCheck = QCheckBox(
+            "Reconstruct ROI Only", objectName="holoROIReconstructCheck"
+        )
+
+        self.holoROIGuardInput = QSpinBox(objectName="holoROIGuardInput")
+        self.holoROIGuardInput.setMaximum(10000)
+        self.holoROIGuardInput.setMinimum(0)
+        self.holoROIGuardInput.setSpecialValueText("Auto")
+        self.holoROIGuardInput.setKeyboardTracking(False)
+
+        self.queueStatusLabel = QLabel("")
+        self.queueStatusLabel.setWordWrap(True)
+        self.queueStatusLabel.setProperty("status", "true")
+
         self.mainMenuBackBtn = QPushButton("Acquire Background")
         self.mainMenuBackBtn.clicked.connect(self.acquire_background_clicked)
 
@@ -476,6 +815,35 @@ class HoloGUI(CAS_GUI):
         self.backgroundStatusLabel.setProperty("status", "true")
         self.backgroundStatusLabel.setTextFormat(Qt.RichText)
 
+        self.backgroundBuilder = BackgroundBuilder()
+
+        self.holoLiveBackgroundCheck = QCheckBox(
+            "Build Background from Live Frames", objectName="holoLiveBackgroundCheck"
+        )
+        self.holoLiveBackgroundCheck.setToolTip(
+            "Frames acquired while this is checked are averaged to form the background, so only check it when there is nothing in the field of view."
+        )
+
+        self.holoLiveBackgroundMethodCombo = QComboBox(
+            objectName="holoLiveBackgroundMethodCombo"
+        )
+        self.holoLiveBackgroundMethodCombo.addItems(BackgroundBuilder.METHODS)
+
+        self.holoLiveBackgroundFramesInput = QSpinBox(
+            objectName="holoLiveBackgroundFramesInput"
+        )
+        self.holoLiveBackgroundFramesInput.setMaximum(256)
+        self.holoLiveBackgroundFramesInput.setMinimum(1)
+        self.holoLiveBackgroundFramesInput.setValue(BackgroundBuilder.numFrames)
+        self.holoLiveBackgroundFramesInput.setKeyboardTracking(False)
+
+        self.holoLiveBackgroundIntervalInput = QDoubleSpinBox(
+            objectName="holoLiveBackgroundIntervalInput"
+        )
+        self.holoLiveBackgroundIntervalInput.setMaximum(3600)
+        self.holoLiveBackgroundIntervalInput.setMinimum(0.1)
+        self.holoLiveBackgroundIntervalInput.setValue(2)
+
         layout.addWidget(self.holoBackgroundCheck)
         layout.addWidget(self.holoNormaliseCheck)
         layout.addWidget(self.holoInvertCheck)
@@ -488,6 +856,16 @@ class HoloGUI(CAS_GUI):
         layout.addWidget(self.mainMenuBackBtn)
         layout.addWidget(self.mainMenuLoadBackBtn)
         layout.addWidget(self.mainMenuSaveBackBtn)
+        layout.addWidget(self.holoLiveBackgroundCheck)
+
+        layout.addWidget(QLabel("Live Background Method:"))
+        layout.addWidget(self.holoLiveBackgroundMethodCombo)
+
+        layout.addWidget(QLabel("Live Background Frames:"))
+        layout.addWidget(self.holoLiveBackgroundFramesInput)
+
+        layout.addWidget(QLabel("Live Background Update Interval (s):"))
+        layout.addWidget(self.holoLiveBackgroundIntervalInput)
 
         lab = QLabel("Parameters")
         lab.setProperty("subheader", "true")
@@ -507,6 +885,37 @@ class HoloGUI(CAS_GUI):
 
         layout.addWidget(QLabel("Downsample Factor:"))
         layout.addWidget(self.holoDownsampleInput)
+
+        lab = QLabel("Live Processing")
+        lab.setProperty("subheader", "true")
+        layout.addWidget(lab)
+
+        layout.addWidget(QLabel("Frame Queue Policy:"))
+        layout.addWidget(self.holoQueuePolicyCombo)
+
+        layout.addWidget(QLabel("Max Queued Frames:"))
+        layout.addWidget(self.holoQueueDepthInput)
+
+        layout.addWidget(QLabel("Process Every Nth Frame:"))
+        layout.addWidget(self.holoProcessEveryNInput)
+
+        layout.addWidget(self.holoFastDisplayCheck)
+
+        layout.addWidget(self.holoAdaptiveDownsampleCheck)
+
+        layout.addWidget(QLabel("Target Frame Rate (fps):"))
+        layout.addWidget(self.holoTargetFPSInput)
+
+        layout.addWidget(QLabel("Max Adaptive Downsample:"))
+        layout.addWidget(self.holoMaxDownsampleInput)
+
+        layout.addWidget(self.holoROIReconstructCheck)
+
+        layout.addWidget(QLabel("ROI Guard Band (px):"))
+        layout.addWidget(self.holoROIGuardInput)
+
+        layout.addWidget(self.holoTelemetryLogCheck)
+        layout.addWidget(self.queueStatusLabel)
         layout.addStretch()
 
         self.holoWavelengthInput.valueChanged[float].connect(
@@ -528,6 +937,41 @@ class HoloGUI(CAS_GUI):
         self.holoDownsampleInput.valueChanged[int].connect(
             self.processing_options_changed
         )
+        self.holoQueuePolicyCombo.currentIndexChanged[int].connect(
+            self.processing_options_changed
+        )
+        self.holoQueueDepthInput.valueChanged[int].connect(
+            self.processing_options_changed
+        )
+        self.holoProcessEveryNInput.valueChanged[int].connect(
+            self.processing_options_changed
+        )
+        self.holoTelemetryLogCheck.stateChanged.connect(self.processing_options_changed)
+        self.holoFastDisplayCheck.stateChanged.connect(self.processing_options_changed)
+        self.holoAdaptiveDownsampleCheck.stateChanged.connect(
+            self.processing_options_changed
+        )
+        self.holoTargetFPSInput.valueChanged[float].connect(
+            self.processing_options_changed
+        )
+        self.holoMaxDownsampleInput.valueChanged[int].connect(
+            self.processing_options_changed
+        )
+        self.holoROIReconstructCheck.stateChanged.connect(
+            self.processing_options_changed
+        )
+        self.holoROIGuardInput.valueChanged[int].connect(
+            self.processing_options_changed
+        )
+        self.holoLiveBackgroundCheck.stateChanged.connect(
+            self.live_background_options_changed
+        )
+        self.holoLiveBackgroundMethodCombo.currentIndexChanged[int].connect(
+            self.live_background_options_changed
+        )
+        self.holoLiveBackgroundFramesInput.valueChanged[int].connect(
+            self.live_background_options_changed
+        )
 
         return
 
@@ -544,14 +988,22 @@ class HoloGUI(CAS_GUI):
             self.imageProcessor.get_processor().holo.set_depth(
                 self.holoDepthInput.value() / 10**6
             )
+            self.settingsTracker.record({"depth": self.holoDepthInput.value() / 10**6})
 
         # Match depth slider to depth numeric input
         self.holoLongDepthSlider.setValue(int(self.holoDepthInput.value()))
         self.update_file_processing()
 
+    def create_processors(self):
+        # A new processor needs all of the settings, not just changes
+        self.settingsTracker.reset()
+        super().create_processors()
+
     def processing_options_changed(self):
-        """When changes are made to processing options, set up the image
-        processor to process the images as required.
+        """When changes are made to processing options, update the GUI and
+        schedule the image processor to be updated. Rapid changes, such as
+        dragging a spinbox, are coalesced by restarting settingsTimer, so that
+        the processor is only updated once they pause.
         """
 
         if self.backgroundImage is not None:
@@ -579,203 +1031,409 @@ class HoloGUI(CAS_GUI):
             )
         )
 
-        # Everything else is only possible if we have an image processor
-        if self.imageProcessor is not None:
-            self.imageProcessor.get_processor().holo.set_use_cuda(self.cuda)
-            
-            self.imageProcessor.get_processor().holo.correct_curvature = self.holoCurvatureCheck.isChecked() / 10**6
-            self.imageProcessor.get_processor().holo.source_distance = self.holoSourceDistanceSpin.value() / 10**6       
-            
-
-            self.imageProcessor.get_processor().holo.set_downsample(
-                self.holoDownsampleInput.value()
-            )
+        self.queuePolicy.policy = self.holoQueuePolicyCombo.currentText()
+        self.queuePolicy.maxDepth = self.holoQueueDepthInput.value()
+        self.holoQueueDepthInput.setEnabled(
+            self.queuePolicy.policy != QueuePolicy.LATEST_ONLY
+        )
+        self.holoProcessEveryNInput.setEnabled(
+            self.queuePolicy.policy == QueuePolicy.EVERY_NTH
+        )
+        self.holoTargetFPSInput.setEnabled(self.holoAdaptiveDownsampleCheck.isChecked())
+        self.holoMaxDownsampleInput.setEnabled(
+            self.holoAdaptiveDownsampleCheck.isChecked()
+        )
 
-            self.imageProcessor.get_processor().DIC = self.holoDICCheck.isChecked()
-            self.imageProcessor.get_processor().removeTilt = (
-                self.holoRemoveTiltCheck.isChecked()
+        self.mainDisplay.clear_overlays()
+        if self.holoShowFFT.isChecked():
+            self.mainDisplay.add_overlay(
+                self.mainDisplay.ELLIPSE,
+                0,
+                0,
+                4 * self.holoOffAxisRadiusX.value(),
+                4 * self.holoOffAxisRadiusY.value(),
+                QPen(Qt.red, 2, Qt.SolidLine),
+                None,
             )
-            self.imageProcessor.get_processor().unwrap = (
-                self.holoUnWrapPhaseCheck.isChecked()
+            self.mainDisplay.add_overlay(
+                self.mainDisplay.ELLIPSE,
+                self.holoOffAxisCentreX.value(),
+                self.holoOffAxisCentreY.value(),
+                2 * self.holoOffAxisRadiusX.value(),
+                2 * self.holoOffAxisRadiusY.value(),
+                QPen(Qt.blue, 2, Qt.SolidLine),
+                None,
             )
 
-            self.imageProcessor.get_processor().holo.return_fft = (
-                self.holoShowFFT.isChecked()
+        if self.phase_display():
+            self.mainDisplay.set_colormap("twilight")
+        else:
+            self.mainDisplay.set_colormap("gray")
+
+        # Images converted for display by the processor are already scaled
+        self.mainDisplay.set_auto_scale(not self.fast_display_active())
+
+        if self.imageProcessor is not None:
+            # Stage timings from the processor on the other core are read
+            # through shared memory
+            if self.multiCore and self.telemetryReader is None:
+                self.telemetryReader = TelemetryReader(HoloProcessor.STAGES)
+
+            # Scrub mode only makes sense for a hologram loaded from file
+            if self.holoScrubModeCheck.isChecked() and self.is_file_source():
+                self.scrubLastProgress = None
+                self.scrubTimer.start(200)
+            else:
+                self.scrubTimer.stop()
+
+        # The first settings are applied immediately so that the processor is
+        # ready before any images arrive
+        if self.settingsTracker.is_empty():
+            self.apply_processing_settings()
+        else:
+            self.settingsTimer.start()
+
+    def is_file_source(self):
+        return self.camTypes[self.camSourceCombo.currentIndex()] == self.FILE_TYPE
+
+    def phase_display(self):
+        """Returns True if the output shown is a phase map."""
+        return self.holoShowPhaseCheck.isChecked() and not (
+            self.holoDICCheck.isChecked() or self.holoShowFFT.isChecked()
+        )
+
+    def fast_display_active(self):
+        """Returns True if live outputs are converted for display by the
+        processor. Not used for files, so that processed images can be
+        saved at full resolution, or when the display is zoomed in.
+        """
+        return (
+            self.holoFastDisplayCheck.isChecked()
+            and not self.is_file_source()
+            and self.mainDisplay.zoomLevel == 0
+        )
+
+    def image_roi(self):
+        """Returns the display ROI as (x1, y1, x2, y2) in pixels of the full
+        resolution output, or None if there is no ROI.
+        """
+        if self.mainDisplay.roi is None:
+            return None
+        return tuple(int(value) * self.displayDecimation for value in self.mainDisplay.roi)
+
+    def set_display_decimation(self, factor):
+        """Changes the decimation of images converted for display, scaling
+        the display ROI so that it stays on the same part of the image.
+        """
+        if factor == self.displayDecimation:
+            return
+        if self.mainDisplay.roi is not None:
+            self.mainDisplay.roi = tuple(
+                int(value * self.displayDecimation / factor) for value in self.mainDisplay.roi
             )
-            self.mainDisplay.clear_overlays()
-
-            if self.holoShowFFT.isChecked():
-                self.mainDisplay.add_overlay(
-                    self.mainDisplay.ELLIPSE,
-                    0,
-                    0,
-                    4 * self.holoOffAxisRadiusX.value(),
-                    4 * self.holoOffAxisRadiusY.value(),
-                    QPen(Qt.red, 2, Qt.SolidLine),
-                    None,
-                )
-                self.mainDisplay.add_overlay(
-                    self.mainDisplay.ELLIPSE,
-                    self.holoOffAxisCentreX.value(),
-                    self.holoOffAxisCentreY.value(),
-                    2 * self.holoOffAxisRadiusX.value(),
-                    2 * self.holoOffAxisRadiusY.value(),
-                    QPen(Qt.blue, 2, Qt.SolidLine),
-                    None,
-                )
+            self.mainDisplay.update()
+        self.displayDecimation = factor
+        self.processing_options_changed()
+
+    def update_display_decimation(self):
+        """Chooses the decimation of images converted for display so that
+        they are no smaller than the display. The full output size is
+        estimated from the size of the decimated images. After a change, the
+        estimate waits for an image of the new size, as images already being
+        processed still have the old size.
+        """
+        active = self.fast_display_active()
+        if active != self.displayActive:
+            # e.g. the display has been zoomed in or out
+            self.displayActive = active
+            self.pendingDisplayShape = None
+            self.set_display_decimation(1)
+            self.processing_options_changed()
+            return
+        if not active:
+            return
+
+        image = self.currentProcessedImage
+        if image is None or np.ndim(image) != 2:
+            return
+        if self.pendingDisplayShape is not None:
+            if np.shape(image) == self.pendingDisplayShape:
+                return
+            self.pendingDisplayShape = None
 
-            # Background - needs custom code for off-axis and inline as PyHoloscope handles this
-            # differently. For inline, background subtraction is controlled by the existence
-            # of a background image, for off-axis it is by setting flag for relative phase
-            if self.holoOffAxisCheck.isChecked():
-                self.imageProcessor.get_processor().holo.set_background(
-                    self.backgroundImage
-                )
-                self.imageProcessor.get_processor().holo.set_relative_phase(
-                    self.holoRelativePhaseCheck.isChecked()
-                )
+        fullShape = (
+            np.shape(image)[0] * self.displayDecimation,
+            np.shape(image)[1] * self.displayDecimation,
+        )
+        displaySize = (self.mainDisplay.height() - 40, self.mainDisplay.width())
+        factor = decimation_factor(fullShape, displaySize)
+        if factor != self.displayDecimation:
+            self.pendingDisplayShape = np.shape(image)
+            self.set_display_decimation(factor)
+
+    def processing_settings(self):
+        """Returns a dictionary of the processing settings selected in the
+        GUI, see processors.holo_settings. Settings which the current options
+        do not use are omitted, so that the processor keeps its values.
+        """
+        settings = {
+            "cuda": self.cuda,
+            "correct_curvature": self.holoCurvatureCheck.isChecked() / 10**6,
+            "source_distance": self.holoSourceDistanceSpin.value() / 10**6,
+            "downsample": self.holoDownsampleInput.value(),
+            "propagatorCacheSize": self.holoPropagatorCacheInput.value(),
+            "scrub": (
+                self.holoScrubModeCheck.isChecked() and self.is_file_source(),
+                (
+                    self.holoSliderMinInput.value() / 10**6,
+                    self.holoSliderMaxInput.value() / 10**6,
+                ),
+                self.holoScrubPlanesInput.value(),
+                self.holoScrubInterpolateCheck.isChecked(),
+            ),
+            "multiPlane": (
+                self.holoMultiPlaneCheck.isChecked(),
+                self.holoMultiPlaneNumInput.value(),
+                self.holoMultiPlaneSpacingInput.value() / 10**6,
+            ),
+            "edof": (
+                self.holoEDOFCheck.isChecked(),
+                (
+                    self.holoSliderMinInput.value() / 10**6,
+                    self.holoSliderMaxInput.value() / 10**6,
+                ),
+                self.holoEDOFPlanesInput.value(),
+                self.holoEDOFDepthMapCheck.isChecked(),
+            ),
+            "edofFocus": (
+                self.holoEDOFMetricCombo.currentText(),
+                self.holoEDOFWindowInput.value(),
+                self.holoEDOFTiledCheck.isChecked(),
+            ),
+            "DIC": self.holoDICCheck.isChecked(),
+            "removeTilt": self.holoRemoveTiltCheck.isChecked(),
+            "tiltOrder": self.holoTiltOrderInput.value(),
+            "autoTilt": (
+                self.holoAutoTiltCheck.isChecked() and not self.is_file_source()
+            ),
+            "unwrap": self.holoUnWrapPhaseCheck.isChecked(),
+            "unwrapMethod": self.holoUnwrapMethodCombo.currentText(),
+            "unwrapROIOnly": self.holoUnwrapROICheck.isChecked(),
+            # Previous frames are only a good seed for a live stream
+            "temporalUnwrap": (
+                self.holoTemporalUnwrapCheck.isChecked() and not self.is_file_source()
+            ),
+            "return_fft": self.holoShowFFT.isChecked(),
+            "showPhase": self.holoShowPhaseCheck.isChecked(),
+            "refocus": self.holoRefocusCheck.isChecked(),
+            "reuseBuffers": self.multiCore and self.sharedMemory,
+        }
+
+        if self.telemetryReader is not None:
+            settings["telemetryShare"] = self.telemetryReader.shareName
+        if self.holoTelemetryLogCheck.isChecked():
+            os.makedirs(self.studyPath, exist_ok=True)
+            settings["telemetryLog"] = os.path.join(self.studyPath, self.telemetryLogName)
+        else:
+            settings["telemetryLog"] = None
+
+        # Frame skipping only applies to live images
+        if self.queuePolicy.policy == QueuePolicy.EVERY_NTH and not self.is_file_source():
+            settings["processEveryN"] = self.holoProcessEveryNInput.value()
+        else:
+            settings["processEveryN"] = 1
+
+        # Live images can be decimated and scaled for display by the
+        # processor, see processors.display. Wrapped phase has a fixed range.
+        if self.fast_display_active():
+            if self.phase_display() and not self.holoUnWrapPhaseCheck.isChecked():
+                displayRange = (0, 2 * math.pi)
             else:
-                if self.holoBackgroundCheck.isChecked():
-                    self.imageProcessor.get_processor().holo.set_background(
-                        self.backgroundImage
-                    )
-                else:
-                    self.imageProcessor.get_processor().holo.set_background(None)
+                displayRange = None
+            settings["display"] = (True, self.displayDecimation, displayRange)
+        else:
+            settings["display"] = (False, 1, None)
+
+        # Adaptive downsampling only applies to live images, files are
+        # processed at the set downsample factor
+        settings["adaptiveDownsample"] = (
+            self.holoAdaptiveDownsampleCheck.isChecked() and not self.is_file_source(),
+            1 / self.holoTargetFPSInput.value(),
+            self.holoMaxDownsampleInput.value(),
+        )
 
-            if self.holoNormaliseCheck.isChecked() and self.backgroundImage is not None:
-                self.imageProcessor.get_processor().holo.set_normalise(
-                    self.backgroundImage
-                )
+        # Background - needs custom code for off-axis and inline as PyHoloscope handles this
+        # differently. For inline, background subtraction is controlled by the existence
+        # of a background image, for off-axis it is by setting flag for relative phase
+        if self.holoOffAxisCheck.isChecked():
+            settings["mode"] = pyholoscope.Holo.OFF_AXIS
+            settings["crop_centre"] = (
+                self.holoOffAxisCentreX.value(),
+                self.holoOffAxisCentreY.value(),
+            )
+            settings["crop_radius"] = (
+                self.holoOffAxisRadiusX.value(),
+                self.holoOffAxisRadiusY.value(),
+            )
+            settings["background"] = self.backgroundImage
+        else:
+            settings["mode"] = pyholoscope.Holo.INLINE
+            if self.holoBackgroundCheck.isChecked():
+                settings["background"] = self.backgroundImage
             else:
-                self.imageProcessor.get_processor().holo.set_normalise(None)
+                settings["background"] = None
 
-            if self.holoShowPhaseCheck.isChecked():
-                self.imageProcessor.get_processor().showPhase = True
-                self.imageProcessor.get_processor().holo.set_relative_phase(
-                    self.holoRelativePhaseCheck.isChecked()
-                )
-                if self.holoDICCheck.isChecked() or self.holoShowFFT.isChecked():
-                    self.mainDisplay.set_colormap("gray")
-                else:
-                    self.mainDisplay.set_colormap("twilight")
+        if self.holoOffAxisCheck.isChecked() or self.holoShowPhaseCheck.isChecked():
+            settings["relative_phase"] = self.holoRelativePhaseCheck.isChecked()
 
-                if self.mainDisplay.roi is not None:
-                    self.imageProcessor.get_processor().roi = pyholoscope.Roi(
-                        *self.mainDisplay.roi
-                    )
-                else:
-                    self.imageProcessor.get_processor().roi = None
+        if self.holoNormaliseCheck.isChecked() and self.backgroundImage is not None:
+            settings["normalise"] = self.backgroundImage
+        else:
+            settings["normalise"] = None
+
+        # Display ROI is (x1, y1, x2, y2), processor ROI is (x, y, w, h)
+        if self.image_roi() is not None:
+            x1, y1, x2, y2 = self.image_roi()
+            settings["roi"] = (x1, y1, x2 - x1, y2 - y1)
+        else:
+            settings["roi"] = None
+        settings["roiReconstruction"] = self.holoROIReconstructCheck.isChecked()
+        settings["roiGuardBand"] = self.holoROIGuardInput.value()
+
+        if not self.holoShowPhaseCheck.isChecked():
+            settings["invert"] = self.holoInvertCheck.isChecked()
+
+        # Remaining options are only relevant if we refocus
+        if self.holoRefocusCheck.isChecked():
+            if self.holoWavelengthInput.value() > 0:
+                settings["wavelength"] = self.holoWavelengthInput.value() / 10**6
+            if self.holoPixelSizeInput.value() > 0:
+                settings["pixel_size"] = self.holoPixelSizeInput.value() / 10**6
+            settings["depth"] = self.holoDepthInput.value() / 10**6
+
+            if self.holoWindowCombo.currentText() == "Circular":
+                settings["window"] = ("circle", self.holoWindowThicknessInput.value())
+            elif self.holoWindowCombo.currentText() == "Rectangular":
+                settings["window"] = ("square", self.holoWindowThicknessInput.value())
             else:
-                self.imageProcessor.get_processor().showPhase = False
-                self.imageProcessor.get_processor().invert = (
-                    self.holoInvertCheck.isChecked()
-                )
-                self.mainDisplay.set_colormap("gray")
+                settings["window"] = None
 
-            if self.holoOffAxisCheck.isChecked():
-                self.imageProcessor.get_processor().holo.set_mode(
-                    pyholoscope.Holo.OFF_AXIS
-                )
-                self.imageProcessor.get_processor().holo.set_crop_centre(
-                    (self.holoOffAxisCentreX.value(), self.holoOffAxisCentreY.value())
-                )
-                self.imageProcessor.get_processor().holo.set_crop_radius(
-                    (self.holoOffAxisRadiusX.value(), self.holoOffAxisRadiusY.value())
-                )
+        return settings
 
-            else:
-                self.imageProcessor.get_processor().holo.set_mode(
-                    pyholoscope.Holo.INLINE
+    def apply_processing_settings(self):
+        """Applies the processing settings which have changed since they were
+        last applied. Only the changes are sent to the processor on the other
+        core, except the first time, when the whole processor is sent.
+        """
+        self.settingsTimer.stop()
+        if self.imageProcessor is not None:
+            changes = self.settingsTracker.changes(self.processing_settings())
+            if changes:
+                firstUpdate = self.settingsTracker.is_empty()
+                self.imageProcessor.get_processor().apply_settings(
+                    local_changes(changes, multiCore=self.multiCore)
                 )
+                self.settingsTracker.record(changes)
 
-            # Remaining options are only relevant if we refocus
-            if self.holoRefocusCheck.isChecked():
-                self.imageProcessor.get_processor().refocus = True
-                self.imageProcessor.get_processor().holo.set_refocus(True)
-
-                if (
-                    self.holoWavelengthInput.value()
-                    != self.imageProcessor.get_processor().holo.wavelength / 10**6
-                ):
-                    if self.holoWavelengthInput.value() > 0:
-                        self.imageProcessor.get_processor().holo.set_wavelength(
-                            self.holoWavelengthInput.value() / 10**6
+                # This is needed if using multicore processing to update the
+                # copy of the processor class on the other core
+                if firstUpdate:
+                    self.imageProcessor.update_settings()
+                    remoteChanges = remote_only_changes(changes)
+                else:
+                    remoteChanges = remote_changes(changes)
+                if self.multiCore:
+                    if remoteChanges:
+                        self.imageProcessor.pipe_message(
+                            "apply_settings", (remoteChanges,)
                         )
 
-                targetPixelSize = self.holoPixelSizeInput.value() / 10**6
-                if (
-                    targetPixelSize
-                    != self.imageProcessor.get_processor().holo.pixel_size
-                ):
-                    if targetPixelSize > 0:
-                        self.imageProcessor.get_processor().holo.set_pixel_size(
-                            targetPixelSize
-                        )
+        # Needed if we are processing a file
+        self.update_file_processing()
 
-                if (
-                    self.holoDepthInput.value()
-                    != self.imageProcessor.get_processor().holo.depth / 10**6
-                ):
-                    self.imageProcessor.get_processor().holo.set_depth(
-                        self.holoDepthInput.value() / 10**6
-                    )
+    def scrub_timer_tick(self):
+        """Redisplays the hologram while the scrub mode depth stack is being
+        built, so that the displayed plane is refined as finer planes
+        become available.
+        """
+        if self.imageProcessor is None:
+            self.scrubTimer.stop()
+            return
+        progress = self.imageProcessor.get_processor().scrub_progress()
+        if progress is not None and progress != self.scrubLastProgress:
+            self.scrubLastProgress = progress
+            self.update_file_processing()
+        elif progress is not None and progress >= 1:
+            self.scrubTimer.stop()
 
-                if self.holoWindowCombo.currentText() == "Circular":
-                    self.imageProcessor.get_processor().holo.set_auto_window(True)
-                    self.imageProcessor.get_processor().holo.set_window_shape("circle")
-                    self.imageProcessor.get_processor().holo.set_window_thickness(
-                        self.holoWindowThicknessInput.value()
-                    )
-                elif self.holoWindowCombo.currentText() == "Rectangular":
-                    self.imageProcessor.get_processor().holo.set_auto_window(True)
-                    self.imageProcessor.get_processor().holo.set_window_shape("square")
-                    self.imageProcessor.get_processor().holo.set_window_thickness(
-                        self.holoWindowThicknessInput.value()
-                    )
-                else:
-                    self.imageProcessor.get_processor().holo.clear_window()
-                    self.imageProcessor.get_processor().holo.set_auto_window(False)
+    def auto_focus_clicked(self):
+        """Handles auto focus click. Starts an auto focus search in the
+        background, or cancels the search if one is already running.
+        """
+        if self.autoFocusThread is not None and self.autoFocusThread.isRunning():
+            self.autoFocusThread.cancel()
+            self.autoFocusStatus.setText("Cancelling...")
+            return
+
+        if self.imageProcessor is None:
+            return
+
+        hologram = self.currentImage
+        if hologram is None:
+            hologram = self.imageProcessor.get_processor().preProcessFrame
+        if hologram is None:
+            QMessageBox.about(self, "Error", "A hologram is required to auto focus.")
+            return
+
+        if self.image_roi() is not None:
+            x1, y1, x2, y2 = self.image_roi()
+            roi = pyholoscope.Roi(x1, y1, x2 - x1, y2 - y1)
+        else:
+            roi = None
+        autofocusMax = self.holoAutoFocusMaxInput.value() / 10**6
+        autofocusMin = self.holoAutoFocusMinInput.value() / 10**6
+        numSearchDivisions = int(self.holoAutoFocusCoarseDivisionsInput.value())
+        autofocusROIMargin = self.holoAutoFocusROIMarginInput.value()
+        autofocusThreads = self.holoAutoFocusThreadsInput.value() or None
+
+        search = self.imageProcessor.get_processor().focus_search(
+            hologram,
+            (autofocusMin, autofocusMax),
+            roi=roi,
+            margin=autofocusROIMargin,
+            numCoarse=numSearchDivisions,
+            numWorkers=autofocusThreads,
+        )
 
-            else:
-                self.imageProcessor.get_processor().refocus = False
-                self.imageProcessor.get_processor().holo.set_refocus(False)
+        self.autoFocusThread = AutoFocusThread(search)
+        self.autoFocusThread.progress.connect(self.auto_focus_progress)
+        self.autoFocusThread.focusFound.connect(self.auto_focus_found)
+        self.autoFocusThread.finished.connect(self.auto_focus_finished)
 
-            # This is needed if using multicore processing to update the
-            # copy of the processor class on the other core
-            self.imageProcessor.update_settings()
+        # The live display keeps running during the search, but we refresh
+        # the GUI less often to leave more time for the search
+        self.GUITimer.setInterval(self.GUIupdateInterval * self.autoFocusDisplaySlowdown)
 
-        # Needed if we are processing a file
-        self.update_file_processing()
+        self.autoFocusButton.setText("Cancel")
+        self.autoFocusStatus.setText("Focusing...")
+        self.autoFocusThread.start()
 
-    def auto_focus_clicked(self):
-        """Handles auto focus click."""
-        if self.imageProcessor is not None:
-            if self.mainDisplay.roi is not None:
-                roi = pyholoscope.Roi(
-                    self.mainDisplay.roi[0],
-                    self.mainDisplay.roi[1],
-                    self.mainDisplay.roi[2] - self.mainDisplay.roi[0],
-                    self.mainDisplay.roi[3] - self.mainDisplay.roi[1],
-                )
-            else:
-                roi = None
-            autofocusMax = self.holoAutoFocusMaxInput.value() / 1000
-            autofocusMin = self.holoAutoFocusMinInput.value() / 1000
-            numSearchDivisions = int(self.holoAutoFocusCoarseDivisionsInput.value())
-            autofocusROIMargin = self.holoAutoFocusROIMarginInput.value()
-            if self.imageThread is not None:
-                self.imageThread.pause()
-
-            autoFocus = self.imageProcessor.get_processor().auto_focus(
-                roi=roi,
-                margin=autofocusROIMargin,
-                depthRange=(autofocusMin, autofocusMax),
-                coarseSearchInterval=numSearchDivisions,
-            )
-            self.holoDepthInput.setValue(autoFocus * 1000)
+    def auto_focus_progress(self, fraction, bestDepth):
+        """Shows progress and the best depth so far during auto focus."""
+        self.autoFocusStatus.setText(
+            f"{int(fraction * 100)}%: {bestDepth * 10**6:.0f} \u03bcm"
+        )
+
+    def auto_focus_found(self, depth):
+        self.holoDepthInput.setValue(depth * 10**6)
+        self.autoFocusStatus.setText("")
 
-            if self.imageThread is not None:
-                self.imageThread.resume()
+    def auto_focus_finished(self):
+        """Restores the GUI after an auto focus search ends or is cancelled."""
+        self.GUITimer.setInterval(self.GUIupdateInterval)
+        self.autoFocusButton.setText("Auto")
+        if self.autoFocusThread is not None and self.autoFocusThread.search.is_cancelled():
+            self.autoFocusStatus.setText("Cancelled")
 
     def long_depth_slider_changed(self):
         self.holoDepthInput.setValue(int(self.holoLongDepthSlider.value()))
@@ -844,9 +1502,11 @@ class HoloGUI(CAS_GUI):
             )
             self.holoOffAxisRadiusY.blockSignals(False)
 
+            # Calibration also demodulates the background, so send the whole
+            # processor rather than only the changed settings. With the
+            # tracker reset, the settings are applied immediately.
+            self.settingsTracker.reset()
             self.processing_options_changed()
-            self.imageProcessor.update_settings()
-            self.update_file_processing()
 
     def detect_tilt_clicked(self):
         """This is called when user wants to recalculate the tilt of phase
@@ -854,15 +1514,27 @@ class HoloGUI(CAS_GUI):
         """
         if self.imageProcessor is not None and self.currentImage is not None:
             self.imageProcessor.get_processor().obtain_tilt(self.currentImage)
+            self.imageProcessor.pipe_message(
+                "tiltModel", self.imageProcessor.get_processor().tiltModel
+            )
+            self.update_file_processing()
 
     def depth_stack_clicked(self):
-        """Creates a depth stack over a specified range."""
+        """Creates a depth stack over a specified range. Planes are written to
+        file as they are generated on a background thread.
+        """
+        if self.stackExportThread is not None and self.stackExportThread.isRunning():
+            QMessageBox.about(self, "Error", "A depth stack export is already running.")
+            return
 
         if self.imageProcessor is not None and self.currentImage is not None:
             if self.exportStackDialog.exec():
                 try:
                     filename = QFileDialog.getSaveFileName(
-                        self, "Select filename to save to:", "", filter="*.tif"
+                        self,
+                        "Select filename to save to:",
+                        "",
+                        filter="BigTIFF (*.tif);;NumPy (*.npy)",
                     )[0]
                 except:
                     filename = None
@@ -874,17 +1546,484 @@ class HoloGUI(CAS_GUI):
                     nDepths = int(
                         self.exportStackDialog.depthStackNumDepthsInput.value()
                     )
-                    QApplication.setOverrideCursor(Qt.WaitCursor)
-                    depthStack = self.imageProcessor.get_processor().holo.depth_stack(
-                        self.currentImage, depthRange, nDepths
+                    export = DepthStackExport(
+                        self.imageProcessor.get_processor(),
+                        self.currentImage,
+                        depthRange,
+                        nDepths,
+                        filename,
+                        autoContrast=self.exportStackDialog.depthStackAutoContrastCheck.isChecked(),
+                    )
+
+                    self.stackExportProgress = QProgressDialog(
+                        "Exporting depth stack...", "Cancel", 0, 100, self
+                    )
+                    self.stackExportProgress.setWindowModality(Qt.WindowModal)
+                    self.stackExportProgress.setAutoClose(False)
+                    self.stackExportProgress.setAutoReset(False)
+
+                    self.stackExportThread = StackExportThread(export)
+                    self.stackExportThread.progress.connect(
+                        self.stackExportProgress.setValue
                     )
-                    QApplication.restoreOverrideCursor()
-                    depthStack.write_intensity_to_tif(filename)
+                    self.stackExportThread.exported.connect(self.depth_stack_exported)
+                    self.stackExportThread.failed.connect(self.depth_stack_failed)
+                    self.stackExportProgress.canceled.connect(
+                        self.stackExportThread.cancel
+                    )
+                    self.stackExportProgress.show()
+                    self.stackExportThread.start()
         else:
             QMessageBox.about(
                 self, "Error", "A hologram is required to create a depth stack."
             )
 
+    def all_in_focus_clicked(self):
+        """Creates an all-in-focus image and depth map of the current hologram
+        over a specified range, using the focus metric options in the focus
+        panel. The planes are processed on a background thread.
+        """
+        if self.stackExportThread is not None and self.stackExportThread.isRunning():
+            QMessageBox.about(self, "Error", "A depth stack export is already running.")
+            return
+
+        if self.imageProcessor is None or self.currentImage is None:
+            QMessageBox.about(
+                self, "Error", "A hologram is required to create an all-in-focus image."
+            )
+            return
+
+        # The export dialog is shared with the depth stack, which has an
+        # option that does not apply here
+        self.exportStackDialog.depthStackAutoContrastCheck.setVisible(False)
+        accepted = self.exportStackDialog.exec()
+        self.exportStackDialog.depthStackAutoContrastCheck.setVisible(True)
+        if not accepted:
+            return
+
+        try:
+            filename = QFileDialog.getSaveFileName(
+                self,
+                "Select filename to save to:",
+                "",
+                filter="TIFF (*.tif)",
+            )[0]
+        except:
+            filename = None
+        if filename is None or filename == "":
+            return
+
+        export = AllInFocusExport(
+            self.imageProcessor.get_processor(),
+            self.currentImage,
+            (
+                self.exportStackDialog.depthStackMinDepthInput.value() / 1000,
+                self.exportStackDialog.depthStackMaxDepthInput.value() / 1000,
+            ),
+            int(self.exportStackDialog.depthStackNumDepthsInput.value()),
+            filename,
+            metric=self.holoEDOFMetricCombo.currentText(),
+            windowSize=self.holoEDOFWindowInput.value(),
+            tiled=self.holoEDOFTiledCheck.isChecked(),
+        )
+
+        self.stackExportProgress = QProgressDialog(
+            "Creating all-in-focus image...", "Cancel", 0, 100, self
+        )
+        self.stackExportProgress.setWindowModality(Qt.WindowModal)
+        self.stackExportProgress.setAutoClose(False)
+        self.stackExportProgress.setAutoReset(False)
+
+        self.stackExportThread = StackExportThread(export)
+        self.stackExportThread.progress.connect(self.stackExportProgress.setValue)
+        self.stackExportThread.exported.connect(self.depth_stack_exported)
+        self.stackExportThread.failed.connect(self.depth_stack_failed)
+        self.stackExportProgress.canceled.connect(self.stackExportThread.cancel)
+        self.stackExportProgress.show()
+        self.stackExportThread.start()
+
+    def depth_stack_exported(self, complete):
+        """Called when the depth stack export finishes or is cancelled."""
+        self.stackExportProgress.close()
+
+    def depth_stack_failed(self, message):
+        """Called if the depth stack export raises an error."""
+        self.stackExportProgress.close()
+        QMessageBox.about(self, "Error", f"Depth stack export failed: {message}")
+
+    def pause_acquire(self):
+        """Pauses as usual. With adaptive downsampling, the current hologram
+        is then processed again at the set downsample factor, so that the
+        paused image is shown at full quality.
+        """
+        super().pause_acquire()
+        if (
+            self.isPaused
+            and self.holoAdaptiveDownsampleCheck.isChecked()
+            and self.imageProcessor is not None
+            and self.currentImage is not None
+        ):
+            self.currentProcessedImage = self.imageProcessor.get_processor().refine(
+                self.currentImage
+            )
+            self.update_image_display()
+
+    def handle_images(self):
+        """Applies the frame queue policy before handling images as usual, so
+        that stale frames are removed before the processor reaches them.
+        """
+        if self.imageThread is not None and not self.isPaused:
+            self.queuePolicy.apply(self.inputQueue, self.acquisitionLock)
+        super().handle_images()
+        self.update_display_decimation()
+        self.update_live_background()
+        self.update_focus_tracking()
+
+    def live_background_options_changed(self):
+        """Handles changes to the live background options. Starting to build
+        a background, or changing the number of frames, discards any frames
+        already averaged.
+        """
+        self.backgroundBuilder.method = self.holoLiveBackgroundMethodCombo.currentText()
+        self.backgroundBuilder.set_num_frames(self.holoLiveBackgroundFramesInput.value())
+        if not self.holoLiveBackgroundCheck.isChecked():
+            self.backgroundBuilder.reset()
+            self.lastBackgroundFrame = None
+
+    def update_focus_tracking(self):
+        """When focus tracking is on, submits each new live frame to the
+        focus tracker, which searches around the current depth every few
+        frames on a background thread, and moves the depth towards the last
+        depth found.
+        """
+        tracker = self.focusTracker
+        if tracker is None:
+            return
+        if (
+            not self.holoFocusTrackCheck.isChecked()
+            or self.is_file_source()
+            or (self.autoFocusThread is not None and self.autoFocusThread.isRunning())
+        ):
+            tracker.reset()
+            return
+
+        depth = self.holoDepthInput.value() / 10**6
+        if (
+            self.imageProcessor is not None
+            and not self.isPaused
+            and self.currentImage is not None
+            and self.currentImage is not self.lastFocusFrame
+        ):
+            self.lastFocusFrame = self.currentImage
+            tracker.interval = self.holoFocusTrackIntervalInput.value()
+            tracker.searchRange = self.holoFocusTrackRangeInput.value() / 10**6
+            if self.image_roi() is not None:
+                x1, y1, x2, y2 = self.image_roi()
+                roi = pyholoscope.Roi(x1, y1, x2 - x1, y2 - y1)
+            else:
+                roi = None
+            tracker.submit(
+                self.imageProcessor.get_processor(),
+                self.currentImage,
+                depth,
+                roi=roi,
+                margin=self.holoAutoFocusROIMarginInput.value(),
+            )
+
+        tracker.take()
+        newDepth = tracker.step(depth)
+        if newDepth is not None:
+            self.holoDepthInput.setValue(newDepth * 10**6)
+
+    def update_live_background(self):
+        """Adds each new camera frame to the live background, periodically
+        starting an update of the background on a background thread, and
+        uses any background that update has finished. The processor receives
+        the new background as a single settings change, which is applied
+        between frames.
+        """
+        if self.backgroundBuilder is None or not self.holoLiveBackgroundCheck.isChecked():
+            return
+
+        if (
+            not self.isPaused
+            and not self.is_file_source()
+            and self.currentImage is not None
+            and self.currentImage is not self.lastBackgroundFrame
+        ):
+            self.backgroundBuilder.add(self.currentImage)
+            self.lastBackgroundFrame = self.currentImage
+
+            if self.backgroundBuilder.due(self.holoLiveBackgroundIntervalInput.value()):
+                self.backgroundBuilder.start_update(
+                    os.path.join(self.studyPath, self.liveBackgroundName)
+                )
+
+        background = self.backgroundBuilder.take()
+        if background is not None:
+            self.backgroundImage = background
+            self.backgroundSource = (
+                f"Live background, {self.backgroundBuilder.method.lower()} of "
+                f"{self.backgroundBuilder.num_frames()} frames, updated at "
+                f"{time.strftime('%H:%M:%S')}."
+            )
+            self.processing_options_changed()
+
+    def update_camera_status(self):
+        """Adds frames removed by the queue policy to the dropped frames count
+        and shows the queue depth and estimated display latency.
+        """
+        super().update_camera_status()
+
+        if self.imageThread is not None and self.imageProcessor is not None:
+            queueDepth = self.imageThread.get_num_images_in_queue()
+            numDropped = self.imageThread.numDroppedFrames + self.queuePolicy.numDropped
+            self.droppedFramesLabel.setText(str(numDropped))
+
+            procFps = self.imageProcessor.get_actual_fps()
+            if procFps > 0:
+                latency = estimate_latency(
+                    queueDepth, 1 / procFps, self.GUIupdateInterval / 1000
+                )
+                latencyText = f"~{round(1000 * latency)} ms"
+            else:
+                latencyText = "-"
+            self.queueStatusLabel.setText(
+                f"Queue: {queueDepth}/{self.queuePolicy.target_depth()}   "
+                f"Dropped: {numDropped}   Latency: {latencyText}"
+            )
+        else:
+            self.queueStatusLabel.setText("")
+
+    def record_options_changed(self):
+        """Shows the compressed and sideband options only for raw
+        recordings, where they replace the choice of tif or avi.
+        """
+        super().record_options_changed()
+        if self.recordCompressedCheck is None or self.recordSidebandCheck is None:
+            return
+        self.recordCompressedCheck.setVisible(self.recordRawCheck.isChecked())
+        self.recordSidebandCheck.setVisible(self.recordRawCheck.isChecked())
+        self.recordTifCheck.setEnabled(not self.record_with_writer())
+
+    def record_with_writer(self):
+        """Returns True if the recording options need a RecordingWriter."""
+        return self.recordRawCheck.isChecked() and (
+            self.recordCompressedCheck.isChecked() or self.recordSidebandCheck.isChecked()
+        )
+
+    def start_recording(self):
+        """Starts a lossless compressed or off-axis sideband recording of raw
+        frames if selected, otherwise records as CAS_GUI does. Frames are
+        compressed (and demodulated for sideband recordings) and written by
+        a RecordingWriter on a background thread, together with the time of
+        each frame and the current processing settings.
+        """
+        if not self.record_with_writer():
+            super().start_recording()
+            return
+
+        if self.imageThread is None:
+            QMessageBox.about(self, "Error", "Images not being acquired.")
+            return
+        if self.currentImage is None:
+            QMessageBox.about(self, "Error", "There is no image to record.")
+            return
+
+        self.recordType = self.WRITER
+        self.recordRaw = True
+        self.recordFilename = os.path.join(
+            self.recordFolder, time.strftime("record_%Y_%m_%d_%H_%M_%S.tif")
+        )
+        self.recordBuffered = self.recordBufferCheck.isChecked()
+        self.recordBufferSize = self.recordBufferSpin.value()
+        self.numFramesRecorded = 0
+        self.numFramesBuffered = 0
+
+        try:
+            if self.recordSidebandCheck.isChecked():
+                if not self.holoOffAxisCheck.isChecked() or self.imageProcessor is None:
+                    QMessageBox.about(self, "Error", "Sideband recording needs off-axis processing.")
+                    return
+                self.recordWriter = sideband_writer(
+                    self.recordFilename,
+                    self.imageProcessor.get_processor().holo,
+                    np.shape(self.currentImage),
+                    settings=self.processing_settings(),
+                    compress=self.recordCompressedCheck.isChecked(),
+                    maxQueue=self.recordQueueSize,
+                )
+            else:
+                self.recordWriter = RecordingWriter(
+                    self.recordFilename,
+                    settings=self.processing_settings(),
+                    maxQueue=self.recordQueueSize,
+                )
+        except ImportError as e:
+            QMessageBox.about(self, "Error", str(e))
+            return
+        self.recordWriter.start()
+
+        # Frames are timed as they are put in the auxillary queue by the
+        # acquisition thread, not when the GUI passes them to the writer
+        if self.recordBuffered:
+            # One larger, as for CAS_GUI buffered recording
+            queueSize = self.recordBufferSize + 1
+        else:
+            queueSize = self.imageThread.auxillaryQueue.maxsize
+        thread = self.imageThread
+        thread.auxillaryQueue = TimestampQueue(
+            maxsize=queueSize, frameCounter=lambda: thread.currentFrameNumber
+        )
+        self.imageThread.set_use_auxillary_queue(True)
+
+        self.videoOut = self.recordWriter
+        self.recording = True
+        self.toggleRecordButton.setText("Stop Recording")
+        self.recordRawCheck.setEnabled(False)
+        self.recordCompressedCheck.setEnabled(False)
+        self.recordSidebandCheck.setEnabled(False)
+        self.recordFolderButton.setEnabled(False)
+
+    def record(self):
+        """For compressed and sideband recordings, passes the frames waiting
+        in the auxillary queue to the writer thread. Frames are only taken
+        while the writer has space, so if the writer falls behind the camera
+        frames are dropped from the auxillary queue, rather than memory
+        filling up.
+        """
+        if self.recordType != self.WRITER:
+            super().record()
+            return
+        if not self.recording or self.recordWriter is None:
+            return
+
+        if self.recordBuffered:
+            self.numFramesBuffered = self.imageThread.get_num_images_in_auxillary_queue()
+            if self.numFramesBuffered < self.recordBufferSize:
+                self.recordStatusLabel.setText(
+                    f"Buffered {self.numFramesBuffered} frames of {self.recordBufferSize}."
+                )
+            else:
+                self.record_buffer_full()
+            return
+
+        while not self.recordWriter.full():
+            im = self.imageThread.get_next_auxillary_image()
+            if im is None:
+                break
+            self.write_auxillary_image(im)
+            self.numFramesRecorded += 1
+        self.recordStatusLabel.setText(
+            f"Recorded {self.numFramesRecorded} frames, "
+            f"{self.recordWriter.num_waiting()} waiting to be written, "
+            f"{self.recordWriter.num_dropped()} dropped."
+        )
+
+    def write_auxillary_image(self, im, block=False):
+        """Passes im, the last frame taken from the auxillary queue, to the
+        writer with the time and camera frame number it was acquired at, so
+        that frames dropped from the full auxillary queue are counted. The
+        time is NaN if it is not known.
+        """
+        auxillaryQueue = self.imageThread.auxillaryQueue
+        return self.recordWriter.put(
+            im,
+            timestamp=getattr(auxillaryQueue, "lastTimestamp", np.nan),
+            block=block,
+            frameNumber=getattr(auxillaryQueue, "lastFrameNumber", None),
+        )
+
+    def record_buffer_full(self):
+        """For compressed and sideband recordings, writes the buffered
+        frames, waiting for the writer where necessary, and then ends the
+        recording.
+        """
+        if self.recordType != self.WRITER:
+            super().record_buffer_full()
+            return
+
+        QApplication.setOverrideCursor(Qt.WaitCursor)
+        self.recording = False
+        self.imageThread.set_use_auxillary_queue(False)
+        for idx in range(self.numFramesBuffered):
+            im = self.imageThread.get_next_auxillary_image()
+            if im is not None:
+                self.write_auxillary_image(im, block=True)
+                self.numFramesRecorded += 1
+        self.numFramesBuffered = 0
+        self.stop_recording()
+        QApplication.restoreOverrideCursor()
+
+    def stop_recording(self):
+        """Waits for the writer to finish a compressed or sideband recording
+        before stopping as usual.
+        """
+        writer = self.recordWriter
+        if writer is not None and self.recording:
+            # Frames still in the auxillary queue are part of the recording
+            im = self.imageThread.get_next_auxillary_image()
+            while im is not None:
+                self.write_auxillary_image(im, block=True)
+                self.numFramesRecorded += 1
+                im = self.imageThread.get_next_auxillary_image()
+        self.recordWriter = None
+        super().stop_recording()
+        self.recordCompressedCheck.setEnabled(True)
+        self.recordSidebandCheck.setEnabled(True)
+        if writer is None:
+            return
+
+        writer.stop()
+        if writer.error is not None:
+            QMessageBox.about(self, "Error", f"Recording failed: {writer.error}")
+        else:
+            self.recordStatusLabel.setText(
+                f"Saved {writer.numWritten} frames to {os.path.basename(self.recordFilename)}, "
+                f"{writer.num_dropped()} dropped."
+            )
+
+    def load_file(self, filename=None):
+        """Loads an image file as the source. Multi-frame TIFF and .npy files
+        are memory-mapped with frames prefetched in the background (see
+        MappedFileInterface) rather than being read in full, other files
+        are loaded by CAS_GUI as usual.
+        """
+        if filename is None:
+            filename = QFileDialog.getOpenFileName(
+                parent=self,
+                caption="Select file",
+                filter="*.tif; *.tiff; *.png; *.npy; *.bmp",
+            )[0]
+        if filename is None or filename == "":
+            return
+
+        if isinstance(self.cam, MappedFileInterface):
+            self.cam.dispose()
+
+        if os.path.splitext(filename)[1].lower() in (".tif", ".tiff", ".npy"):
+            cam = MappedFileInterface(filename=filename)
+            if cam.is_file_open() and cam.get_number_images() > 1:
+                if self.camOpen:
+                    try:
+                        self.imageThread.stop()
+                        self.imageTimer.stop()
+                        self.GUITimer.stop()
+                    except:
+                        pass
+                self.cam = cam
+                if self.imageProcessor is None:
+                    self.create_processors()
+                self.fileIdxInput.setMaximum(self.cam.get_number_images() - 1)
+                self.fileIdxSlider.setMaximum(self.cam.get_number_images() - 1)
+                self.fileIdxWidget.show()
+                self.update_file_processing()
+                self.filename_label.setText(filename)
+                return
+            cam.dispose()
+
+        super().load_file(filename)
+
     def update_info_bar(self):
         """Writes information to the bottom status bar."""
 
@@ -924,8 +2063,44 @@ class HoloGUI(CAS_GUI):
         else:
             text = text = "| Amplitude Image"
 
+        text = text + self.timing_info_text()
+
         self.infoBar.setText(text)
 
+    def timing_info_text(self):
+        """Returns text for the info bar with the processing frame rate and
+        the stage taking the most time.
+        """
+        if self.imageProcessor is None:
+            return ""
+
+        if (
+            self.camTypes[self.camSourceCombo.currentIndex()] == self.FILE_TYPE
+            or self.telemetryReader is None
+        ):
+            timer = self.imageProcessor.get_processor().stageTimer
+            fps = timer.fps()
+            summary = timer.summary()
+        else:
+            fps = self.telemetryReader.fps()
+            summary = self.telemetryReader.summary()
+
+        stage = dominant_stage(summary)
+        if stage is None:
+            return ""
+        stats = summary[stage]
+        return (
+            f" | {fps:.1f} fps | Slowest: {stage} {1000 * stats['mean']:.1f} ms "
+            f"(p95 {1000 * stats['p95']:.1f} ms, {100 * stats['fraction']:.0f}%)"
+        )
+
+    def closeEvent(self, event):
+        super().closeEvent(event)
+        if self.recordWriter is not None:
+            self.recordWriter.stop()
+        if self.telemetryReader is not None:
+            self.telemetryReader.close()
+
 
 class ExportStackDialog(QDialog):
     """Dialog box that appears when export depth stack is clicked." """
@@ -958,12 +2133,15 @@ class ExportStackDialog(QDialog):
         self.depthStackNumDepthsInput.setMaximum(10**6)
         self.depthStackNumDepthsInput.setValue(10)
 
+        self.depthStackAutoContrastCheck = QCheckBox("16 Bit Auto Contrast (Slower)")
+
         self.layout.addWidget(QLabel("Start Depth (mm):"))
         self.layout.addWidget(self.depthStackMinDepthInput)
         self.layout.addWidget(QLabel("End Depth (mm):"))
         self.layout.addWidget(self.depthStackMaxDepthInput)
         self.layout.addWidget(QLabel("Number of Depths:"))
         self.layout.addWidget(self.depthStackNumDepthsInput)
+        self.layout.addWidget(self.depthStackAutoContrastCheck)
 
         self.layout.addWidget(self.buttonBox)
         self.setLayout(self.layout)
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""
+HoloSnake Batch
+
+Command line batch processing of saved holograms without the GUI. Processing
+settings are read from a HoloSnake config file (such as config.ini saved by
+the GUI) and each hologram is processed by a pool of worker processes.
+
+Example:
+    python holosnake_batch.py "data/*.tif" -o processed --background back.tif --type phase
+
+"""
+
+import argparse
+import configparser
+import glob
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+import pyholoscope
+
+from processors.holo_processor import HoloProcessor
+
+
+OUTPUT_TYPES = ["amplitude", "phase", "dic"]
+
+# Processor used by each worker process, set by init_worker
+workerProcessor = None
+
+
+def read_config(filename):
+    """Reads the [General] section of a HoloSnake config file written by the
+    GUI and returns a dictionary of widget name: value (as a string).
+    """
+    config = configparser.ConfigParser(interpolation=None)
+    config.optionxform = str  # Keys are widget names, so keep case
+    if not config.read(filename):
+        raise FileNotFoundError(f"Could not read config file {filename}")
+    if "General" not in config:
+        return {}
+
+    # QSettings escapes spaces in keys as %20
+    return {key.replace("%20", " ").strip(): value for key, value in config["General"].items()}
+
+
+def config_bool(config, key, default=False):
+    value = config.get(key, None)
+    if value is None:
+        return default
+    return value.strip().lower() in ("true", "1", "yes")
+
+
+def config_float(config, key, default=0.0):
+    try:
+        return float(config[key])
+    except (KeyError, ValueError):
+        return default
+
+
+def load_image(filename):
+    """Loads an image as a 2D numpy array, converting colour to grayscale."""
+    im = Image.open(filename)
+    if im.mode in ("RGB", "RGBA", "P"):
+        im = im.convert("L")
+    return np.asarray(im)
+
+
+def save_image(filename, img):
+    Image.fromarray(np.asarray(img, dtype="float32")).save(filename)
+
+
+def configure_processor(processor, config, background=None, outputType="amplitude"):
+    """Sets up a HoloProcessor from config values in the same way as the
+    GUI does when processing options are changed. Lengths in the config are
+    in microns.
+    """
+    holo = processor.holo
+
+    holo.correct_curvature = config_bool(config, "holoCorrectCurvature")
+    holo.source_distance = config_float(config, "holoSourceDistanceSpin") / 10**6
+    holo.set_downsample(config_float(config, "holoDownsampleInput", 1))
+
+    offAxis = config_bool(config, "holoOffAxisCheck")
+    if offAxis:
+        holo.set_mode(pyholoscope.Holo.OFF_AXIS)
+        holo.set_background(background)
+        holo.set_crop_centre(
+            (config_float(config, "holoOffAxisCentreX"), config_float(config, "holoOffAxisCentreY"))
+        )
+        holo.set_crop_radius(
+            (config_float(config, "holoOffAxisRadiusX"), config_float(config, "holoOffAxisRadiusY"))
+        )
+    else:
+        holo.set_mode(pyholoscope.Holo.INLINE)
+        if config_bool(config, "holoBackgroundCheck") and background is not None:
+            holo.set_background(background)
+        else:
+            holo.set_background(None)
+
+    if config_bool(config, "holoNormaliseCheck") and background is not None:
+        holo.set_normalise(background)
+    else:
+        holo.set_normalise(None)
+
+    holo.set_relative_phase(config_bool(config, "holoRelativePhaseCheck"))
+
+    processor.showPhase = outputType in ("phase", "dic")
+    processor.DIC = outputType == "dic"
+    processor.invert = config_bool(config, "holoInvertCheck")
+    processor.unwrap = config_bool(config, "holoUnWrapPhaseCheck")
+    processor.removeTilt = config_bool(config, "holoRemoveTiltCheck")
+    processor.roi = None
+    holo.return_fft = False
+
+    if config_bool(config, "holoRefocusCheck", True):
+        processor.refocus = True
+        holo.set_refocus(True)
+        if config_float(config, "holoWavelengthInput") > 0:
+            holo.set_wavelength(config_float(config, "holoWavelengthInput") / 10**6)
+        if config_float(config, "holoPixelSizeInput") > 0:
+            holo.set_pixel_size(config_float(config, "holoPixelSizeInput") / 10**6)
+        holo.set_depth(config_float(config, "holoDepthInput") / 10**6)
+
+        window = config.get("holoWindowCombo", "None")
+        if window in ("Circular", "Rectangular"):
+            holo.set_auto_window(True)
+            holo.set_window_shape("circle" if window == "Circular" else "square")
+            holo.set_window_thickness(config_float(config, "holoWindowThicknessInput"))
+        else:
+            holo.clear_window()
+            holo.set_auto_window(False)
+    else:
+        processor.refocus = False
+        holo.set_refocus(False)
+
+
+def find_files(inputs):
+    """Expands directories and glob patterns into a sorted list of TIFFs."""
+    files = []
+    for item in inputs:
+        if os.path.isdir(item):
+            for ext in ("*.tif", "*.tiff"):
+                files.extend(glob.glob(os.path.join(item, ext)))
+        else:
+            files.extend(glob.glob(item))
+    return sorted(set(files))
+
+
+def output_filename(filename, outputDir, outputType):
+    stem = os.path.splitext(os.path.basename(filename))[0]
+    return os.path.join(outputDir, f"{stem}_{outputType}.tif")
+
+
+def init_worker(processor):
+    """Pool initialiser, stores the configured processor in the worker so it
+    is only sent to each process once. Calibration, background and tilt model
+    are already set up so they are shared by every worker.
+    """
+    global workerProcessor
+    workerProcessor = processor
+    # Each output is saved before the next hologram is processed
+    workerProcessor.reuseBuffers = True
+
+
+def process_file(job):
+    """Processes a single hologram and saves the result. Returns a tuple of
+    (filename, number of pixels, processing time in s, error message or None).
+    """
+    filename, outFilename = job
+    try:
+        hologram = load_image(filename)
+        t1 = time.perf_counter()
+        outputFrame = workerProcessor.process(hologram)
+        elapsed = time.perf_counter() - t1
+        save_image(outFilename, outputFrame)
+        return filename, np.size(hologram), elapsed, None
+    except Exception as e:
+        return filename, 0, 0, str(e)
+
+
+def print_statistics(results, wallTime, numWorkers):
+    processed = [r for r in results if r[3] is None]
+    failed = [r for r in results if r[3] is not None]
+    for filename, numPixels, elapsed, error in failed:
+        print(f"Failed: {filename}: {error}")
+
+    print(f"Processed {len(processed)} holograms ({len(failed)} failed) in {wallTime:.2f} s using {numWorkers} workers")
+    if processed and wallTime > 0:
+        times = np.array([r[2] for r in processed])
+        megapixels = sum(r[1] for r in processed) / 10**6
+        print(f"Throughput: {len(processed) / wallTime:.2f} holograms/s, {megapixels / wallTime:.2f} MPixels/s")
+        print(
+            f"Processing time per hologram: mean {1000 * np.mean(times):.1f} ms, "
+            f"median {1000 * np.median(times):.1f} ms, max {1000 * np.max(times):.1f} ms"
+        )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Batch process holograms using HoloSnake settings.")
+    parser.add_argument("inputs", nargs="+", help="directories or glob patterns of TIFF holograms")
+    parser.add_argument("-o", "--output", default="processed", help="output directory")
+    parser.add_argument("-c", "--config", default="config.ini", help="HoloSnake config file")
+    parser.add_argument("-t", "--type", choices=OUTPUT_TYPES, default="amplitude", help="output image type")
+    parser.add_argument("-b", "--background", default=None, help="background image file")
+    parser.add_argument("--calibrate-off-axis", action="store_true",
+                        help="find the off-axis modulation from the background, or the first hologram if no background")
+    parser.add_argument("--tilt-reference", default=None,
+                        help="hologram used to find the tilt map, default is the first hologram")
+    parser.add_argument("-w", "--workers", type=int, default=None, help="number of worker processes")
+    parser.add_argument("--chunksize", type=int, default=4, help="holograms sent to a worker at once")
+    args = parser.parse_args(argv)
+
+    files = find_files(args.inputs)
+    if not files:
+        print("No holograms found.")
+        return 1
+
+    config = read_config(args.config)
+    background = load_image(args.background) if args.background is not None else None
+
+    processor = HoloProcessor()
+    configure_processor(processor, config, background, args.type)
+
+    # Anything that depends on a reference image is found once here and then
+    # sent to every worker with the processor
+    if args.calibrate_off_axis:
+        processor.holo.calib_off_axis(background if background is not None else load_image(files[0]))
+    if processor.removeTilt and processor.showPhase:
+        reference = args.tilt_reference if args.tilt_reference is not None else files[0]
+        processor.obtain_tilt(load_image(reference))
+
+    os.makedirs(args.output, exist_ok=True)
+    jobs = [(f, output_filename(f, args.output, args.type)) for f in files]
+    numWorkers = args.workers or os.cpu_count() or 1
+
+    t1 = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=numWorkers, initializer=init_worker, initargs=(processor,)) as pool:
+        results = list(pool.map(process_file, jobs, chunksize=max(args.chunksize, 1)))
+    wallTime = time.perf_counter() - t1
+
+    print_statistics(results, wallTime, numWorkers)
+
+    return 0 if all(r[3] is None for r in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+"""
+HoloSnake Benchmark
+
+Times HoloProcessor.process over combinations of processing modes and frame
+sizes, using the example holograms and synthetic inline and off-axis
+holograms. Results are written as JSON so that runs on different versions or
+machines can be compared, and a previous results file can be given to report
+any cases that have become slower.
+
+Example:
+    python holosnake_benchmark.py -o results.json --sizes 512 1024
+    python holosnake_benchmark.py -o new.json --compare results.json
+
+"""
+
+import argparse
+import datetime
+import glob
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+import scipy
+from PIL import Image
+
+import pyholoscope as pyh
+
+from processors.holo_processor import HoloProcessor
+from processors.propagator_cache import angular_spectrum_propagator
+
+
+WAVELENGTH = 0.63e-6
+PIXEL_SIZE = 1e-6
+DEPTH = 0.005
+
+SIZES = [512, 1024, 2048, 4096]
+DOWNSAMPLES = [1, 2, 4]
+OUTPUTS = ["amplitude", "phase", "unwrap", "tilt", "dic"]
+
+
+def synthetic_object(size, rng):
+    """Returns a complex field of size x size containing random weakly
+    absorbing, phase shifting discs.
+    """
+    yy, xx = np.mgrid[0:size, 0:size]
+    amplitude = np.ones((size, size), dtype="float32")
+    phase = np.zeros((size, size), dtype="float32")
+    for idx in range(20):
+        cy, cx = rng.uniform(0, size, 2)
+        radius = rng.uniform(0.01, 0.04) * size
+        disc = (yy - cy) ** 2 + (xx - cx) ** 2 < radius**2
+        amplitude[disc] *= rng.uniform(0.6, 0.95)
+        phase[disc] += rng.uniform(0.5, 2)
+    return amplitude * np.exp(1j * phase)
+
+
+def synthetic_inline(size, seed=0):
+    """Returns (hologram, background) for an inline hologram of an object
+    DEPTH from the camera.
+    """
+    rng = np.random.default_rng(seed)
+    field = synthetic_object(size, rng)
+    prop = angular_spectrum_propagator((size, size), WAVELENGTH, PIXEL_SIZE, -DEPTH)
+    hologram = np.abs(np.fft.ifft2(np.fft.fft2(field) * prop)) ** 2
+    background = np.ones((size, size))
+    return to_camera(hologram), to_camera(background)
+
+
+def synthetic_off_axis(size, seed=0):
+    """Returns (hologram, background) for an off-axis hologram of an object
+    DEPTH from the camera, with a tilted plane wave reference.
+    """
+    rng = np.random.default_rng(seed)
+    field = synthetic_object(size, rng)
+    prop = angular_spectrum_propagator((size, size), WAVELENGTH, PIXEL_SIZE, -DEPTH)
+    field = np.fft.ifft2(np.fft.fft2(field) * prop)
+    yy, xx = np.mgrid[0:size, 0:size]
+    reference = np.exp(2j * np.pi * (xx + yy) / 8)
+    hologram = np.abs(field + reference) ** 2
+    background = np.abs(1 + reference) ** 2
+    return to_camera(hologram), to_camera(background)
+
+
+def to_camera(img):
+    """Scales an intensity image to 16 bit, like a camera frame."""
+    img = img / np.max(img) * 50000
+    return img.astype("uint16")
+
+
+def load_examples(exampleDir):
+    """Returns a list of (name, mode, hologram, background) for the example
+    holograms.
+    """
+    examples = []
+    for filename in sorted(glob.glob(os.path.join(exampleDir, "*_holo.tif"))):
+        name = os.path.basename(filename)
+        mode = "off_axis" if name.startswith("off_axis") else "inline"
+        hologram = np.asarray(Image.open(filename))
+        backFile = filename.replace("_holo.tif", "_back.tif")
+        background = np.asarray(Image.open(backFile)) if os.path.exists(backFile) else None
+        examples.append((name, mode, hologram, background))
+    return examples
+
+
+def create_processor(mode, refocus, output, downsample, hologram, background):
+    """Returns a HoloProcessor set up for one benchmark case."""
+    processor = HoloProcessor()
+    holo = processor.holo
+    holo.set_wavelength(WAVELENGTH)
+    holo.set_pixel_size(PIXEL_SIZE)
+    holo.set_depth(DEPTH)
+    holo.set_downsample(downsample)
+
+    if mode == "off_axis":
+        holo.set_mode(pyh.Holo.OFF_AXIS)
+        holo.calib_off_axis(background if background is not None else hologram)
+        holo.set_background(background)
+        holo.set_relative_phase(background is not None)
+    else:
+        holo.set_mode(pyh.Holo.INLINE)
+        holo.set_background(background)
+
+    processor.refocus = refocus
+    holo.set_refocus(refocus)
+    processor.showPhase = output != "amplitude"
+    processor.invert = False
+    processor.unwrap = output in ("unwrap", "tilt")
+    processor.removeTilt = output == "tilt"
+    processor.DIC = output == "dic"
+    processor.reuseBuffers = True
+    # Every repeat processes the same frame, which would otherwise only be
+    # refocused once and then returned from the stage cache
+    processor.cacheStages = False
+    if processor.removeTilt:
+        processor.obtain_tilt(hologram)
+    return processor
+
+
+def benchmark_case(processor, hologram, repeats, warmup):
+    """Times processing of hologram, returning a dictionary of results."""
+    for idx in range(warmup):
+        processor.process(hologram)
+    processor.stageTimer.reset()
+
+    times = []
+    for idx in range(repeats):
+        t1 = time.perf_counter()
+        out = processor.process(hologram)
+        times.append(time.perf_counter() - t1)
+
+    times = np.array(times)
+    return {
+        "output_shape": list(np.shape(out)) if out is not None else None,
+        "times": times.tolist(),
+        "mean": float(np.mean(times)),
+        "median": float(np.median(times)),
+        "min": float(np.min(times)),
+        "p95": float(np.percentile(times, 95)),
+        "fps": float(1 / np.median(times)) if np.median(times) > 0 else None,
+        "stages": {
+            stage: stats["mean"]
+            for stage, stats in processor.stage_timings().items()
+            if stats["mean"] > 0
+        },
+    }
+
+
+def cases(mode, downsamples, outputs):
+    """Yields (refocus, output, downsample) for each case of a hologram.
+    Without refocusing an inline hologram is returned unchanged, so only one
+    case is needed for that.
+    """
+    for refocus, output, downsample in itertools.product([True, False], outputs, downsamples):
+        if mode == "inline" and not refocus and (output != "amplitude" or downsample != 1):
+            continue
+        yield refocus, output, downsample
+
+
+def case_name(source, mode, refocus, output, downsample):
+    refocusText = "refocus" if refocus else "norefocus"
+    return f"{source}/{mode}/{refocusText}/{output}/ds{downsample}"
+
+
+def environment():
+    """Returns details of the software and machine the benchmark ran on."""
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except Exception:
+        commit = None
+    return {
+        "timestamp": datetime.datetime.now().isoformat(),
+        "git_commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "numpy": np.__version__,
+        "scipy": scipy.__version__,
+        "pyholoscope": getattr(pyh, "__version__", None),
+    }
+
+
+def compare(results, previousFile, threshold):
+    """Prints cases which are slower than in previousFile by more than
+    threshold (fractional increase in median time). Returns the number of
+    regressions.
+    """
+    with open(previousFile) as f:
+        previous = {r["name"]: r for r in json.load(f)["results"]}
+
+    numRegressions = 0
+    for result in results:
+        old = previous.get(result["name"])
+        if old is None or old["median"] <= 0:
+            continue
+        change = result["median"] / old["median"] - 1
+        if change > threshold:
+            numRegressions += 1
+            print(
+                f"Slower: {result['name']} {1000 * old['median']:.2f} ms -> "
+                f"{1000 * result['median']:.2f} ms (+{100 * change:.0f}%)"
+            )
+    print(f"{numRegressions} regressions of more than {100 * threshold:.0f}%")
+    return numRegressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark HoloSnake processing.")
+    parser.add_argument("-o", "--output", default="benchmark_results.json", help="JSON results file")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES, help="synthetic hologram sizes")
+    parser.add_argument("--downsamples", type=int, nargs="+", default=DOWNSAMPLES)
+    parser.add_argument("--outputs", nargs="+", choices=OUTPUTS, default=OUTPUTS)
+    parser.add_argument("--modes", nargs="+", choices=["inline", "off_axis"], default=["inline", "off_axis"])
+    parser.add_argument("--repeats", type=int, default=5, help="timed repeats of each case")
+    parser.add_argument("--warmup", type=int, default=1, help="untimed repeats of each case")
+    parser.add_argument("--examples", default="examples", help="folder of example holograms")
+    parser.add_argument("--no-examples", action="store_true", help="only use synthetic holograms")
+    parser.add_argument("--compare", default=None, help="previous results file to check for regressions")
+    parser.add_argument("--threshold", type=float, default=0.1, help="fractional slow-down counted as a regression")
+    args = parser.parse_args(argv)
+
+    # Holograms are created once for each source and size
+    sources = []
+    if not args.no_examples:
+        for name, mode, hologram, background in load_examples(args.examples):
+            if mode in args.modes:
+                sources.append((name, mode, hologram, background))
+    for size in args.sizes:
+        if "inline" in args.modes:
+            sources.append((f"synthetic_{size}", "inline") + synthetic_inline(size))
+        if "off_axis" in args.modes:
+            sources.append((f"synthetic_{size}", "off_axis") + synthetic_off_axis(size))
+
+    results = []
+    for source, mode, hologram, background in sources:
+        for refocus, output, downsample in cases(mode, args.downsamples, args.outputs):
+            name = case_name(source, mode, refocus, output, downsample)
+            try:
+                processor = create_processor(mode, refocus, output, downsample, hologram, background)
+                result = benchmark_case(processor, hologram, args.repeats, args.warmup)
+            except Exception as e:
+                print(f"Failed: {name}: {e}")
+                continue
+            result.update(
+                {
+                    "name": name,
+                    "source": source,
+                    "input_shape": list(np.shape(hologram)),
+                    "mode": mode,
+                    "refocus": refocus,
+                    "output": output,
+                    "downsample": downsample,
+                }
+            )
+            results.append(result)
+            print(f"{name:60s} {1000 * result['median']:9.2f} ms")
+
+    with open(args.output, "w") as f:
+        json.dump({"environment": environment(), "results": results}, f, indent=1)
+    print(f"Wrote {len(results)} results to {args.output}")
+
+    if args.compare is not None:
+        return 1 if compare(results, args.compare, args.threshold) > 0 else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+HoloSnake Track
+
+Command line 3D particle localisation and tracking over recorded hologram
+sequences. Each frame is refocused over a range of depths and in-focus
+particles are found from a local focus metric (see
+processors.particle_tracking). Frames are processed by a pool of worker
+processes and the detections are then linked into tracks, which are written
+as CSV or Parquet. Processing settings are read from a HoloSnake config file
+as for holosnake_batch.
+
+Inputs may be multi-frame recordings (multi-page TIFF or .npy) or
+directories or glob patterns of single holograms, which are taken as
+successive frames in sorted order.
+
+Example:
+    python holosnake_track.py recording.tif -o tracks.csv --depth-min 5000 --depth-max 25000 --planes 41
+
+"""
+
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from processors.holo_processor import HoloProcessor
+from processors.edof import METRICS
+from processors.particle_tracking import ParticleDetector, ParticleTracker, write_tracks, parquet_available
+from cameras.mapped_file_interface import MappedFrames
+from holosnake_batch import read_config, configure_processor, find_files, load_image, config_float
+
+
+# Set in each worker process by init_worker
+workerProcessor = None
+workerDetector = None
+workerFilenames = None
+workerFrames = {}
+
+
+def find_inputs(inputs):
+    """Expands directories and glob patterns, and also accepts .npy files."""
+    files = find_files(inputs)
+    for item in inputs:
+        if os.path.splitext(item)[1].lower() == ".npy" and os.path.exists(item):
+            files.append(item)
+    return sorted(set(files))
+
+
+def frame_jobs(filenames):
+    """Returns a list of (frame number, file index, frame index in file) for
+    every frame of every file.
+    """
+    jobs = []
+    for fileIdx, filename in enumerate(filenames):
+        frames = MappedFrames(filename)
+        for idx in range(len(frames)):
+            jobs.append((len(jobs), fileIdx, idx))
+        frames.close()
+    return jobs
+
+
+def init_worker(processor, detector, filenames):
+    """Pool initialiser, stores the configured processor and detector in the
+    worker so they are only sent to each process once.
+    """
+    global workerProcessor, workerDetector, workerFilenames
+    workerProcessor = processor
+    workerDetector = detector
+    workerFilenames = filenames
+
+
+def get_frame(fileIdx, idx):
+    # Files are opened once per worker and memory-mapped where possible
+    frames = workerFrames.get(fileIdx)
+    if frames is None:
+        frames = MappedFrames(workerFilenames[fileIdx])
+        workerFrames[fileIdx] = frames
+    return np.array(frames.get(idx))
+
+
+def detect_frame(job):
+    """Finds the particles in one frame. Returns a tuple of (frame number,
+    detections, processing time in s, error message or None).
+    """
+    frameNumber, fileIdx, idx = job
+    try:
+        hologram = get_frame(fileIdx, idx)
+        t1 = time.perf_counter()
+        detections = workerDetector.detect(workerProcessor, hologram)
+        return frameNumber, detections, time.perf_counter() - t1, None
+    except Exception as e:
+        return frameNumber, np.zeros((0, 4)), 0, str(e)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Localise and track particles in 3D in hologram sequences.")
+    parser.add_argument("inputs", nargs="+", help="recordings, directories or glob patterns of holograms")
+    parser.add_argument("-o", "--output", default="tracks.csv", help="tracks file, .csv or .parquet")
+    parser.add_argument("-c", "--config", default="config.ini", help="HoloSnake config file")
+    parser.add_argument("-b", "--background", default=None, help="background image file")
+    parser.add_argument("--calibrate-off-axis", action="store_true",
+                        help="find the off-axis modulation from the background, or the first frame if no background")
+    parser.add_argument("--depth-min", type=float, required=True, help="minimum depth (microns)")
+    parser.add_argument("--depth-max", type=float, required=True, help="maximum depth (microns)")
+    parser.add_argument("--planes", type=int, default=21, help="number of depths searched")
+    parser.add_argument("--metric", choices=METRICS, default=METRICS[0], help="focus metric")
+    parser.add_argument("--window", type=int, default=15, help="focus metric window (px)")
+    parser.add_argument("--min-distance", type=int, default=10, help="minimum particle separation (px)")
+    parser.add_argument("--threshold", type=float, default=5, help="detection threshold (robust standard deviations)")
+    parser.add_argument("--max-distance", type=float, default=20, help="maximum lateral movement between frames (microns)")
+    parser.add_argument("--max-depth-change", type=float, default=200, help="maximum change in depth between frames (microns)")
+    parser.add_argument("--max-gap", type=int, default=2, help="frames a particle may be missed for")
+    parser.add_argument("--min-length", type=int, default=3, help="shortest track kept (detections)")
+    parser.add_argument("-w", "--workers", type=int, default=None, help="number of worker processes")
+    parser.add_argument("--chunksize", type=int, default=4, help="frames sent to a worker at once")
+    args = parser.parse_args(argv)
+
+    if os.path.splitext(args.output)[1].lower() == ".parquet" and not parquet_available():
+        print("pandas is required to write Parquet files.")
+        return 1
+
+    filenames = find_inputs(args.inputs)
+    if not filenames:
+        print("No holograms found.")
+        return 1
+    jobs = frame_jobs(filenames)
+    if not jobs:
+        print("No frames found.")
+        return 1
+
+    config = read_config(args.config)
+    background = load_image(args.background) if args.background is not None else None
+
+    processor = HoloProcessor()
+    configure_processor(processor, config, background, "amplitude")
+    if args.calibrate_off_axis:
+        if background is None:
+            frames = MappedFrames(filenames[0])
+            background = np.array(frames.get(0))
+            frames.close()
+        processor.holo.calib_off_axis(background)
+
+    detector = ParticleDetector(
+        np.linspace(args.depth_min, args.depth_max, max(args.planes, 1)) / 10**6,
+        windowSize=args.window,
+        metric=args.metric,
+        minDistance=args.min_distance,
+        threshold=args.threshold,
+    )
+    tracker = ParticleTracker(
+        maxDistance=args.max_distance,
+        maxDepthChange=args.max_depth_change,
+        maxGap=args.max_gap,
+        pixelSize=config_float(config, "holoPixelSizeInput", 1) or 1,
+        minLength=args.min_length,
+    )
+
+    numWorkers = args.workers or os.cpu_count() or 1
+    numDetections = 0
+    failed = []
+    times = []
+
+    t1 = time.perf_counter()
+    with ProcessPoolExecutor(
+        max_workers=numWorkers,
+        initializer=init_worker,
+        initargs=(processor, detector, filenames),
+    ) as pool:
+        # Results arrive in frame order, so are linked as they arrive
+        for frameNumber, detections, elapsed, error in pool.map(
+            detect_frame, jobs, chunksize=max(args.chunksize, 1)
+        ):
+            if error is not None:
+                failed.append((frameNumber, error))
+                continue
+            tracker.update(frameNumber, detections)
+            numDetections += len(detections)
+            times.append(elapsed)
+    wallTime = time.perf_counter() - t1
+
+    tracks = tracker.tracks()
+    write_tracks(tracks, args.output)
+
+    for frameNumber, error in failed:
+        print(f"Failed: frame {frameNumber}: {error}")
+    numTracks = len(np.unique(tracks[:, 0])) if len(tracks) else 0
+    print(
+        f"Processed {len(times)} frames ({len(failed)} failed) in {wallTime:.2f} s "
+        f"using {numWorkers} workers, {len(times) / wallTime:.2f} frames/s"
+    )
+    print(f"Found {numDetections} detections, wrote {numTracks} tracks to {args.output}")
+
+    return 0 if not failed else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Adaptive downsampling to hold a target frame rate.
+
+The processor measures the time taken by each frame and the controller
+raises the downsample factor when frames are slower than the target and
+lowers it when they would still be faster than the target at the smaller
+factor. Processing time is taken to scale with the number of pixels, i.e.
+with 1 / factor^2, and a change is only made when the smoothed frame time
+is outside the target by more than the hysteresis, and a few frames after
+the previous change, so that the factor does not oscillate.
+
+"""
+
+import numpy as np
+
+
+class DownsampleController:
+    """Chooses the downsample factor from measured frame times.
+
+    Arguments:
+        targetTime  : float
+                      target processing time per frame in seconds
+
+    Keyword Arguments:
+        minFactor   : int
+                      smallest factor used, normally the manual downsample
+                      factor (default 1)
+        maxFactor   : int
+                      largest factor used (default 8)
+        hysteresis  : float
+                      fraction the frame time must be above the target
+                      before the factor is raised, or predicted to be below
+                      the target before it is lowered (default 0.2)
+        settleFrames : int
+                      frames measured after a change before another change
+                      (default 5)
+        smoothing   : float
+                      weight of each new frame time in the smoothed frame
+                      time (default 0.3)
+    """
+
+    def __init__(self, targetTime, minFactor=1, maxFactor=8, hysteresis=0.2, settleFrames=5, smoothing=0.3):
+        self.targetTime = float(targetTime)
+        self.minFactor = max(int(minFactor), 1)
+        self.maxFactor = max(int(maxFactor), self.minFactor)
+        self.hysteresis = hysteresis
+        self.settleFrames = settleFrames
+        self.smoothing = smoothing
+        self.factor = self.minFactor
+        self.reset()
+
+    def reset(self):
+        self.frameTime = None
+        self.framesSinceChange = 0
+
+    def set_min_factor(self, minFactor):
+        """Sets the smallest factor, e.g. when the manual factor changes."""
+        self.minFactor = max(int(minFactor), 1)
+        self.maxFactor = max(self.maxFactor, self.minFactor)
+        self.factor = int(np.clip(self.factor, self.minFactor, self.maxFactor))
+        self.reset()
+
+    def update(self, frameTime):
+        """Adds the time taken by a frame processed at the current factor.
+        Returns True if the factor has changed.
+        """
+        if self.frameTime is None:
+            self.frameTime = frameTime
+        else:
+            self.frameTime += self.smoothing * (frameTime - self.frameTime)
+        self.framesSinceChange += 1
+        if self.framesSinceChange < self.settleFrames:
+            return False
+
+        factor = self.factor
+        if self.frameTime > self.targetTime * (1 + self.hysteresis) and factor < self.maxFactor:
+            newFactor = factor + 1
+        elif factor > self.minFactor and (
+            self.frameTime * (factor / (factor - 1)) ** 2 < self.targetTime * (1 - self.hysteresis)
+        ):
+            newFactor = factor - 1
+        else:
+            return False
+
+        # Predicted time at the new factor, until it is measured
+        self.frameTime *= (factor / newFactor) ** 2
+        self.factor = newFactor
+        self.framesSinceChange = 0
+        return True
@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+"""
+Interruptible auto focus search.
+
+The search is split into a coarse scan over the whole depth range followed
+by a golden-section search around the best coarse depth. The FFT of the
+field is computed once and re-used for every trial depth. Progress and the
+best depth found so far are reported through a callback after every trial
+depth, and the search can be cancelled from another thread.
+
+The coarse scan is split into batches of depths which are evaluated on a
+thread pool. Each batch is refocused with a single batched inverse FFT and
+scored with a vectorised focus metric. The FFTs and most NumPy operations
+release the GIL, so this scales with the number of cores without needing
+to copy the hologram FFT to other processes.
+
+"""
+
+import math
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import scipy.fft
+
+import pyholoscope as pyh
+
+from processors.propagator_cache import angular_spectrum_propagator
+
+
+GOLDEN = (math.sqrt(5) - 1) / 2
+
+
+def batch_focus_scores(stack, method):
+    """Returns the focus scores for each image in stack, a 3D array of
+    amplitude images (depth, y, x), as a 1D array. The built-in PyHoloscope
+    metrics that are simple to vectorise are calculated for the whole stack
+    at once, giving the same values as pyholoscope.focus_score. Any other
+    method is scored image by image. Lower is better.
+    """
+    name = method.lower() if isinstance(method, str) else None
+
+    if name == "brenner":
+        diffY = np.zeros(np.shape(stack), dtype=stack.dtype)
+        diffX = np.zeros(np.shape(stack), dtype=stack.dtype)
+        diffY[:, :-2, :] = stack[:, 2:, :] - stack[:, :-2, :]
+        diffX[:, :, :-2] = stack[:, :, 2:] - stack[:, :, :-2]
+        np.square(diffY, out=diffY)
+        np.square(diffX, out=diffX)
+        return -np.mean(np.maximum(diffY, diffX, out=diffY), axis=(1, 2))
+    elif name == "peak":
+        return -np.max(stack, axis=(1, 2))
+    elif name == "sum":
+        return np.sum(stack, axis=(1, 2))
+    elif name == "norm_var":
+        mean = np.mean(stack, axis=(1, 2))
+        return -np.sum((stack - mean[:, None, None]) ** 2, axis=(1, 2)) / mean
+    else:
+        return np.array([pyh.focus_score(img, method) for img in stack])
+
+
+class FocusSearch:
+    """Finds the depth which optimises a focus metric for a field.
+
+    Arguments:
+        field       : ndarray
+                      2D pre-propagation field (preprocessed or demodulated)
+        wavelength  : float
+        pixelSize   : float or tuple of (float, float)
+                      effective (y, x) pixel size of field
+        depthRange  : tuple of (float, float)
+                      min and max depths to search
+
+    Keyword Arguments:
+        numCoarse   : int
+                      number of intervals in the coarse search (default 10)
+        roi         : pyholoscope.Roi or None
+                      region of the field to score, default is whole field
+        margin      : int or None
+                      if specified with roi, only the roi plus this margin is
+                      refocused, which is faster
+        method      : str
+                      focus metric passed to pyholoscope.focus_score, lower
+                      is better (default 'Brenner')
+        tolerance   : float or None
+                      depth tolerance of fine search, default is 1% of the
+                      coarse step
+        maxFineIterations : int
+                      maximum number of golden-section iterations
+        numWorkers  : int or None
+                      number of threads for the coarse search, default is
+                      the number of CPUs
+        maxBatchMemory : int
+                      approximate memory limit in bytes of each batch of
+                      refocused images in the coarse search
+    """
+
+    def __init__(self, field, wavelength, pixelSize, depthRange, **kwargs):
+        self.wavelength = wavelength
+        self.pixelSize = pixelSize
+        self.depthRange = (min(depthRange), max(depthRange))
+        self.numCoarse = max(int(kwargs.get("numCoarse", 10)), 2)
+        self.method = kwargs.get("method", "Brenner")
+        self.maxFineIterations = kwargs.get("maxFineIterations", 20)
+        self.numWorkers = kwargs.get("numWorkers", None) or os.cpu_count() or 1
+        self.maxBatchMemory = kwargs.get("maxBatchMemory", 256 * 1024**2)
+        self.coarseStep = (self.depthRange[1] - self.depthRange[0]) / self.numCoarse
+        self.tolerance = kwargs.get("tolerance", None)
+        if self.tolerance is None:
+            self.tolerance = self.coarseStep / 100
+
+        roi = kwargs.get("roi", None)
+        margin = kwargs.get("margin", None)
+        self.refocusRoi, self.scoreRoi = self.score_regions(np.shape(field), roi, margin)
+        if self.refocusRoi is not None:
+            field = self.refocusRoi.crop(field)
+        self.field = field
+        self.fieldFFT = None
+
+        self.cancelEvent = threading.Event()
+        self.resultLock = threading.Lock()
+        self.bestDepth = None
+        self.bestScore = None
+        self.numEvaluated = 0
+
+    @staticmethod
+    def score_regions(fieldShape, roi, margin):
+        """Returns a tuple of (region to refocus, region to score within the
+        refocused region). Either may be None meaning the whole image.
+        """
+        if roi is None:
+            return None, None
+        height, width = fieldShape
+        if margin is None:
+            scoreRoi = pyh.Roi(roi.x, roi.y, roi.width, roi.height)
+            scoreRoi.constrain(0, 0, width, height)
+            return None, scoreRoi
+
+        margin = int(margin)
+        refocusRoi = pyh.Roi(
+            roi.x - margin, roi.y - margin, roi.width + 2 * margin, roi.height + 2 * margin
+        )
+        refocusRoi.constrain(0, 0, width, height)
+        scoreRoi = pyh.Roi(
+            roi.x - refocusRoi.x, roi.y - refocusRoi.y, roi.width, roi.height
+        )
+        scoreRoi.constrain(0, 0, refocusRoi.width, refocusRoi.height)
+        return refocusRoi, scoreRoi
+
+    def cancel(self):
+        self.cancelEvent.set()
+
+    def is_cancelled(self):
+        return self.cancelEvent.is_set()
+
+    def score(self, depth):
+        """Refocuses to depth and returns the focus score (lower is better)."""
+        prop = angular_spectrum_propagator(
+            np.shape(self.fieldFFT), self.wavelength, self.pixelSize, depth
+        )
+        amp = np.abs(scipy.fft.ifft2(self.fieldFFT * prop))
+        if self.scoreRoi is not None:
+            amp = self.scoreRoi.crop(amp)
+        return pyh.focus_score(amp, self.method)
+
+    def score_batch(self, depths):
+        """Refocuses to each of depths in one batch and returns an array of
+        focus scores.
+        """
+        props = np.stack(
+            [
+                angular_spectrum_propagator(
+                    np.shape(self.fieldFFT), self.wavelength, self.pixelSize, depth
+                )
+                for depth in depths
+            ]
+        )
+        props *= self.fieldFFT
+        amp = np.abs(scipy.fft.ifft2(props, axes=(-2, -1), overwrite_x=True))
+        if self.scoreRoi is not None:
+            amp = amp[
+                :,
+                self.scoreRoi.y : self.scoreRoi.y + self.scoreRoi.height,
+                self.scoreRoi.x : self.scoreRoi.x + self.scoreRoi.width,
+            ]
+        return batch_focus_scores(amp, self.method)
+
+    def record(self, depth, score):
+        with self.resultLock:
+            self.numEvaluated += 1
+            if self.bestScore is None or score < self.bestScore:
+                self.bestScore = score
+                self.bestDepth = depth
+
+    def evaluate(self, depth):
+        score = self.score(depth)
+        self.record(depth, score)
+        return score
+
+    def coarse_batches(self):
+        """Splits the coarse depths into batches, at least one per worker
+        and each within the batch memory limit.
+        """
+        depths = self.coarse_depths()
+        planeBytes = 16 * np.prod(np.shape(self.fieldFFT))
+        maxBatch = max(int(self.maxBatchMemory // planeBytes), 1)
+        batchSize = min(math.ceil(len(depths) / self.numWorkers), maxBatch)
+        return [depths[idx : idx + batchSize] for idx in range(0, len(depths), batchSize)]
+
+    def coarse_search(self, report):
+        """Evaluates the coarse depths in batches on a thread pool."""
+
+        def run_batch(depths):
+            if self.is_cancelled():
+                return
+            for depth, score in zip(depths, self.score_batch(depths)):
+                self.record(depth, score)
+            report()
+
+        batches = self.coarse_batches()
+        if self.numWorkers == 1 or len(batches) == 1:
+            for batch in batches:
+                run_batch(batch)
+        else:
+            with ThreadPoolExecutor(max_workers=min(self.numWorkers, len(batches))) as pool:
+                for result in pool.map(run_batch, batches):
+                    pass
+
+    def coarse_depths(self):
+        return np.linspace(self.depthRange[0], self.depthRange[1], self.numCoarse + 1)
+
+    def expected_evaluations(self):
+        """Approximate total number of trial depths, used to report progress."""
+        fineIterations = math.ceil(
+            math.log(max(self.tolerance, 1e-30) / max(2 * self.coarseStep, 1e-30))
+            / math.log(GOLDEN)
+        )
+        fineIterations = min(max(fineIterations, 0), self.maxFineIterations)
+        return self.numCoarse + 1 + fineIterations + 2
+
+    def run(self, progress=None):
+        """Runs the search and returns the best depth, or None if cancelled
+        before any depth was evaluated. If progress is provided it is called
+        as progress(fraction, bestDepth) after each trial depth.
+        """
+        self.fieldFFT = scipy.fft.fft2(self.field)
+        total = self.expected_evaluations()
+
+        def report():
+            if progress is not None:
+                progress(min(self.numEvaluated / total, 1.0), self.bestDepth)
+
+        # Coarse search
+        self.coarse_search(report)
+        if self.is_cancelled():
+            return self.bestDepth
+
+        # Golden-section search either side of the best coarse depth
+        low = max(self.bestDepth - self.coarseStep, self.depthRange[0])
+        high = min(self.bestDepth + self.coarseStep, self.depthRange[1])
+        depth1 = high - GOLDEN * (high - low)
+        depth2 = low + GOLDEN * (high - low)
+        score1 = self.evaluate(depth1)
+        report()
+        score2 = self.evaluate(depth2)
+        report()
+
+        iteration = 0
+        while high - low > self.tolerance and iteration < self.maxFineIterations:
+            if self.is_cancelled():
+                return self.bestDepth
+            if score1 < score2:
+                high, depth2, score2 = depth2, depth1, score1
+                depth1 = high - GOLDEN * (high - low)
+                score1 = self.evaluate(depth1)
+            else:
+                low, depth1, score1 = depth1, depth2, score2
+                depth2 = low + GOLDEN * (high - low)
+                score2 = self.evaluate(depth2)
+            iteration += 1
+            report()
+
+        if progress is not None:
+            progress(1.0, self.bestDepth)
+
+        return self.bestDepth
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+Builds a background hologram from live frames.
+
+The last numFrames frames are kept in a preallocated ring buffer. A running
+sum is updated as each frame is added, replacing the oldest, so the mean is
+available at a cost per frame that does not depend on numFrames. The median,
+which is more robust to objects passing through the field, is calculated
+from the ring buffer when a new background is requested. New backgrounds are
+calculated (and optionally saved) on a background thread and collected with
+take(), so that acquisition and display are not held up.
+
+"""
+
+import os
+import threading
+import time
+
+import numpy as np
+from PIL import Image
+
+
+class BackgroundBuilder:
+    """Rolling mean or median background over the most recent frames.
+
+    Keyword Arguments:
+        numFrames  : int
+                     number of frames averaged (default 32)
+        method     : str
+                     MEAN or MEDIAN (default MEAN)
+    """
+
+    MEAN = "Mean"
+    MEDIAN = "Median"
+    METHODS = [MEAN, MEDIAN]
+
+    numFrames = 32
+    method = MEAN
+
+    def __init__(self, numFrames=32, method=MEAN):
+        self.numFrames = max(int(numFrames), 1)
+        self.method = method
+        self.lock = threading.Lock()
+        self.thread = None
+        self.latest = None
+        self.lastUpdate = 0
+        self.reset()
+
+    def reset(self):
+        """Discards all frames."""
+        with self.lock:
+            self.ring = None
+            self.sum = None
+            self.count = 0
+
+    def set_num_frames(self, numFrames):
+        numFrames = max(int(numFrames), 1)
+        if numFrames != self.numFrames:
+            self.numFrames = numFrames
+            self.reset()
+
+    def num_frames(self):
+        """Returns the number of frames currently in the average."""
+        return min(self.count, self.numFrames)
+
+    def add(self, frame):
+        """Adds frame, replacing the oldest frame once numFrames have been
+        added. Frames of a different shape restart the average.
+        """
+        with self.lock:
+            if self.ring is None or self.ring.shape[1:] != np.shape(frame):
+                self.ring = np.zeros((self.numFrames,) + np.shape(frame), dtype="float32")
+                self.sum = np.zeros(np.shape(frame), dtype="float64")
+                self.count = 0
+
+            idx = self.count % self.numFrames
+            if self.count >= self.numFrames:
+                self.sum -= self.ring[idx]
+            self.ring[idx] = frame
+            self.sum += self.ring[idx]
+            self.count += 1
+
+            # Recalculate the sum once per cycle of the ring so that rounding
+            # errors do not build up
+            if self.count % self.numFrames == 0:
+                np.sum(self.ring, axis=0, dtype="float64", out=self.sum)
+
+    def background(self):
+        """Returns the current background as a float32 array, or None if no
+        frames have been added.
+        """
+        with self.lock:
+            num = self.num_frames()
+            if num == 0:
+                return None
+            if self.method == self.MEDIAN:
+                frames = self.ring[:num].copy()
+            else:
+                return (self.sum / num).astype("float32")
+        return np.median(frames, axis=0).astype("float32")
+
+    def busy(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start_update(self, filename=None):
+        """Starts calculating a new background on a background thread,
+        saving it to filename if given. Returns False if an update is
+        already running or there are no frames.
+        """
+        if self.busy() or self.num_frames() == 0:
+            return False
+        self.lastUpdate = time.perf_counter()
+        self.thread = threading.Thread(target=self.update, args=(filename,), daemon=True)
+        self.thread.start()
+        return True
+
+    def update(self, filename=None):
+        background = self.background()
+        if background is None:
+            return
+        if filename is not None:
+            save_background(background, filename)
+        with self.lock:
+            self.latest = background
+
+    def due(self, interval):
+        """Returns True if interval seconds have passed since the last update."""
+        return time.perf_counter() - self.lastUpdate >= interval
+
+    def take(self):
+        """Returns the newest background and forgets it, or None if there is
+        no new background since the last call.
+        """
+        with self.lock:
+            background = self.latest
+            self.latest = None
+        return background
+
+
+def save_background(background, filename):
+    """Saves background as a 32 bit float tif. This is written to a temporary
+    file first so that an existing background is never left half written.
+    """
+    folder = os.path.dirname(filename)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    tempFilename = filename + ".tmp"
+    Image.fromarray(np.asarray(background, dtype="float32")).save(tempFilename, format="TIFF")
+    os.replace(tempFilename, filename)
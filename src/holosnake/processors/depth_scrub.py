@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+Precomputed depth stack used for fast focus scrubbing of a single hologram.
+
+The stack of refocused complex fields is built on a background thread from
+the FFT of the pre-propagation field. Planes are computed in coarse-to-fine
+order (ends of the range first, then repeated bisection) so that a usable,
+if coarse, stack is available almost immediately and then fills in.
+
+"""
+
+import threading
+from collections import deque
+
+import numpy as np
+import scipy.fft
+
+from processors.propagator_cache import angular_spectrum_propagator
+
+
+def coarse_to_fine_order(numPlanes):
+    """Returns the plane indices 0 to numPlanes - 1 ordered so that the ends
+    of the range come first, followed by successive bisections.
+    """
+    if numPlanes <= 0:
+        return []
+    if numPlanes == 1:
+        return [0]
+
+    order = [0, numPlanes - 1]
+    intervals = deque([(0, numPlanes - 1)])
+    while intervals:
+        lo, hi = intervals.popleft()
+        if hi - lo < 2:
+            continue
+        mid = (lo + hi) // 2
+        order.append(mid)
+        intervals.append((lo, mid))
+        intervals.append((mid, hi))
+
+    return order
+
+
+class DepthScrubStack:
+    """Stack of refocused fields for one hologram over a range of depths.
+
+    Arguments:
+        fieldFFT   : ndarray
+                     2D complex array, FFT of the pre-propagation field
+        depthRange : tuple of (float, float)
+                     min and max depths of the stack
+        numPlanes  : int
+                     number of equally spaced planes
+        wavelength : float
+        pixelSize  : float or tuple of (float, float)
+                     effective (y, x) pixel size of the field
+        key        : any
+                     identifies the hologram and settings the stack was
+                     built for
+    """
+
+    def __init__(self, fieldFFT, depthRange, numPlanes, wavelength, pixelSize, key=None):
+        self.fieldFFT = fieldFFT
+        self.depthRange = (float(depthRange[0]), float(depthRange[1]))
+        self.numPlanes = max(int(numPlanes), 1)
+        self.wavelength = wavelength
+        self.pixelSize = pixelSize
+        self.key = key
+        self.depths = np.linspace(self.depthRange[0], self.depthRange[1], self.numPlanes)
+        self.planes = np.zeros(
+            (self.numPlanes,) + np.shape(fieldFFT), dtype="complex64"
+        )
+        self.filled = np.zeros(self.numPlanes, dtype=bool)
+        self.numFilled = 0
+        self.cancelEvent = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """Starts building the stack on a background thread."""
+        self.thread = threading.Thread(target=self.build, daemon=True)
+        self.thread.start()
+
+    def build(self):
+        """Computes each plane in coarse-to-fine order. Stops early if
+        cancel() is called.
+        """
+        for idx in coarse_to_fine_order(self.numPlanes):
+            if self.cancelEvent.is_set():
+                return
+            prop = angular_spectrum_propagator(
+                np.shape(self.fieldFFT),
+                self.wavelength,
+                self.pixelSize,
+                self.depths[idx],
+            )
+            self.planes[idx] = scipy.fft.ifft2(self.fieldFFT * prop)
+            self.filled[idx] = True
+            self.numFilled += 1
+
+        # The FFT is no longer needed once every plane exists
+        self.fieldFFT = None
+
+    def cancel(self):
+        self.cancelEvent.set()
+
+    def is_complete(self):
+        return self.numFilled >= self.numPlanes
+
+    def progress(self):
+        """Returns the fraction of planes computed so far."""
+        return self.numFilled / self.numPlanes
+
+    def get(self, depth, interpolate=False):
+        """Returns the refocused field for depth from the stack, or None if
+        depth is outside the stack or no planes are ready yet. If the planes
+        either side of depth are ready and interpolate is True, the fields
+        are linearly interpolated, otherwise the nearest ready plane is
+        returned.
+        """
+        minDepth, maxDepth = self.depthRange
+        if self.numFilled == 0 or depth < min(minDepth, maxDepth) or depth > max(minDepth, maxDepth):
+            return None
+
+        if self.numPlanes == 1 or maxDepth == minDepth:
+            return self.planes[0]
+
+        pos = (depth - minDepth) / (maxDepth - minDepth) * (self.numPlanes - 1)
+        lower = int(np.floor(pos))
+        upper = min(lower + 1, self.numPlanes - 1)
+
+        if interpolate and self.filled[lower] and self.filled[upper] and upper != lower:
+            frac = pos - lower
+            return (1 - frac) * self.planes[lower] + frac * self.planes[upper]
+
+        ready = np.flatnonzero(self.filled)
+        nearest = ready[np.argmin(np.abs(ready - pos))]
+        return self.planes[nearest]
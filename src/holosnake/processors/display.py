@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+Conversion of processed images for display.
+
+On large sensors, scaling a full resolution float image to 8 bits on the GUI
+thread costs a noticeable fraction of the frame time, and most of those
+pixels are then thrown away when the image is scaled to fit the display.
+The processor can instead decimate its output to about the display size and
+map it to 8 bits itself, so that only a small 8 bit image is passed to the
+GUI, which then only needs to apply its colour table.
+
+Contrast is set either by a fixed range (e.g. 0 to 2 pi for wrapped phase)
+or by percentiles of a regular subsample of the image.
+
+"""
+
+import numpy as np
+
+
+def decimation_factor(shape, displaySize):
+    """Returns the largest integer factor that an image of shape can be
+    decimated by and still be at least displaySize (height, width) along
+    one dimension, so that it is never enlarged for display.
+    """
+    if displaySize is None or min(displaySize) <= 0:
+        return 1
+    return max(int(min(shape[0] / displaySize[0], shape[1] / displaySize[1])), 1)
+
+
+def decimate(image, factor):
+    """Returns every factor-th pixel of image along each dimension."""
+    if factor <= 1:
+        return image
+    return image[::factor, ::factor]
+
+
+def resample(image, shape):
+    """Returns image resampled to shape by nearest neighbour."""
+    if tuple(np.shape(image)[:2]) == tuple(shape):
+        return image
+    rows = np.arange(shape[0]) * np.shape(image)[0] // shape[0]
+    cols = np.arange(shape[1]) * np.shape(image)[1] // shape[1]
+    return image[rows[:, np.newaxis], cols]
+
+
+def percentile_range(image, percentiles=(1, 99), maxSamples=65536):
+    """Returns (low, high) percentiles of image, estimated from a regular
+    subsample of at most maxSamples pixels. Non-finite values are ignored.
+    """
+    step = max(int(np.ceil(np.sqrt(np.size(image) / maxSamples))), 1)
+    sample = image[::step, ::step]
+    sample = sample[np.isfinite(sample)]
+    if np.size(sample) == 0:
+        return 0.0, 1.0
+    low, high = np.percentile(sample, percentiles)
+    return float(low), float(high)
+
+
+class DisplayConverter:
+    """Decimates images and maps them to 8 bits for display.
+
+    Keyword Arguments:
+        factor       : int
+                       decimation factor (default 1)
+        displayRange : tuple of (float, float) or None
+                       values mapped to 0 and 255, or None to use
+                       percentiles (default None)
+        percentiles  : tuple of (float, float)
+                       percentiles mapped to 0 and 255 when there is no fixed
+                       range (default (1, 99))
+    """
+
+    def __init__(self, factor=1, displayRange=None, percentiles=(1, 99)):
+        self.factor = max(int(factor), 1)
+        self.displayRange = displayRange
+        self.percentiles = percentiles
+
+    def convert(self, image, fullShape=None):
+        """Returns image decimated and mapped to uint8. Complex images are
+        shown as their amplitude. If image has been downsampled, fullShape is
+        its shape before downsampling, and the output is the same as for an
+        image of fullShape.
+        """
+        if fullShape is not None and tuple(fullShape) != np.shape(image)[:2]:
+            small = resample(image, [-(-size // self.factor) for size in fullShape])
+        else:
+            small = decimate(image, self.factor)
+        if np.iscomplexobj(small):
+            small = np.abs(small)
+        if self.displayRange is not None:
+            low, high = self.displayRange
+        else:
+            low, high = percentile_range(small, self.percentiles)
+        scale = 255 / (high - low) if high > low else 0
+
+        scaled = np.subtract(small, low, dtype="float32")
+        scaled *= scale
+        np.clip(scaled, 0, 255, out=scaled)
+        np.nan_to_num(scaled, copy=False)
+        return scaled.astype("uint8")
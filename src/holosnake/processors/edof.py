@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""
+Extended depth of field (all-in-focus) compositing.
+
+A hologram is refocused to a series of depths and, for each pixel, the
+refocused field from the depth where the image is locally sharpest is kept.
+The depth chosen for each pixel is kept as a depth map. Planes are processed
+in small batches and merged into a running composite, so memory depends only
+on the image size and batch size, not on the number of depths.
+
+The local focus metric is computed for a whole batch at once, either for
+each pixel (averaged over a sliding window) or for each tile of a grid,
+which is cheaper and less noisy but gives a blocky depth map.
+
+"""
+
+import copy
+import os
+import threading
+
+import numpy as np
+import scipy.fft
+import scipy.ndimage
+
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
+from PIL import Image
+
+
+VARIANCE = "Variance"
+GRADIENT = "Gradient"
+METRICS = [VARIANCE, GRADIENT]
+
+
+def box_mean(stack, size, tiled=False):
+    """Returns the mean of each image in stack, a 3D array (plane, y, x), over
+    size x size neighbourhoods. If tiled is True, the mean is over the tiles
+    of a size x size grid, and each pixel takes the value for its tile.
+    """
+    if size <= 1:
+        return stack
+    if not tiled:
+        return scipy.ndimage.uniform_filter(stack, size=(1, size, size), mode="nearest")
+
+    numPlanes, height, width = np.shape(stack)
+    tilesY = -(-height // size)
+    tilesX = -(-width // size)
+    padded = np.pad(
+        stack,
+        ((0, 0), (0, tilesY * size - height), (0, tilesX * size - width)),
+        mode="edge",
+    )
+    means = padded.reshape(numPlanes, tilesY, size, tilesX, size).mean(axis=(2, 4))
+    return np.repeat(np.repeat(means, size, axis=1), size, axis=2)[:, :height, :width]
+
+
+def local_focus(amplitudes, size=15, metric=VARIANCE, tiled=False):
+    """Returns the local sharpness of each image in amplitudes, a 3D array
+    (plane, y, x). Higher is sharper.
+
+    VARIANCE is the local variance normalised by the local mean, GRADIENT is
+    the local mean of the squared gradient magnitude.
+    """
+    amplitudes = np.asarray(amplitudes, dtype="float32")
+    if metric == GRADIENT:
+        gradY = np.zeros_like(amplitudes)
+        gradX = np.zeros_like(amplitudes)
+        gradY[:, 1:-1, :] = amplitudes[:, 2:, :] - amplitudes[:, :-2, :]
+        gradX[:, :, 1:-1] = amplitudes[:, :, 2:] - amplitudes[:, :, :-2]
+        np.square(gradY, out=gradY)
+        np.square(gradX, out=gradX)
+        gradY += gradX
+        return box_mean(gradY, size, tiled)
+
+    mean = box_mean(amplitudes, size, tiled)
+    meanSquare = box_mean(amplitudes**2, size, tiled)
+    meanSquare -= mean**2
+    return meanSquare / np.maximum(mean, np.finfo("float32").tiny)
+
+
+class FocusCompositor:
+    """Accumulates an all-in-focus composite over batches of refocused
+    fields.
+
+    Keyword Arguments:
+        windowSize : int
+                     size in pixels of the neighbourhood or tile the focus
+                     metric is calculated over (default 15)
+        metric     : str
+                     VARIANCE or GRADIENT (default VARIANCE)
+        tiled      : boolean
+                     if True, the metric is calculated for tiles rather than
+                     for each pixel (default False)
+    """
+
+    def __init__(self, windowSize=15, metric=VARIANCE, tiled=False):
+        self.windowSize = int(windowSize)
+        self.metric = metric
+        self.tiled = tiled
+        self.reset()
+
+    def reset(self):
+        self.field = None
+        self.depthMap = None
+        self.score = None
+
+    def add(self, depths, fields):
+        """Merges a batch of refocused fields, a 3D complex array (plane, y, x),
+        at depths into the composite.
+        """
+        depths = np.asarray(depths, dtype="float32")
+        scores = local_focus(np.abs(fields), self.windowSize, self.metric, self.tiled)
+        best = np.argmax(scores, axis=0)[np.newaxis]
+        bestScore = np.take_along_axis(scores, best, axis=0)[0]
+        bestField = np.take_along_axis(fields, best, axis=0)[0]
+        bestDepth = depths[best[0]]
+
+        if self.score is None or self.score.shape != bestScore.shape:
+            self.score = bestScore
+            self.field = bestField
+            self.depthMap = bestDepth
+        else:
+            better = bestScore > self.score
+            np.copyto(self.score, bestScore, where=better)
+            np.copyto(self.field, bestField, where=better)
+            np.copyto(self.depthMap, bestDepth, where=better)
+
+
+def depth_batches(depths, batchSize):
+    """Yields successive batches of at most batchSize depths."""
+    for idx in range(0, len(depths), batchSize):
+        yield depths[idx : idx + batchSize]
+
+
+def refocused_batches(processor, hologram, depths, batchSize, cache=False):
+    """Generator yielding (depths, refocused fields) for successive batches
+    of depths, using the reconstruction settings of processor (a
+    HoloProcessor) without changing its current depth. If cache is True
+    the propagators are kept in the processor's propagator cache.
+    """
+    if processor.use_propagator_cache():
+        # Pre-propagation field and its FFT only need to be found once
+        field = processor.pre_propagation_field(hologram)
+        fieldFFT = scipy.fft.fft2(field)
+        for batch in depth_batches(depths, batchSize):
+            yield batch, processor.refocus_stack(fieldFFT, np.shape(hologram), batch, cache=cache)
+    else:
+        # Settings the cached path does not support, so use a private
+        # copy of the Holo object to avoid changing the live depth
+        holo = copy.deepcopy(processor.holo)
+        holo.refocus = True
+        for batch in depth_batches(depths, batchSize):
+            fields = []
+            for depth in batch:
+                holo.depth = depth
+                fields.append(holo.process(hologram))
+            yield batch, np.stack(fields)
+
+
+def save_float_image(image, filename):
+    if tifffile is not None:
+        tifffile.imwrite(filename, np.asarray(image, dtype="float32"))
+    else:
+        Image.fromarray(np.asarray(image, dtype="float32")).save(filename)
+
+
+class AllInFocusExport:
+    """Creates an all-in-focus image and depth map of a hologram and saves
+    them as 32 bit tifs. The depth map (in metres) is saved alongside the
+    image with _depth added to the filename.
+
+    Arguments:
+        processor  : HoloProcessor
+                     processor providing the current reconstruction settings,
+                     which is copied so that the export can run on another
+                     thread
+        hologram   : ndarray
+                     raw hologram
+        depthRange : tuple of (float, float)
+                     min and max depths
+        numDepths  : int
+                     number of equally spaced depths
+        filename   : str
+                     filename of the all-in-focus image
+
+    Keyword Arguments:
+        windowSize : int
+                     see FocusCompositor (default 15)
+        metric     : str
+                     see FocusCompositor (default VARIANCE)
+        tiled      : boolean
+                     see FocusCompositor (default False)
+        batchSize  : int
+                     number of depths refocused at once (default 4)
+    """
+
+    def __init__(self, processor, hologram, depthRange, numDepths, filename, **kwargs):
+        # A private copy, as refocusing changes the state of the processor
+        # and its Holo, which are also used on the GUI thread
+        self.processor = copy.deepcopy(processor)
+        self.hologram = hologram.astype("float32")
+        self.depths = np.linspace(depthRange[0], depthRange[1], max(int(numDepths), 1))
+        self.filename = filename
+        self.batchSize = max(int(kwargs.get("batchSize", 4)), 1)
+        self.compositor = FocusCompositor(
+            windowSize=kwargs.get("windowSize", 15),
+            metric=kwargs.get("metric", VARIANCE),
+            tiled=kwargs.get("tiled", False),
+        )
+        self.cancelEvent = threading.Event()
+
+    def cancel(self):
+        self.cancelEvent.set()
+
+    def is_cancelled(self):
+        return self.cancelEvent.is_set()
+
+    def batches(self):
+        """Generator yielding (depths, refocused fields) for each batch."""
+        return refocused_batches(self.processor, self.hologram, self.depths, self.batchSize)
+
+    def run(self, progress=None):
+        """Creates and saves the image and depth map, returning True if
+        complete or False if cancelled. If progress is provided it is called
+        as progress(fraction) after each batch.
+        """
+        self.compositor.reset()
+        numDone = 0
+        for depths, fields in self.batches():
+            if self.is_cancelled():
+                return False
+            self.compositor.add(depths, fields)
+            numDone += len(depths)
+            if progress is not None:
+                progress(numDone / len(self.depths))
+
+        save_float_image(np.abs(self.compositor.field), self.filename)
+        root, ext = os.path.splitext(self.filename)
+        save_float_image(self.compositor.depthMap, root + "_depth" + (ext or ".tif"))
+        return True
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+Continuous focus tracking for live imaging.
+
+Every few frames a short search is run around the current depth, rather
+than a full auto focus over the whole range, so that a sample drifting in z
+stays in focus. The search uses FocusSearch with only a few coarse steps
+followed by a golden-section search, on the ROI (if any) of a field
+downsampled in the Fourier domain. Finding the field and the search both
+run on a background thread, from a copy of the hologram and of the
+reconstruction settings, so the GUI thread is not held up. New depths are
+collected with take(), and the depth shown is moved towards the new depth
+a fraction at a time by step() so that it does not jump.
+
+"""
+
+import copy
+import threading
+
+import numpy as np
+import scipy.fft
+
+from processors.auto_focus import FocusSearch
+from processors.multi_plane import crop_spectrum
+
+
+def downsample_field(field, maxSize):
+    """Returns (field, scale) where field is downsampled by cropping its
+    spectrum so that neither dimension is larger than maxSize, and scale is
+    the factor the pixel size is increased by along (y, x).
+    """
+    shape = tuple(min(size, int(maxSize) // 2 * 2) for size in np.shape(field))
+    if shape == tuple(np.shape(field)):
+        return field, (1, 1)
+    small = scipy.fft.ifft2(crop_spectrum(scipy.fft.fft2(field), shape))
+    scale = (np.shape(field)[0] / shape[0], np.shape(field)[1] / shape[1])
+    return small, scale
+
+
+class FocusTracker:
+    """Re-estimates the focus depth on a background thread every interval
+    frames, searching within searchRange either side of the current depth.
+
+    Keyword Arguments:
+        interval    : int
+                      number of frames between searches (default 10)
+        searchRange : float
+                      depth either side of the current depth to search, in
+                      metres (default 50e-6)
+        maxSize     : int
+                      field is downsampled to no more than this size along
+                      each dimension (default 256)
+        numCoarse   : int
+                      number of coarse steps over the search range, before
+                      the golden-section search (default 4)
+        smoothing   : float
+                      fraction of the remaining distance to the new depth
+                      moved by each call to step() (default 0.3)
+        method      : str
+                      focus metric, see FocusSearch (default 'Brenner')
+    """
+
+    def __init__(self, interval=10, searchRange=50e-6, maxSize=256, numCoarse=4, smoothing=0.3,
+                 method="Brenner"):
+        self.interval = max(int(interval), 1)
+        self.searchRange = searchRange
+        self.maxSize = maxSize
+        self.numCoarse = numCoarse
+        self.smoothing = smoothing
+        self.method = method
+        self.lock = threading.Lock()
+        self.thread = None
+        self.search = None
+        self.cancelled = None
+        self.latest = None
+        self.target = None
+        self.framesSinceSearch = 0
+
+    def busy(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def reset(self):
+        """Cancels any search in progress and forgets any new depth."""
+        with self.lock:
+            if self.cancelled is not None:
+                self.cancelled.set()
+            if self.search is not None:
+                self.search.cancel()
+            self.latest = None
+        self.target = None
+        self.framesSinceSearch = 0
+
+    def submit(self, processor, hologram, depth, roi=None, margin=None):
+        """Counts a new frame and, if interval frames have passed and the
+        previous search has finished, starts a search around depth for
+        hologram using the reconstruction settings of processor (a
+        HoloProcessor). Only roi plus margin is refocused if roi is given.
+        Returns True if a search was started.
+        """
+        self.framesSinceSearch += 1
+        if self.busy() or self.framesSinceSearch < self.interval:
+            return False
+        self.framesSinceSearch = 0
+
+        # The copy of the processor has its own Holo, as finding the field
+        # changes its state, but shares its images, which are only replaced
+        # and never changed in place
+        snapshot = copy.copy(processor)
+        snapshot.holo = copy.copy(processor.holo)
+        hologram = np.array(hologram, dtype="float32")
+        pixelSize = processor.field_pixel_size(np.shape(hologram))
+        self.cancelled = threading.Event()
+        self.thread = threading.Thread(
+            target=self.run,
+            args=(snapshot, hologram, depth, roi, margin, pixelSize, self.cancelled),
+            daemon=True,
+        )
+        self.thread.start()
+        return True
+
+    @staticmethod
+    def crop(field, roi, margin):
+        """Returns field cropped to roi plus margin, or the whole field if
+        this is too small to score.
+        """
+        margin = int(margin or 0)
+        height, width = np.shape(field)
+        y0 = int(np.clip(roi.y - margin, 0, height))
+        y1 = int(np.clip(roi.y + roi.height + margin, 0, height))
+        x0 = int(np.clip(roi.x - margin, 0, width))
+        x1 = int(np.clip(roi.x + roi.width + margin, 0, width))
+        if y1 - y0 < 8 or x1 - x0 < 8:
+            return field
+        return field[y0:y1, x0:x1]
+
+    def run(self, processor, hologram, depth, roi, margin, pixelSize, cancelled):
+        field = processor.pre_propagation_field(hologram)
+        if field is None or cancelled.is_set():
+            return
+        if roi is not None:
+            field = self.crop(field, roi, margin)
+        field, scale = downsample_field(field, self.maxSize)
+
+        search = FocusSearch(
+            field,
+            processor.holo.wavelength,
+            (pixelSize[0] * scale[0], pixelSize[1] * scale[1]),
+            (depth - self.searchRange, depth + self.searchRange),
+            numCoarse=self.numCoarse,
+            method=self.method,
+            numWorkers=1,
+        )
+        with self.lock:
+            if cancelled.is_set():
+                return
+            self.search = search
+        newDepth = search.run()
+        if newDepth is not None and not search.is_cancelled():
+            with self.lock:
+                self.latest = newDepth
+
+    def take(self):
+        """Returns the depth found by the last search and forgets it, or None
+        if no search has finished since the last call. The depth is also
+        kept as the target for step().
+        """
+        with self.lock:
+            depth = self.latest
+            self.latest = None
+        if depth is not None:
+            self.target = depth
+        return depth
+
+    def step(self, depth, tolerance=0.5e-6):
+        """Returns the depth to show next, moving from depth towards the
+        target by a fraction smoothing of the distance, or None if there is
+        no target. The target is cleared once within tolerance.
+        """
+        if self.target is None:
+            return None
+        newDepth = depth + self.smoothing * (self.target - depth)
+        if abs(self.target - newDepth) <= tolerance:
+            newDepth = self.target
+            self.target = None
+        return newDepth
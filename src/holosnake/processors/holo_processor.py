@@ -7,16 +7,49 @@ This is a sub-class of ImageProcessorThread provided with Kent-CAS.
 """
 
 import sys
+import zlib
 import numpy as np
+import scipy.fft
 import time
 
 from cas_gui.threads.image_processor_class import ImageProcessorClass
 
 import pyholoscope as pyh
 
+from processors.propagator_cache import PropagatorCache, angular_spectrum_propagator
+from processors.depth_scrub import DepthScrubStack
+from processors.auto_focus import FocusSearch
+from processors.stage_timer import StageTimer
+from processors.phase_unwrap import PhaseUnwrapper
+from processors.tilt_model import TiltModel, TiltEstimator
+from processors.holo_settings import apply_settings
+from processors.edof import FocusCompositor, depth_batches
+from processors.multi_plane import grid_shape, tile_shape, propagator_stack, refocus_planes, tile_planes
+from processors.display import DisplayConverter, resample
+from processors.adaptive_downsample import DownsampleController
+
 import matplotlib.pyplot as plt
 
 
+def array_fingerprint(arr):
+    """Returns a hashable fingerprint of an array (or None) used to tell
+    whether a background has changed. All pixels are checksummed, as images
+    which differ only in a small region must not share a fingerprint, so
+    this is too slow to use for every frame.
+    """
+    if arr is None:
+        return None
+    arr = np.ascontiguousarray(arr)
+    return (np.shape(arr), arr.dtype.str, zlib.crc32(memoryview(arr).cast("B")))
+
+
+def settings_value(value):
+    """Converts a setting to something that can be compared and hashed."""
+    if value is None or np.isscalar(value):
+        return value
+    return tuple(np.ravel(value).tolist())
+
+
 class HoloProcessor(ImageProcessorClass):
 
     mask = None
@@ -30,65 +63,1112 @@ class HoloProcessor(ImageProcessorClass):
     show_phase = False
     roi = None
     unwrap = False
-    tiltMap = None
+    unwrapROIOnly = False
+    tiltModel = None
+    tiltOrder = 1
+    autoTilt = False
+    autoTiltInterval = 5.0  # seconds
+    tiltEstimator = None
     removeTilt = False
     DIC = False
+    cachePropagators = True
+    propagatorCacheSize = 512  # MB
+    scrubMode = False
+    scrubStack = None
+    scrubDepthRange = (0, 0.001)
+    scrubNumPlanes = 64
+    scrubInterpolate = False
+    scrubMaxMemory = 1024  # MB
+    processEveryN = 1
+    frameCount = 0
+    cacheStages = True
+    fieldKey = None
+    fieldFFT = None
+    lastFrame = None
+    frameToken = 0
+    keyedBackground = None
+    backgroundKey = None
+    keyedNormalise = None
+    normaliseKey = None
+    refocusedKey = None
+    refocused = None
+    singlePrecision = True
+    roiReconstruction = False
+    roiGuardBand = 0  # pixels, 0 to size from the propagation distance
+    canvasKey = None
+    multiPlane = False
+    multiPlaneNum = 3
+    multiPlaneSpacing = 10e-6  # m
+    edof = False
+    edofDepthRange = (0, 0.001)
+    edofNumPlanes = 5
+    edofShowDepth = False
+    edofBatchSize = 4
+    edofCompositor = None
+    displayConverter = None  # if set, outputs are converted for display
+    baseDownsample = 1  # manual downsample factor
+    downsampleController = None  # if set, downsample factor is adaptive
+    reuseBuffers = False
+    buffers = None
+    STAGES = ["field", "propagate", "reconstruct", "amplitude", "phase", "unwrap", "tilt", "dic"]
 
     def __init__(self):
         super().__init__()
         self.holo = pyh.Holo(
             pyh.INLINE, 1, 1, crop_centre=(20, 20), crop_radius=10, relative_phase=True
         )
+        self.propagatorCache = PropagatorCache(self.propagatorCacheSize * 1024**2)
+        self.stageTimer = StageTimer(self.STAGES)
+        self.phaseUnwrapper = PhaseUnwrapper()
 
 
     def process(self, inputFrame):
-        """This is called by parent class whenever a frame needs to be processed."""
+        """This is called by parent class whenever a frame needs to be processed.
+        If display conversion is on, the output is decimated and converted to
+        8 bits for display here rather than on the GUI thread. If downsampling
+        is adaptive, the factor is updated from the time taken, and the output
+        is resampled to the size it has at the manual factor.
+        """
+        if self.downsampleController is None or inputFrame is None:
+            return self.display_output(self.process_hologram(inputFrame))
+
+        factor = self.holo.downsample
+        t1 = time.perf_counter()
+        outputFrame = self.process_hologram(inputFrame)
+        if outputFrame is None:
+            return None
+        if self.downsampleController.update(time.perf_counter() - t1):
+            self.holo.set_downsample(self.downsampleController.factor)
+        return self.display_output(outputFrame, self.base_output_shape(inputFrame, outputFrame, factor))
+
+
+    def refine(self, inputFrame):
+        """Returns the output for inputFrame at the manual downsample
+        factor, whatever the current adaptive factor, e.g. when paused. The
+        frame is always processed, even if frames are being skipped.
+        """
+        factor = self.holo.downsample
+        self.holo.set_downsample(self.baseDownsample)
+        try:
+            outputFrame = self.process_hologram(inputFrame, skipFrames=False)
+        finally:
+            self.holo.set_downsample(factor)
+        return self.display_output(outputFrame)
+
+
+    def display_output(self, outputFrame, fullShape=None):
+        """Returns outputFrame converted for display if this is on, and
+        resampled to fullShape, the shape it would have at the manual
+        downsample factor, if given.
+        """
+        if outputFrame is None:
+            return None
+        if self.displayConverter is not None:
+            return self.displayConverter.convert(outputFrame, fullShape)
+        if fullShape is not None:
+            return resample(outputFrame, fullShape)
+        return outputFrame
+
+
+    def base_output_shape(self, inputFrame, outputFrame, factor):
+        """Returns the shape outputFrame, processed at downsample factor,
+        would have at the manual downsample factor, or None if this is its
+        shape or it is not a downsampled field (e.g. the FFT or tiled planes).
+        """
+        if factor == self.baseDownsample:
+            return None
+        if self.holo.mode == pyh.OFF_AXIS:
+            sourceShape = tuple(2 * size for size in pyh.dimensions(self.holo.crop_radius))
+        else:
+            sourceShape = np.shape(inputFrame)
+        if np.shape(outputFrame)[:2] != self.full_field_shape(sourceShape, factor):
+            return None
+        return self.full_field_shape(sourceShape, self.baseDownsample)
+
+
+    def process_hologram(self, inputFrame, skipFrames=True):
+        """Returns the processed output for inputFrame at full resolution.
+        If skipFrames is False the frame is processed even if only every Nth
+        frame is being processed.
+        """
         self.preProcessFrame = inputFrame
 
         if inputFrame is None:
             return None
 
+        # When processing live frames we may only want to process every Nth
+        # frame, returning None means nothing is sent for display
+        if skipFrames and self.processEveryN > 1:
+            self.frameCount += 1
+            if self.frameCount % self.processEveryN != 0:
+                return None
+
         # If we are in inline mode and refocus is false we need to hack this
         # to return the input images as PyHoloscope has no option to do
         # inline holography without refocusing
         if self.holo.mode == pyh.INLINE and not self.refocus:
             return inputFrame
 
-        outputFrame = self.holo.process(inputFrame)
+        timer = self.stageTimer
+        timer.start_frame()
+
+        outputFrame = None
+        roi = self.reconstruction_roi()
+        if self.refocus and self.use_propagator_cache():
+            if self.edof:
+                return self.process_edof(inputFrame)
+            if self.multiPlane:
+                return self.process_multi_plane(inputFrame)
+            if self.scrubMode:
+                outputFrame = self.scrub_field(inputFrame)
+                timer.mark("propagate")
+            elif roi is not None:
+                return self.process_roi(inputFrame, roi)
+            if outputFrame is None:
+                outputFrame = self.refocus_with_cache(inputFrame)
+        else:
+            outputFrame = self.holo.process(inputFrame)
+            timer.mark("reconstruct")
 
         if outputFrame is not None:
-            if self.showPhase is False:
-                outputFrame = pyh.amplitude(outputFrame)
-                if self.invert is True:
-                    outputFrame = np.max(outputFrame) - outputFrame
+            if self.singlePrecision:
+                outputFrame = self.post_process_single(outputFrame)
             else:
-                outputFrame = pyh.phase(outputFrame)
-                if self.unwrap:
-                    outputFrame = pyh.phase_unwrap(outputFrame)
-                if self.removeTilt and self.tiltMap is not None:
-                    if np.shape(self.tiltMap) == np.shape(outputFrame):
-                        outputFrame = outputFrame - self.tiltMap
-                if self.DIC:
-                    outputFrame = pyh.synthetic_DIC(outputFrame)
+                outputFrame = self.post_process(outputFrame)
+            timer.end_frame()
             return outputFrame
 
+        timer.end_frame()
         return inputFrame
 
 
+    def process_roi(self, inputFrame, roi):
+        """Reconstructs only roi (plus a guard band) and returns a full size
+        output which is zero outside roi.
+        """
+        timer = self.stageTimer
+        roiField, fieldShape, roi = self.refocus_roi(inputFrame, roi)
+        if roiField is None:
+            timer.end_frame()
+            return inputFrame
+
+        if self.singlePrecision:
+            roiOutput = self.post_process_single(roiField, roi=roi, fieldShape=fieldShape)
+        else:
+            roiOutput = self.post_process(roiField, roi=roi, fieldShape=fieldShape)
+
+        # Only the ROI is written, so a reused canvas only needs clearing
+        # when the ROI or shape changes
+        canvas = self.get_buffer("canvas", fieldShape, roiOutput.dtype)
+        canvasKey = (fieldShape, roi.x, roi.y, roi.width, roi.height)
+        if not self.reuseBuffers or canvasKey != self.canvasKey:
+            canvas[:] = 0
+            self.canvasKey = canvasKey
+        roi.crop(canvas)[:] = roiOutput
+        timer.end_frame()
+        return canvas
+
+
+    def set_multi_plane(self, enabled, numPlanes=None, spacing=None):
+        """Turns the multi-plane view on or off. numPlanes planes spaced by
+        spacing are shown, centred on the current depth.
+        """
+        self.multiPlane = enabled
+        if numPlanes is not None:
+            self.multiPlaneNum = max(int(numPlanes), 1)
+        if spacing is not None:
+            self.multiPlaneSpacing = spacing
+
+
+    def multi_plane_depths(self):
+        """Returns a tuple of the depths shown in the multi-plane view."""
+        centre = (self.multiPlaneNum - 1) / 2
+        return tuple(
+            self.holo.depth + (idx - centre) * self.multiPlaneSpacing
+            for idx in range(self.multiPlaneNum)
+        )
+
+
+    def process_multi_plane(self, inputFrame):
+        """Refocuses inputFrame to each of multi_plane_depths() and returns
+        the planes tiled row by row into an image no larger than the field.
+        The field FFT is calculated (or taken from the stage cache) once and
+        all planes are propagated together, see multi_plane.
+        """
+        timer = self.stageTimer
+        fieldFFT = self.field_fft(inputFrame, self.frame_key(inputFrame))
+        timer.mark("field")
+        if fieldFFT is None:
+            timer.end_frame()
+            return inputFrame
+
+        inputShape = np.shape(inputFrame)
+        fieldShape = np.shape(fieldFFT)
+        depths = self.multi_plane_depths()
+        grid = grid_shape(len(depths))
+        tileShape = tile_shape(fieldShape, grid)
+        pixelSize = self.field_pixel_size(inputShape, fieldShape)
+        dtype = "complex128" if self.holo.precision == "double" else "complex64"
+        wavelength = self.holo.wavelength
+        props = self.propagatorCache.get(
+            self.propagator_key(inputShape, fieldShape) + ("multi", tileShape, depths),
+            lambda: propagator_stack(fieldShape, tileShape, wavelength, pixelSize, depths, dtype=dtype),
+        )
+        planes = refocus_planes(fieldFFT, props)
+        timer.mark("propagate")
+
+        out = self.get_buffer("planes", np.shape(planes), "float32")
+        if self.showPhase is False:
+            np.abs(planes, out=out)
+            if self.invert is True:
+                np.subtract(np.max(out, axis=(1, 2), keepdims=True), out, out=out)
+            timer.mark("amplitude")
+        else:
+            np.arctan2(np.imag(planes), np.real(planes), out=out)
+            np.mod(out, 2 * np.pi, out=out)
+            timer.mark("phase")
+            # Each plane is a different depth, so temporal unwrapping and
+            # automatic tilt estimation are not used
+            if self.unwrap:
+                for plane in out:
+                    plane[:] = self.phaseUnwrapper.spatial_unwrap(plane)
+                timer.mark("unwrap")
+            if self.removeTilt:
+                tilt = self.tilt_correction(tileShape)
+                if tilt is not None:
+                    np.subtract(out, tilt, out=out)
+                timer.mark("tilt")
+            if self.DIC:
+                for plane in out:
+                    plane[:] = pyh.synthetic_DIC(plane)
+                timer.mark("dic")
+
+        tiled = tile_planes(
+            out,
+            grid,
+            out=self.get_buffer(
+                "tiles", (grid[0] * tileShape[0], grid[1] * tileShape[1]), "float32"
+            ),
+        )
+        timer.end_frame()
+        return tiled
+
+
+    def set_edof(self, enabled, depthRange=None, numPlanes=None, showDepth=None,
+                 metric=None, windowSize=None, tiled=None):
+        """Turns the all-in-focus (extended depth of field) display on or
+        off. numPlanes planes over depthRange are composited, and if
+        showDepth is True the depth map (in microns) is shown instead of the
+        composite. See edof.FocusCompositor for the other arguments.
+        """
+        self.edof = enabled
+        if depthRange is not None:
+            self.edofDepthRange = (min(depthRange), max(depthRange))
+        if numPlanes is not None:
+            self.edofNumPlanes = max(int(numPlanes), 1)
+        if showDepth is not None:
+            self.edofShowDepth = showDepth
+        if self.edofCompositor is None:
+            self.edofCompositor = FocusCompositor()
+        if metric is not None:
+            self.edofCompositor.metric = metric
+        if windowSize is not None:
+            self.edofCompositor.windowSize = int(windowSize)
+        if tiled is not None:
+            self.edofCompositor.tiled = tiled
+
+
+    def refocus_stack(self, fieldFFT, inputShape, depths, cache=True):
+        """Returns the fields refocused to each of depths, a 3D array (depth,
+        y, x), from fieldFFT, the FFT of the pre-propagation field of a
+        hologram of inputShape. All depths are propagated with a single
+        batched inverse FFT. If cache is True the stack of propagators is
+        kept in the propagator cache.
+        """
+        fieldShape = np.shape(fieldFFT)
+        pixelSize = self.field_pixel_size(inputShape, fieldShape)
+        dtype = "complex128" if self.holo.precision == "double" else "complex64"
+        wavelength = self.holo.wavelength
+
+        def create():
+            return np.stack(
+                [
+                    angular_spectrum_propagator(fieldShape, wavelength, pixelSize, depth, dtype=dtype)
+                    for depth in depths
+                ]
+            )
+
+        if cache:
+            # The current depth is not used, so is left out of the key
+            props = self.propagatorCache.get(
+                self.propagator_key(inputShape, fieldShape)[1:] + ("stack", tuple(depths)),
+                create,
+            )
+            batch = props * fieldFFT
+        else:
+            batch = create()
+            batch *= fieldFFT
+        return scipy.fft.ifft2(batch, axes=(-2, -1), overwrite_x=True, workers=-1)
+
+
+    def process_edof(self, inputFrame):
+        """Returns the all-in-focus image of inputFrame, or the depth map if
+        edofShowDepth is True. The planes are refocused and merged into the
+        composite edofBatchSize at a time.
+        """
+        timer = self.stageTimer
+        fieldFFT = self.field_fft(inputFrame, self.frame_key(inputFrame))
+        timer.mark("field")
+        if fieldFFT is None:
+            timer.end_frame()
+            return inputFrame
+
+        if self.edofCompositor is None:
+            self.edofCompositor = FocusCompositor()
+        compositor = self.edofCompositor
+        compositor.reset()
+        depths = np.linspace(self.edofDepthRange[0], self.edofDepthRange[1], self.edofNumPlanes)
+        for batchDepths in depth_batches(depths, self.edofBatchSize):
+            compositor.add(
+                batchDepths,
+                self.refocus_stack(fieldFFT, np.shape(inputFrame), batchDepths),
+            )
+        timer.mark("propagate")
+
+        if self.edofShowDepth:
+            out = self.get_buffer("output", np.shape(compositor.depthMap), "float32")
+            np.multiply(compositor.depthMap, 10**6, out=out)
+            timer.end_frame()
+            return out
+
+        if self.singlePrecision:
+            outputFrame = self.post_process_single(compositor.field)
+        else:
+            outputFrame = self.post_process(compositor.field)
+        timer.end_frame()
+        return outputFrame
+
+
+    def reconstruction_roi(self):
+        """Returns the ROI to reconstruct, or None for the whole frame."""
+        roi = self.current_roi()
+        if not self.roiReconstruction or roi is None:
+            return None
+        if roi.width < 2 or roi.height < 2:
+            return None
+        return roi
+
+
+    def full_field_shape(self, inputShape, factor=None):
+        """Returns the shape of the pre-propagation field of an inline
+        hologram of inputShape, as PyHoloscope downsamples, by factor
+        (default the current downsample factor).
+        """
+        if factor is None:
+            factor = self.holo.downsample
+        if factor == 1:
+            return tuple(inputShape[:2])
+        return tuple(
+            int(size / factor / 2) * 2 for size in inputShape[:2]
+        )
+
+
+    def guard_band(self, pixelSize):
+        """Returns the guard band in pixels of pixelSize around the ROI. Light
+        from a point in the ROI spreads out by up to depth * tan(theta) on
+        propagation, where theta is the steepest angle the pixel size can
+        sample.
+        """
+        if self.roiGuardBand > 0:
+            return int(self.roiGuardBand)
+        sinTheta = min(self.holo.wavelength / (2 * pixelSize), 0.99)
+        spread = abs(self.holo.depth) * sinTheta / np.sqrt(1 - sinTheta**2)
+        return int(np.ceil(spread / pixelSize)) + 8
+
+
+    def roi_region(self, roi, fieldShape, guard):
+        """Returns (y0, y1, x0, x1), the region of a field of fieldShape to
+        be propagated for roi. This is the ROI plus the guard band, enlarged
+        to an even size that is fast to FFT.
+        """
+        region = []
+        for start, size, fullSize in (
+            (roi.y, roi.height, fieldShape[0]),
+            (roi.x, roi.width, fieldShape[1]),
+        ):
+            length = min(size + 2 * guard, fullSize)
+            fastLength = scipy.fft.next_fast_len(length)
+            while fastLength % 2:
+                fastLength = scipy.fft.next_fast_len(fastLength + 1)
+            length = min(fastLength, fullSize)
+            low = int(np.clip(start + size // 2 - length // 2, 0, fullSize - length))
+            region.extend([low, low + length])
+        return region
+
+
+    def refocus_roi(self, inputFrame, roi):
+        """Refocuses only the part of the hologram needed for roi. Returns
+        (refocused field within roi, shape of the full field, roi constrained
+        to the field).
+        """
+        inputShape = np.shape(inputFrame)
+        if self.holo.mode == pyh.OFF_AXIS:
+            # Demodulation needs the whole hologram, only propagation is
+            # restricted to the ROI
+            field = self.pre_propagation_field(inputFrame)
+            if field is None:
+                return None, None, None
+            fieldShape = np.shape(field)
+        else:
+            fieldShape = self.full_field_shape(inputShape)
+
+        roi = pyh.Roi(roi.x, roi.y, roi.width, roi.height)
+        roi.constrain(0, 0, fieldShape[1], fieldShape[0])
+        if roi.width < 2 or roi.height < 2:
+            return None, None, None
+
+        pixelSize = self.field_pixel_size(inputShape, fieldShape)
+        guard = self.guard_band(max(pixelSize))
+        y0, y1, x0, x1 = self.roi_region(roi, fieldShape, guard)
+
+        if self.holo.mode == pyh.OFF_AXIS:
+            field = field[y0:y1, x0:x1]
+        else:
+            scale = self.holo.downsample
+            crop = (slice(y0 * scale, y1 * scale), slice(x0 * scale, x1 * scale))
+            background = self.holo.background
+            if background is not None and np.shape(background) == inputShape:
+                background = background[crop]
+            normalise = self.holo.normalise
+            if normalise is not None and np.shape(normalise) == inputShape:
+                normalise = normalise[crop]
+            # The window is for the edges of the whole frame, so is not used
+            field = pyh.pre_process(
+                inputFrame[crop],
+                background=background,
+                normalise=normalise,
+                downsample=scale,
+                precision=self.holo.precision,
+            )
+        self.stageTimer.mark("field")
+
+        prop = self.get_propagator(inputShape, np.shape(field), pixelSize=pixelSize)
+        refocused = scipy.fft.ifft2(scipy.fft.fft2(field) * prop)
+        self.stageTimer.mark("propagate")
+
+        top = roi.y - y0
+        left = roi.x - x0
+        return (
+            refocused[top : top + roi.height, left : left + roi.width],
+            tuple(fieldShape),
+            roi,
+        )
+
+
+    def post_process(self, outputFrame, roi=None, fieldShape=None):
+        """Converts the complex reconstruction to the amplitude or phase
+        image to be displayed. If the reconstruction has been cropped to roi
+        of a field of fieldShape these are given so that the tilt correction
+        can be cropped to match.
+        """
+        timer = self.stageTimer
+        if self.showPhase is False:
+            outputFrame = pyh.amplitude(outputFrame)
+            if self.invert is True:
+                outputFrame = np.max(outputFrame) - outputFrame
+            timer.mark("amplitude")
+        else:
+            outputFrame = pyh.phase(outputFrame)
+            timer.mark("phase")
+            if self.unwrap:
+                outputFrame = self.unwrap_phase(outputFrame, cropped=roi is not None)
+                timer.mark("unwrap")
+            if self.removeTilt:
+                self.update_tilt(outputFrame, roi)
+                tilt = self.tilt_correction(np.shape(outputFrame), roi, fieldShape)
+                if tilt is not None:
+                    outputFrame = outputFrame - tilt
+                timer.mark("tilt")
+            if self.DIC:
+                outputFrame = pyh.synthetic_DIC(outputFrame)
+                timer.mark("dic")
+        return outputFrame
+
+
+    def post_process_single(self, outputFrame, roi=None, fieldShape=None):
+        """As post_process but the output is float32 and written in place
+        into a single output array. If reuseBuffers is True the output array
+        is reused for every frame, so the caller must have finished with
+        (or copied) each output before processing the next frame.
+        """
+        timer = self.stageTimer
+        out = self.get_buffer("output", np.shape(outputFrame), "float32")
+        if self.showPhase is False:
+            np.abs(outputFrame, out=out)
+            if self.invert is True:
+                np.subtract(np.max(out), out, out=out)
+            timer.mark("amplitude")
+        else:
+            np.arctan2(np.imag(outputFrame), np.real(outputFrame), out=out)
+            np.mod(out, 2 * np.pi, out=out)
+            timer.mark("phase")
+            if self.unwrap:
+                self.unwrap_phase(out, cropped=roi is not None)
+                timer.mark("unwrap")
+            if self.removeTilt:
+                self.update_tilt(out, roi)
+                tilt = self.tilt_correction(np.shape(out), roi, fieldShape)
+                if tilt is not None:
+                    np.subtract(out, tilt, out=out)
+                timer.mark("tilt")
+            if self.DIC:
+                out[:] = pyh.synthetic_DIC(out)
+                timer.mark("dic")
+        return out
+
+
+    def tilt_correction(self, shape, roi=None, fieldShape=None):
+        """Returns the tilt to subtract from a phase map of shape, or None if
+        no tilt has been found. If the phase map is cropped to roi of a field
+        of fieldShape the tilt is cropped to match.
+        """
+        if self.tiltModel is None:
+            return None
+        if roi is None:
+            return self.tiltModel.correction(shape)
+        return roi.crop(self.tiltModel.correction(fieldShape))
+
+
+    def update_tilt(self, phase, roi=None):
+        """If autoTilt is True, periodically re-estimates the tilt from phase
+        on a background thread, and uses the new tilt once it is ready.
+        Phase maps cropped to an ROI are not used.
+        """
+        if not self.autoTilt:
+            return
+        if self.tiltEstimator is None:
+            self.tiltEstimator = TiltEstimator(self.tiltOrder, self.autoTiltInterval)
+        if roi is None:
+            self.tiltEstimator.submit(phase, unwrapped=self.unwrap)
+        model = self.tiltEstimator.take()
+        if model is not None:
+            self.tiltModel = model
+
+
+    def set_tilt_order(self, order):
+        self.tiltOrder = order
+        self.tiltEstimator = None
+
+
+    def set_auto_tilt(self, enabled, interval=None):
+        self.autoTilt = enabled
+        if interval is not None:
+            self.autoTiltInterval = interval
+        self.tiltEstimator = None
+
+
+    def unwrap_phase(self, phase, cropped=False):
+        """Unwraps phase in place using phaseUnwrapper, only within roi if
+        unwrapROIOnly is True, unless phase is already cropped to the ROI.
+        """
+        roi = self.current_roi() if self.unwrapROIOnly and not cropped else None
+        key = (self.field_settings_key(), self.holo.depth, self.holo.refocus)
+        return self.phaseUnwrapper.unwrap(phase, roi=roi, key=key)
+
+
+    def set_unwrap_method(self, method):
+        self.phaseUnwrapper.method = method
+        self.phaseUnwrapper.reset()
+
+
+    def set_temporal_unwrap(self, temporal):
+        self.phaseUnwrapper.temporal = temporal
+        self.phaseUnwrapper.reset()
+
+
+    def get_buffer(self, name, shape, dtype):
+        """Returns an array of shape and dtype. If reuseBuffers is True the
+        same array is returned each time it is requested with the same shape,
+        otherwise a new array is created.
+        """
+        if not self.reuseBuffers:
+            return np.empty(shape, dtype=dtype)
+        if self.buffers is None:
+            self.buffers = {}
+        buffer = self.buffers.get(name)
+        if buffer is None or buffer.shape != tuple(shape) or buffer.dtype != np.dtype(dtype):
+            buffer = np.empty(shape, dtype=dtype)
+            self.buffers[name] = buffer
+        return buffer
+
+
+    def use_propagator_cache(self):
+        """Returns True if refocusing can be done here using cached
+        propagators. Anything other than plain angular spectrum refocusing
+        on the CPU is left to PyHoloscope, as are a propagator look up table,
+        windowing after refocusing and inversion by the Holo.
+        """
+        holo = self.holo
+        return (
+            self.cachePropagators
+            and not holo.return_fft
+            and not holo.invert
+            and not getattr(holo, "post_window", False)
+            and not getattr(holo, "use_prop_lut", False)
+            and not getattr(holo, "correct_curvature", False)
+            and not getattr(holo, "correct_pixel_size", False)
+            and getattr(holo, "propagation_method", "angular_spectrum")
+            == "angular_spectrum"
+            and not (holo.cuda and getattr(holo, "cuda_available", False))
+        )
+
+
+    def pre_propagation_field(self, inputFrame):
+        """Returns the field to be refocused, i.e. the hologram after
+        background, normalisation, windowing and downsampling (inline) or after
+        demodulation (off-axis).
+        """
+        if self.holo.mode == pyh.OFF_AXIS:
+            # PyHoloscope handles demodulation, relative phase etc. and we
+            # just stop it from refocusing
+            refocus = self.holo.refocus
+            self.holo.refocus = False
+            try:
+                field = self.holo.process(inputFrame)
+            finally:
+                self.holo.refocus = refocus
+        else:
+            self.holo.update_auto_window(inputFrame)
+            field = pyh.pre_process(
+                inputFrame,
+                background=self.holo.background,
+                normalise=self.holo.normalise,
+                window=self.holo.window,
+                downsample=self.holo.downsample,
+                precision=self.holo.precision,
+            )
+        return field
+
+
+    def propagator_key(self, inputShape, fieldShape):
+        """Key for the propagator cache. Includes everything the propagator
+        for the current settings depends on.
+        """
+        holo = self.holo
+        return (
+            holo.depth,
+            holo.wavelength,
+            holo.pixel_size,
+            tuple(inputShape),
+            tuple(fieldShape),
+            holo.downsample,
+            holo.mode,
+            holo.auto_window,
+            holo.window_shape,
+            holo.window_thickness,
+            holo.precision,
+        )
+
+
+    def field_settings_key(self):
+        """Returns a key describing all the settings that affect the
+        pre-propagation field and its propagation, apart from depth.
+        """
+        self.update_image_keys()
+        holo = self.holo
+        return (
+            holo.mode,
+            holo.wavelength,
+            holo.pixel_size,
+            holo.downsample,
+            holo.auto_window,
+            holo.window_shape,
+            holo.window_thickness,
+            holo.precision,
+            settings_value(holo.crop_centre),
+            settings_value(holo.crop_radius),
+            holo.relative_phase,
+            self.backgroundKey,
+            self.normaliseKey,
+        )
+
+
+    def field_pixel_size(self, inputShape, fieldShape=None):
+        """Returns the (y, x) pixel size used to refocus a field of fieldShape
+        obtained from a hologram of inputShape, which only depends on
+        inputShape and the current settings. This is the pixel size
+        PyHoloscope uses, so that cached refocusing gives the same result:
+        the camera pixel size times the downsample factor for inline
+        holograms, and the camera pixel size scaled by the height of the
+        hologram relative to the demodulated field before any downsampling
+        for off-axis holograms.
+        """
+        holo = self.holo
+        if holo.mode == pyh.OFF_AXIS:
+            demodHeight = 2 * pyh.dimensions(holo.crop_radius)[0]
+            pixelSize = holo.pixel_size * inputShape[0] / demodHeight
+        else:
+            pixelSize = holo.pixel_size * holo.downsample
+        return (pixelSize, pixelSize)
+
+
+    def get_propagator(self, inputShape, fieldShape, pixelSize=None):
+        """Returns the propagator for a field of fieldShape obtained from a
+        hologram of inputShape, from the cache if possible. The pixel size of
+        the field must be given if the field has been cropped.
+        """
+        if pixelSize is None:
+            pixelSize = self.field_pixel_size(inputShape, fieldShape)
+        if self.holo.precision == "double":
+            dtype = "complex128"
+        else:
+            dtype = "complex64"
+        depth = self.holo.depth
+        wavelength = self.holo.wavelength
+
+        return self.propagatorCache.get(
+            self.propagator_key(inputShape, fieldShape) + (pixelSize,),
+            lambda: angular_spectrum_propagator(
+                fieldShape, wavelength, pixelSize, depth, dtype=dtype
+            ),
+        )
+
+
+    def update_image_keys(self):
+        """Fingerprints the background and normalisation images if they have
+        been replaced since they were last fingerprinted. The setters do this
+        when the images are set, so normally there is nothing to do here.
+        """
+        holo = self.holo
+        if holo.background is not self.keyedBackground:
+            self.keyedBackground = holo.background
+            self.backgroundKey = array_fingerprint(holo.background)
+        if holo.normalise is not self.keyedNormalise:
+            self.keyedNormalise = holo.normalise
+            self.normaliseKey = array_fingerprint(holo.normalise)
+
+
+    def set_background(self, background):
+        self.holo.set_background(background)
+        self.update_image_keys()
+
+
+    def set_normalise(self, normalise):
+        self.holo.set_normalise(normalise)
+        self.update_image_keys()
+
+
+    def frame_token(self, inputFrame):
+        """Returns a number identifying inputFrame. Frames are told apart by
+        identity rather than by their pixels, which would take too long for
+        every live frame. A frame processed again, e.g. a file frame after a
+        change of depth, is the same array, and frames must not be changed
+        in place once they have been processed.
+        """
+        if inputFrame is not self.lastFrame:
+            self.lastFrame = inputFrame
+            self.frameToken += 1
+        return self.frameToken
+
+
+    def frame_key(self, inputFrame):
+        """Returns a key identifying inputFrame and the settings that affect
+        its pre-propagation field.
+        """
+        return (self.frame_token(inputFrame), self.field_settings_key())
+
+
+    def field_fft(self, inputFrame, frameKey):
+        """Returns the FFT of the pre-propagation field of inputFrame. The
+        FFT of the last frame is kept so that it is not recalculated when the
+        same frame is processed again with only the depth or output changed.
+        """
+        if self.cacheStages and frameKey == self.fieldKey:
+            return self.fieldFFT
+        field = self.pre_propagation_field(inputFrame)
+        if field is None:
+            return None
+        fieldFFT = scipy.fft.fft2(field)
+        if self.cacheStages:
+            self.fieldKey = frameKey
+            self.fieldFFT = fieldFFT
+        return fieldFFT
+
+
+    def clear_stage_cache(self):
+        self.fieldKey = None
+        self.fieldFFT = None
+        self.refocusedKey = None
+        self.refocused = None
+
+
+    def refocus_with_cache(self, inputFrame):
+        """Refocuses the hologram to the current depth using a cached
+        propagator. If the same frame is processed again the field FFT is
+        reused, so a change of depth only needs a multiply and an inverse
+        FFT, and the refocused field is reused if only the post-processing
+        has changed.
+        """
+        frameKey = self.frame_key(inputFrame)
+        fieldFFT = self.field_fft(inputFrame, frameKey)
+        self.stageTimer.mark("field")
+        if fieldFFT is None:
+            return None
+
+        refocusedKey = (frameKey, self.holo.depth)
+        if self.cacheStages and refocusedKey == self.refocusedKey:
+            return self.refocused
+
+        prop = self.get_propagator(np.shape(inputFrame), np.shape(fieldFFT))
+        product = self.get_buffer(
+            "product", np.shape(fieldFFT), np.result_type(fieldFFT, prop)
+        )
+        np.multiply(fieldFFT, prop, out=product)
+        refocused = scipy.fft.ifft2(product)
+        self.stageTimer.mark("propagate")
+        if self.cacheStages:
+            self.refocusedKey = refocusedKey
+            self.refocused = refocused
+        return refocused
+
+
+    def set_downsample(self, factor):
+        """Sets the manual downsample factor, which is the smallest factor
+        used when downsampling is adaptive.
+        """
+        self.baseDownsample = max(int(factor), 1)
+        if self.downsampleController is not None:
+            self.downsampleController.set_min_factor(self.baseDownsample)
+            self.holo.set_downsample(self.downsampleController.factor)
+        else:
+            self.holo.set_downsample(self.baseDownsample)
+
+
+    def set_adaptive_downsample(self, enabled, targetTime=None, maxFactor=None):
+        """Sets whether the downsample factor is chosen automatically to
+        process frames in targetTime seconds, see adaptive_downsample. The
+        factor is between the manual factor and maxFactor.
+        """
+        controller = self.downsampleController
+        if not enabled:
+            self.downsampleController = None
+            self.holo.set_downsample(self.baseDownsample)
+            return
+        if controller is None:
+            controller = DownsampleController(targetTime or 0.05, minFactor=self.baseDownsample)
+            self.downsampleController = controller
+        if targetTime is not None:
+            controller.targetTime = targetTime
+        if maxFactor is not None:
+            controller.maxFactor = max(int(maxFactor), controller.minFactor)
+            controller.factor = min(controller.factor, controller.maxFactor)
+        controller.reset()
+        self.holo.set_downsample(controller.factor)
+
+
+    def current_roi(self):
+        """Returns the ROI in pixels of the current output, which differ
+        from those of the manual downsample factor the ROI is set in if the
+        adaptive factor is larger.
+        """
+        roi = self.roi
+        if roi is None or self.holo.downsample == self.baseDownsample:
+            return roi
+        scale = self.baseDownsample / self.holo.downsample
+        return pyh.Roi(
+            int(roi.x * scale),
+            int(roi.y * scale),
+            max(int(roi.width * scale), 1),
+            max(int(roi.height * scale), 1),
+        )
+
+
+    def set_display(self, enabled, factor=1, displayRange=None):
+        """Sets whether outputs are converted for display, see
+        processors.display. If enabled, outputs are decimated by factor and
+        mapped to 8 bits with displayRange mapped to 0-255, or with contrast
+        from percentiles if displayRange is None.
+        """
+        if enabled:
+            self.displayConverter = DisplayConverter(factor, displayRange)
+        else:
+            self.displayConverter = None
+
+
+    def set_propagator_cache_size(self, sizeMB):
+        """Sets the maximum memory used by the propagator cache in MB."""
+        self.propagatorCacheSize = sizeMB
+        self.propagatorCache.set_max_bytes(sizeMB * 1024**2)
+
+
+    def propagator_cache_stats(self):
+        """Returns hit/miss counters and memory use of the propagator cache."""
+        return self.propagatorCache.stats()
+
+
+    def set_telemetry_log(self, filename):
+        """Logs per-frame stage timings to filename (CSV, or JSON lines if the
+        extension is .json), or stops logging if filename is None.
+        """
+        self.stageTimer.set_log_file(filename)
+
+
+    def set_telemetry_share(self, shareName):
+        """Publishes stage timing summaries to the shared memory created by
+        a TelemetryReader with shareName.
+        """
+        self.stageTimer.set_share_name(shareName)
+
+
+    def stage_timings(self):
+        """Returns rolling timing statistics for each processing stage."""
+        return self.stageTimer.summary()
+
+
+    def set_scrub_mode(self, enabled, depthRange=None, numPlanes=None, interpolate=None):
+        """Turns scrub mode on or off. In scrub mode a depth stack of the
+        current hologram over depthRange is built in the background and
+        changes of depth are served from the stack rather than by refocusing.
+        """
+        self.scrubMode = enabled
+        if depthRange is not None:
+            self.scrubDepthRange = (min(depthRange), max(depthRange))
+        if numPlanes is not None:
+            self.scrubNumPlanes = max(int(numPlanes), 2)
+        if interpolate is not None:
+            self.scrubInterpolate = interpolate
+        if not enabled:
+            self.clear_scrub_stack()
+
+
+    def clear_scrub_stack(self):
+        if self.scrubStack is not None:
+            self.scrubStack.cancel()
+        self.scrubStack = None
+
+
+    def start_scrub_stack(self, inputFrame, key):
+        """Starts building a new depth stack for inputFrame in the background."""
+        self.clear_scrub_stack()
+
+        fieldFFT = self.field_fft(inputFrame, key[0])
+        if fieldFFT is None:
+            return
+
+        # Limit the number of planes so the stack fits in the memory allowed
+        planeBytes = np.prod(np.shape(fieldFFT)) * np.dtype("complex64").itemsize
+        numPlanes = int(min(self.scrubNumPlanes, self.scrubMaxMemory * 1024**2 // planeBytes))
+        if numPlanes < 2:
+            return
+
+        self.scrubStack = DepthScrubStack(
+            fieldFFT,
+            self.scrubDepthRange,
+            numPlanes,
+            self.holo.wavelength,
+            self.field_pixel_size(np.shape(inputFrame), np.shape(fieldFFT)),
+            key=key,
+        )
+        self.scrubStack.start()
+
+
+    def scrub_field(self, inputFrame):
+        """Returns the refocused field for the current depth from the scrub
+        stack, starting a new stack if the hologram or settings have changed.
+        Returns None if the depth is not (yet) available from the stack.
+        """
+        key = (
+            self.frame_key(inputFrame),
+            self.scrubDepthRange,
+            self.scrubNumPlanes,
+        )
+        if self.scrubStack is None or self.scrubStack.key != key:
+            self.start_scrub_stack(inputFrame, key)
+        if self.scrubStack is None:
+            return None
+        return self.scrubStack.get(self.holo.depth, self.scrubInterpolate)
+
+
+    def scrub_progress(self):
+        """Returns the fraction of the scrub stack built, or None if there is
+        no stack."""
+        if self.scrubStack is None:
+            return None
+        return self.scrubStack.progress()
+
+
+    def __getstate__(self):
+        # Scrub mode is only for holograms processed in the GUI process, so
+        # it is not sent to the processing core along with the settings
+        state = self.__dict__.copy()
+        state["scrubMode"] = False
+        state["scrubStack"] = None
+        # Cached results for the last frame are large and only of use here
+        state["fieldKey"] = None
+        state["fieldFFT"] = None
+        state["lastFrame"] = None
+        state["refocusedKey"] = None
+        state["refocused"] = None
+        state["buffers"] = None
+        state["tiltEstimator"] = None
+        if self.edofCompositor is not None:
+            state["edofCompositor"] = FocusCompositor(
+                self.edofCompositor.windowSize,
+                self.edofCompositor.metric,
+                self.edofCompositor.tiled,
+            )
+        return state
+
+
     def obtain_tilt(self, inputFrame):
+        """Fits the tilt model to the unwrapped phase of hologram inputFrame.
+        The model is independent of the output size, so it remains valid if
+        the downsampling or ROI are changed.
+        """
         if inputFrame is not None and self.holo is not None:
             phase = pyh.phase_unwrap(pyh.phase(self.holo.process(inputFrame)))
-            self.tiltMap = pyh.obtain_tilt(phase)
+            self.tiltModel = TiltModel.fit(phase, order=self.tiltOrder)
         else:
-            self.tiltMap = None
+            self.tiltModel = None
 
 
     def set_depth(self, depth):
         self.holo.set_depth(depth)
-        
 
-    def auto_focus(self, **kwargs):
+
+    def apply_settings(self, changes):
+        """Applies a dictionary of changed settings, see holo_settings. This
+        is sent as a message so that only the settings which have changed are
+        passed to the processor on the other core.
+        """
+        apply_settings(self, changes)
+
+
+    def focus_search(self, inputFrame, depthRange, **kwargs):
+        """Returns a FocusSearch for hologram inputFrame over depthRange using
+        the current settings. Call run() on the returned object, optionally
+        from another thread. Keyword arguments are passed to FocusSearch.
+        """
+        field = self.pre_propagation_field(inputFrame.astype("float32"))
+        return FocusSearch(
+            field,
+            self.holo.wavelength,
+            self.field_pixel_size(np.shape(inputFrame), np.shape(field)),
+            depthRange,
+            **kwargs,
+        )
+
+
+    def auto_focus(self, roi=None, margin=None, depthRange=(0, 0.001), coarseSearchInterval=10):
+        """Finds the best focus depth for the last processed hologram. This
+        blocks until the search is complete, use focus_search() for a search
+        that can be run in the background.
+        """
         if self.preProcessFrame is not None:
-            return self.holo.auto_focus(
-                self.preProcessFrame.astype("float32"), **kwargs
-            )
+            return self.focus_search(
+                self.preProcessFrame,
+                depthRange,
+                roi=roi,
+                margin=margin,
+                numCoarse=coarseSearchInterval,
+            ).run()
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental processing settings.
+
+Processing settings are described by a flat dictionary of name: value. The
+SettingsTracker compares each new dictionary with the settings last applied
+and returns only those which have changed, so that a change to one option
+only calls the corresponding setter and only the changes need to be sent to
+the processor on the other core. Arrays such as the background are compared
+by identity and then by value, so they are only resent (and any state
+derived from them rebuilt) when the image actually changes.
+
+"""
+
+import numpy as np
+
+import pyholoscope as pyh
+
+
+def set_refocus(processor, value):
+    processor.refocus = value
+    processor.holo.set_refocus(value)
+
+
+def set_window(processor, value):
+    # value is None for no window, otherwise (shape, thickness)
+    if value is None:
+        processor.holo.clear_window()
+        processor.holo.set_auto_window(False)
+    else:
+        processor.holo.set_auto_window(True)
+        processor.holo.set_window_shape(value[0])
+        processor.holo.set_window_thickness(value[1])
+
+
+def set_crop(processor, centre=None, radius=None):
+    # The demodulated background and normalisation fields, and their
+    # amplitudes and phases, depend on the crop and are recreated on the
+    # next frame
+    holo = processor.holo
+    if centre is not None:
+        holo.set_crop_centre(centre)
+    if radius is not None:
+        holo.set_crop_radius(radius)
+    holo.background_field = None
+    holo.background_abs = None
+    holo.background_angle = None
+    holo.normalise_field = None
+    holo.normalise_abs = None
+    holo.normaliseAngle = None
+
+
+def set_roi(processor, value):
+    processor.roi = pyh.Roi(*value) if value is not None else None
+
+
+# Setters in the order they are applied, mode must be set before anything
+# that depends on it
+SETTERS = [
+    ("cuda", lambda p, v: p.holo.set_use_cuda(v)),
+    ("mode", lambda p, v: p.holo.set_mode(v)),
+    ("crop_centre", lambda p, v: set_crop(p, centre=v)),
+    ("crop_radius", lambda p, v: set_crop(p, radius=v)),
+    ("background", lambda p, v: p.set_background(v)),
+    ("normalise", lambda p, v: p.set_normalise(v)),
+    ("relative_phase", lambda p, v: p.holo.set_relative_phase(v)),
+    ("downsample", lambda p, v: p.set_downsample(v)),
+    ("adaptiveDownsample", lambda p, v: p.set_adaptive_downsample(v[0], targetTime=v[1], maxFactor=v[2])),
+    ("correct_curvature", lambda p, v: setattr(p.holo, "correct_curvature", v)),
+    ("source_distance", lambda p, v: setattr(p.holo, "source_distance", v)),
+    ("return_fft", lambda p, v: setattr(p.holo, "return_fft", v)),
+    ("refocus", set_refocus),
+    ("wavelength", lambda p, v: p.holo.set_wavelength(v)),
+    ("pixel_size", lambda p, v: p.holo.set_pixel_size(v)),
+    ("depth", lambda p, v: p.holo.set_depth(v)),
+    ("window", set_window),
+    ("showPhase", lambda p, v: setattr(p, "showPhase", v)),
+    ("invert", lambda p, v: setattr(p, "invert", v)),
+    ("unwrap", lambda p, v: setattr(p, "unwrap", v)),
+    ("unwrapMethod", lambda p, v: p.set_unwrap_method(v)),
+    ("unwrapROIOnly", lambda p, v: setattr(p, "unwrapROIOnly", v)),
+    ("temporalUnwrap", lambda p, v: p.set_temporal_unwrap(v)),
+    ("removeTilt", lambda p, v: setattr(p, "removeTilt", v)),
+    ("tiltOrder", lambda p, v: p.set_tilt_order(v)),
+    ("autoTilt", lambda p, v: p.set_auto_tilt(v)),
+    ("DIC", lambda p, v: setattr(p, "DIC", v)),
+    ("roi", set_roi),
+    ("roiReconstruction", lambda p, v: setattr(p, "roiReconstruction", v)),
+    ("roiGuardBand", lambda p, v: setattr(p, "roiGuardBand", v)),
+    ("multiPlane", lambda p, v: p.set_multi_plane(v[0], numPlanes=v[1], spacing=v[2])),
+    ("edof", lambda p, v: p.set_edof(v[0], depthRange=v[1], numPlanes=v[2], showDepth=v[3])),
+    ("edofFocus", lambda p, v: p.set_edof(p.edof, metric=v[0], windowSize=v[1], tiled=v[2])),
+    ("display", lambda p, v: p.set_display(v[0], factor=v[1], displayRange=v[2])),
+    ("processEveryN", lambda p, v: setattr(p, "processEveryN", v)),
+    ("propagatorCacheSize", lambda p, v: p.set_propagator_cache_size(v)),
+    ("telemetryShare", lambda p, v: p.set_telemetry_share(v)),
+    ("telemetryLog", lambda p, v: p.set_telemetry_log(v)),
+    ("reuseBuffers", lambda p, v: setattr(p, "reuseBuffers", v)),
+    ("scrub", lambda p, v: p.set_scrub_mode(v[0], depthRange=v[1], numPlanes=v[2], interpolate=v[3])),
+]
+
+SETTING_NAMES = [name for name, setter in SETTERS]
+
+# Settings which only apply to the processor in the GUI process
+LOCAL_ONLY = {"scrub"}
+
+# Settings which only apply to the processor on the processing core. Output
+# buffers can only be reused there, as each output is copied to shared memory
+# before the next frame is processed.
+REMOTE_ONLY = {"reuseBuffers"}
+
+# Settings which only apply to the processor of live frames, which is the one
+# on the processing core if there is one. Stage timings are only logged by
+# one process, so that rows from the two are not mixed in one file.
+LIVE_ONLY = {"telemetryLog"}
+
+
+def apply_settings(processor, changes):
+    """Applies a dictionary of changed settings to processor."""
+    for name, setter in SETTERS:
+        if name in changes:
+            setter(processor, changes[name])
+
+
+def settings_equal(a, b):
+    if isinstance(a, np.ndarray) or isinstance(b, np.ndarray):
+        if a is b:
+            return True
+        if not (isinstance(a, np.ndarray) and isinstance(b, np.ndarray)):
+            return False
+        return a.shape == b.shape and a.dtype == b.dtype and np.array_equal(a, b)
+    return a == b
+
+
+def remote_changes(changes):
+    """Returns the changes which need to be sent to the processing core."""
+    return {name: value for name, value in changes.items() if name not in LOCAL_ONLY}
+
+
+def local_changes(changes, multiCore=False):
+    """Returns the changes which apply to the processor in the GUI process,
+    which does not process live frames if multiCore is True.
+    """
+    excluded = REMOTE_ONLY | LIVE_ONLY if multiCore else REMOTE_ONLY
+    return {name: value for name, value in changes.items() if name not in excluded}
+
+
+def remote_only_changes(changes):
+    return {name: value for name, value in changes.items() if name in REMOTE_ONLY | LIVE_ONLY}
+
+
+class SettingsTracker:
+    """Keeps a record of the settings last applied to the processor."""
+
+    def __init__(self):
+        self.applied = {}
+
+    def changes(self, settings):
+        """Returns a dictionary of the settings which differ from those last
+        applied. Settings not present in settings are left unchanged.
+        """
+        for name in settings:
+            if name not in SETTING_NAMES:
+                raise KeyError(f"Unknown processing setting {name}")
+        return {
+            name: value
+            for name, value in settings.items()
+            if name not in self.applied or not settings_equal(value, self.applied[name])
+        }
+
+    def record(self, changes):
+        """Records that changes have been applied."""
+        self.applied.update(changes)
+
+    def is_empty(self):
+        return len(self.applied) == 0
+
+    def reset(self):
+        """Forget the applied settings, so that everything is applied next
+        time.
+        """
+        self.applied = {}
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Multi-plane view: several refocused planes of one hologram tiled into a
+single image.
+
+Each plane is shown as a tile smaller than the field, so rather than
+refocusing at full size and then downsampling, the FFT of the field is
+cropped to the central (low) spatial frequencies that a tile can show. The
+stack of propagators for the cropped spectrum is applied in a single
+broadcast multiply and the planes are inverse transformed together with a
+batched FFT. The tiled image is therefore no larger than the field, and
+costs about the same as refocusing to a single depth.
+
+"""
+
+import math
+
+import numpy as np
+import scipy.fft
+
+from processors.propagator_cache import angular_spectrum_propagator
+
+
+def grid_shape(numPlanes):
+    """Returns (rows, columns) of the most nearly square grid of tiles
+    that holds numPlanes planes.
+    """
+    columns = math.ceil(math.sqrt(numPlanes))
+    rows = math.ceil(numPlanes / columns)
+    return rows, columns
+
+
+def tile_shape(fieldShape, grid):
+    """Returns the shape of each tile for a field of fieldShape shown in a
+    grid of (rows, columns) tiles. Each dimension is the largest even size
+    that fits and is fast to FFT.
+    """
+    shape = []
+    for size, num in zip(fieldShape, grid):
+        length = max(int(size / num), 2)
+        while length > 2 and (length % 2 or scipy.fft.next_fast_len(length) != length):
+            length -= 1
+        shape.append(length)
+    return tuple(shape)
+
+
+def frequency_indices(fullSize, size):
+    """Returns the indices along an axis of an unshifted spectrum of
+    fullSize which are kept when it is cropped to size.
+    """
+    half = size // 2
+    return np.concatenate((np.arange(0, size - half), np.arange(fullSize - half, fullSize)))
+
+
+def crop_spectrum(fieldFFT, shape):
+    """Returns the central frequencies of the unshifted spectrum fieldFFT
+    as an array of shape, also unshifted.
+    """
+    rows = frequency_indices(np.shape(fieldFFT)[0], shape[0])
+    cols = frequency_indices(np.shape(fieldFFT)[1], shape[1])
+    return fieldFFT[np.ix_(rows, cols)]
+
+
+def propagator_stack(fieldShape, shape, wavelength, pixelSize, depths, dtype="complex64"):
+    """Returns an array of (len(depths),) + shape angular spectrum
+    propagators for the cropped spectrum of a field of fieldShape with
+    (y, x) pixelSize. The propagators include the scaling needed for the
+    inverse FFT of the cropped spectrum to have the same amplitude as the
+    full size field.
+    """
+    # With the pixel size scaled up, the frequencies of the smaller grid are
+    # exactly the central frequencies of the full size grid
+    tilePixelSize = (
+        pixelSize[0] * fieldShape[0] / shape[0],
+        pixelSize[1] * fieldShape[1] / shape[1],
+    )
+    scale = shape[0] * shape[1] / (fieldShape[0] * fieldShape[1])
+    stack = np.empty((len(depths),) + tuple(shape), dtype=dtype)
+    for idx, depth in enumerate(depths):
+        stack[idx] = angular_spectrum_propagator(shape, wavelength, tilePixelSize, depth, dtype=dtype)
+    stack *= scale
+    return stack
+
+
+def refocus_planes(fieldFFT, props):
+    """Returns the refocused fields for each propagator in the stack props,
+    calculated with one batched inverse FFT.
+    """
+    spectrum = crop_spectrum(fieldFFT, np.shape(props)[1:])
+    return scipy.fft.ifft2(props * spectrum[np.newaxis], axes=(-2, -1), workers=-1)
+
+
+def tile_planes(planes, grid, out=None):
+    """Tiles the stack of images planes row by row into a grid of (rows,
+    columns). Tiles with no plane are set to zero. If out is given the
+    tiles are written into it.
+    """
+    numPlanes, height, width = np.shape(planes)
+    rows, columns = grid
+    if out is None:
+        out = np.empty((rows * height, columns * width), dtype=planes.dtype)
+    tiles = out.reshape(rows, height, columns, width)
+    for idx in range(rows * columns):
+        row, column = divmod(idx, columns)
+        if idx < numPlanes:
+            tiles[row, :, column, :] = planes[idx]
+        else:
+            tiles[row, :, column, :] = 0
+    return out
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""
+3D localisation and tracking of particles in hologram sequences.
+
+Each hologram is refocused to a set of depths and merged into an
+all-in-focus composite (see edof), giving the best local focus score and
+the depth it occurred at for every pixel. Particles are found as peaks of
+the focus score, with the depth of each taken from the depth map. Detections
+in successive frames are then linked into tracks by minimum cost assignment,
+allowing particles to go undetected for a few frames. Depth is found much
+less precisely than lateral position, so lateral and axial movement are
+limited separately when linking.
+
+Detections are arrays with one row per particle and columns x, y (camera
+pixels), z (microns) and focus score. Tracks are arrays with columns
+COLUMNS.
+
+"""
+
+import csv
+import os
+
+import numpy as np
+import scipy.ndimage
+from scipy.optimize import linear_sum_assignment
+from scipy.spatial.distance import cdist
+
+from processors.edof import FocusCompositor, VARIANCE, refocused_batches
+
+
+COLUMNS = ["track", "frame", "x", "y", "z", "score"]
+
+
+def find_peaks(score, minDistance, threshold, maxSamples=65536):
+    """Returns (y, x) indices of local maxima of score which are at least
+    minDistance pixels apart and more than threshold robust standard
+    deviations above the median. The median and deviation are estimated
+    from a regular subsample of at most maxSamples pixels.
+    """
+    step = max(int(np.ceil(np.sqrt(np.size(score) / maxSamples))), 1)
+    sample = score[::step, ::step]
+    median = np.median(sample)
+    deviation = 1.4826 * np.median(np.abs(sample - median))
+    level = median + threshold * deviation
+
+    localMax = scipy.ndimage.maximum_filter(score, size=2 * int(minDistance) + 1, mode="nearest")
+    return np.nonzero((score == localMax) & (score > level))
+
+
+class ParticleDetector:
+    """Finds in-focus particles in holograms.
+
+    Arguments:
+        depths      : array of float
+                      depths to refocus to, in metres
+
+    Keyword Arguments:
+        windowSize  : int
+                      size of the focus metric window in pixels (default 15)
+        metric      : str
+                      focus metric, see edof (default VARIANCE)
+        minDistance : int
+                      minimum separation of particles in pixels of the
+                      refocused field (default 10)
+        threshold   : float
+                      detection threshold in robust standard deviations of
+                      the focus score above the median (default 5)
+        batchSize   : int
+                      number of depths refocused at once (default 4)
+    """
+
+    def __init__(self, depths, **kwargs):
+        self.depths = np.asarray(depths, dtype="float64")
+        self.minDistance = int(kwargs.get("minDistance", 10))
+        self.threshold = float(kwargs.get("threshold", 5))
+        self.batchSize = max(int(kwargs.get("batchSize", 4)), 1)
+        self.compositor = FocusCompositor(
+            windowSize=kwargs.get("windowSize", 15),
+            metric=kwargs.get("metric", VARIANCE),
+        )
+
+    def detect(self, processor, hologram):
+        """Returns the detections in hologram using the reconstruction
+        settings of processor (a HoloProcessor).
+        """
+        hologram = np.asarray(hologram, dtype="float32")
+        compositor = self.compositor
+        compositor.reset()
+        # Propagators are cached, as every hologram uses the same depths
+        for depths, fields in refocused_batches(processor, hologram, self.depths, self.batchSize, cache=True):
+            compositor.add(depths, fields)
+
+        y, x = find_peaks(compositor.score, self.minDistance, self.threshold)
+
+        # The field may be downsampled relative to the hologram
+        scaleY = np.shape(hologram)[0] / np.shape(compositor.score)[0]
+        scaleX = np.shape(hologram)[1] / np.shape(compositor.score)[1]
+        return np.stack(
+            [
+                (x + 0.5) * scaleX - 0.5,
+                (y + 0.5) * scaleY - 0.5,
+                compositor.depthMap[y, x] * 10**6,
+                compositor.score[y, x],
+            ],
+            axis=-1,
+        ).astype("float64")
+
+
+class ParticleTracker:
+    """Links detections in successive frames into tracks.
+
+    Keyword Arguments:
+        maxDistance : float
+                      maximum lateral distance in microns a particle can move
+                      between the frames it is detected in (default 20)
+        maxDepthChange : float
+                      maximum change in depth in microns between the frames
+                      a particle is detected in (default 200)
+        maxGap      : int
+                      number of frames a particle can go undetected before
+                      its track ends (default 2)
+        pixelSize   : float
+                      camera pixel size in microns, used to convert x and y
+                      to microns (default 1)
+        minLength   : int
+                      tracks with fewer detections are discarded (default 1)
+    """
+
+    def __init__(self, maxDistance=20, maxDepthChange=200, maxGap=2, pixelSize=1.0, minLength=1):
+        self.maxDistance = float(maxDistance)
+        self.maxDepthChange = float(maxDepthChange)
+        self.maxGap = int(maxGap)
+        self.pixelSize = float(pixelSize)
+        self.minLength = int(minLength)
+        self.reset()
+
+    def reset(self):
+        self.rows = []
+        self.active = {}  # track: (last frame, last scaled position)
+        self.lengths = {}
+        self.nextTrack = 0
+
+    def positions(self, detections):
+        # Scaled so that the largest allowed lateral and axial movements
+        # are both 1
+        return np.stack(
+            [
+                detections[:, 0] * self.pixelSize / self.maxDistance,
+                detections[:, 1] * self.pixelSize / self.maxDistance,
+                detections[:, 2] / self.maxDepthChange,
+            ],
+            axis=-1,
+        )
+
+    def update(self, frame, detections):
+        """Adds the detections for frame, which must be later than any
+        previous frame.
+        """
+        detections = np.reshape(detections, (-1, 4))
+
+        # Tracks not seen for more than maxGap frames have ended
+        self.active = {
+            track: value
+            for track, value in self.active.items()
+            if frame - value[0] <= self.maxGap + 1
+        }
+
+        assigned = np.full(len(detections), -1)
+        if len(detections) and self.active:
+            tracks = list(self.active)
+            previous = np.stack([self.active[track][1] for track in tracks])
+            current = self.positions(detections)
+            cost = cdist(previous, current)
+            # Links with more than the maximum lateral or axial movement are
+            # not allowed
+            allowed = (cdist(previous[:, :2], current[:, :2]) <= 1) & (
+                np.abs(previous[:, 2:] - current[:, 2].T) <= 1
+            )
+            cost[~allowed] = 1e12
+            trackIdx, detectionIdx = linear_sum_assignment(cost)
+            for t, d in zip(trackIdx, detectionIdx):
+                if allowed[t, d]:
+                    assigned[d] = tracks[t]
+
+        positions = self.positions(detections)
+        for idx, detection in enumerate(detections):
+            track = assigned[idx]
+            if track < 0:
+                track = self.nextTrack
+                self.nextTrack += 1
+            self.active[track] = (frame, positions[idx])
+            self.lengths[track] = self.lengths.get(track, 0) + 1
+            self.rows.append((track, frame) + tuple(detection))
+
+    def tracks(self):
+        """Returns the tracks as an array with columns COLUMNS, sorted by
+        track and then frame.
+        """
+        rows = [row for row in self.rows if self.lengths[row[0]] >= self.minLength]
+        if not rows:
+            return np.zeros((0, len(COLUMNS)))
+        tracks = np.array(rows, dtype="float64")
+        return tracks[np.lexsort((tracks[:, 1], tracks[:, 0]))]
+
+
+def parquet_available():
+    try:
+        import pandas
+    except ImportError:
+        return False
+    return True
+
+
+def write_tracks(tracks, filename):
+    """Writes tracks (see ParticleTracker.tracks) to filename as CSV, or as
+    Parquet if the extension is .parquet (requires pandas with a Parquet
+    engine).
+    """
+    if os.path.splitext(filename)[1].lower() == ".parquet":
+        try:
+            import pandas
+        except ImportError:
+            raise ImportError("pandas is required to write Parquet files.")
+        table = pandas.DataFrame(tracks, columns=COLUMNS)
+        table = table.astype({"track": "int64", "frame": "int64"})
+        table.to_parquet(filename, index=False)
+        return
+
+    with open(filename, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(COLUMNS)
+        for row in tracks:
+            writer.writerow([int(row[0]), int(row[1])] + [f"{value:.6g}" for value in row[2:]])
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+Phase unwrapping for HoloProcessor.
+
+Three spatial methods are provided:
+    Reliability   : PyHoloscope (scikit-image) reliability sorting unwrap,
+                    robust but the slowest
+    Least Squares : DCT-based least squares unwrap (Ghiglia and Romero),
+                    made congruent with the wrapped phase. Uses multi-threaded
+                    FFTs and is several times faster on large frames
+    Row/Column    : path-following along each row and then down the first
+                    column, parallelised over rows with numba if available.
+                    Fastest, but errors propagate along rows in noisy images
+
+Unwrapping can be limited to a region of interest, and in temporal mode each
+frame is unwrapped using the previous frame's unwrapped phase as a seed,
+which is a single pass over the pixels. This is valid as long as the phase
+of each pixel changes by less than pi between frames, and a full spatial
+unwrap is done every refreshInterval frames to stop errors accumulating.
+
+"""
+
+import math
+
+import numpy as np
+import scipy.fft
+
+import pyholoscope as pyh
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+
+TWO_PI = 2 * math.pi
+
+
+def wrap(phase):
+    """Wraps phase into the range [-pi, pi)."""
+    return (phase + math.pi) % TWO_PI - math.pi
+
+
+def unwrap_reliability(phase):
+    return pyh.phase_unwrap(phase)
+
+
+def unwrap_least_squares(phase):
+    """Returns the least squares unwrapped phase, made congruent with phase
+    so that it differs from it only by multiples of 2pi.
+    """
+    dtype = np.result_type(phase, np.float32)
+    phase = np.asarray(phase, dtype=dtype)
+    rows, cols = np.shape(phase)
+
+    # Divergence of the wrapped phase gradient, with the gradient taken as
+    # zero beyond the edges (Neumann boundary conditions)
+    dx = np.zeros((rows, cols + 1), dtype=dtype)
+    dy = np.zeros((rows + 1, cols), dtype=dtype)
+    dx[:, 1:-1] = wrap(np.diff(phase, axis=1))
+    dy[1:-1, :] = wrap(np.diff(phase, axis=0))
+    rho = np.diff(dx, axis=1) + np.diff(dy, axis=0)
+
+    # Solve the Poisson equation in the DCT domain. The denominator is close
+    # to zero at low frequencies so is calculated in double precision.
+    rhoDCT = scipy.fft.dctn(rho, type=2, norm="ortho", workers=-1)
+    denom = (
+        2 * np.cos(np.pi * np.arange(rows) / rows)[:, None]
+        + 2 * np.cos(np.pi * np.arange(cols) / cols)[None, :]
+        - 4
+    )
+    denom[0, 0] = 1
+    rhoDCT /= denom
+    rhoDCT[0, 0] = 0
+    leastSquares = scipy.fft.idctn(rhoDCT, type=2, norm="ortho", workers=-1)
+
+    return phase + TWO_PI * np.round((leastSquares - phase) / TWO_PI)
+
+
+if njit is not None:
+
+    @njit(parallel=True, cache=True)
+    def _unwrap_rows(phase, out):
+        rows, cols = phase.shape
+        for row in prange(rows):
+            offset = 0.0
+            out[row, 0] = phase[row, 0]
+            for col in range(1, cols):
+                diff = phase[row, col] - phase[row, col - 1]
+                if diff > math.pi:
+                    offset -= TWO_PI
+                elif diff < -math.pi:
+                    offset += TWO_PI
+                out[row, col] = phase[row, col] + offset
+
+else:
+
+    def _unwrap_rows(phase, out):
+        out[:] = np.unwrap(phase, axis=1)
+
+
+def unwrap_rows_columns(phase):
+    """Unwraps along each row, and then shifts each row by the multiple of
+    2pi that unwraps the first column.
+    """
+    phase = np.ascontiguousarray(phase)
+    out = np.empty_like(phase)
+    _unwrap_rows(phase, out)
+    firstColumn = np.unwrap(phase[:, 0])
+    out += (firstColumn - out[:, 0])[:, None]
+    return out
+
+
+class PhaseUnwrapper:
+    """Unwraps phase maps with a choice of method, optionally only within a
+    region of interest and optionally using the previous frame as a seed.
+
+    Keyword Arguments:
+        method          : str
+                          one of METHODS (default RELIABILITY)
+        temporal        : boolean
+                          use the previous frame as a seed (default False)
+        refreshInterval : int
+                          in temporal mode, number of frames between full
+                          spatial unwraps (default 30)
+    """
+
+    RELIABILITY = "Reliability"
+    LEAST_SQUARES = "Least Squares"
+    ROWS_COLUMNS = "Row/Column"
+    METHODS = [RELIABILITY, LEAST_SQUARES, ROWS_COLUMNS]
+
+    method = RELIABILITY
+    temporal = False
+    refreshInterval = 30
+
+    def __init__(self, method=RELIABILITY, temporal=False, refreshInterval=30):
+        self.method = method
+        self.temporal = temporal
+        self.refreshInterval = refreshInterval
+        self.reset()
+
+    def reset(self):
+        """Forgets the previous frame, so that the next frame is unwrapped
+        spatially."""
+        self.previous = None
+        self.key = None
+        self.framesSinceRefresh = 0
+
+    def spatial_unwrap(self, phase):
+        if self.method == self.LEAST_SQUARES:
+            return unwrap_least_squares(phase)
+        if self.method == self.ROWS_COLUMNS:
+            return unwrap_rows_columns(phase)
+        return unwrap_reliability(phase)
+
+    def unwrap(self, phase, roi=None, key=None):
+        """Unwraps phase in place and returns it. If roi (a PyHoloscope Roi)
+        is given only that region is unwrapped. In temporal mode the previous
+        frame is only used as a seed if key is the same as for the previous
+        frame, so pass a key which changes whenever the phase could jump,
+        for example with the depth.
+        """
+        if roi is not None:
+            roi = pyh.Roi(roi.x, roi.y, roi.width, roi.height)
+            roi.constrain(0, 0, np.shape(phase)[1], np.shape(phase)[0])
+            if roi.width < 2 or roi.height < 2:
+                return phase
+            region = roi.crop(phase)
+            key = (key, roi.x, roi.y, roi.width, roi.height)
+        else:
+            region = phase
+
+        if key != self.key:
+            self.reset()
+            self.key = key
+
+        if (
+            self.temporal
+            and self.previous is not None
+            and self.previous.shape == region.shape
+            and self.framesSinceRefresh < self.refreshInterval
+        ):
+            unwrapped = region + TWO_PI * np.round((self.previous - region) / TWO_PI)
+            self.framesSinceRefresh += 1
+        else:
+            unwrapped = self.spatial_unwrap(region)
+            # Keep the same multiple of 2pi as the previous frame so that
+            # the display does not jump when refreshing
+            if self.previous is not None and self.previous.shape == region.shape:
+                unwrapped += TWO_PI * np.round(
+                    np.median(self.previous - unwrapped) / TWO_PI
+                )
+            self.framesSinceRefresh = 0
+
+        region[:] = unwrapped
+        if self.temporal:
+            self.previous = np.array(region)
+        return phase
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["previous"] = None
+        state["key"] = None
+        return state
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+Bounded least-recently-used cache of angular spectrum propagators.
+
+Regenerating the Fourier domain propagator is the dominant cost when the
+refocus depth changes, so when the focus slider is dragged back and forth
+over the same range, keeping recent propagators in memory avoids rebuilding
+them on every tick.
+
+"""
+
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+def angular_spectrum_propagator(shape, wavelength, pixelSize, depth, dtype="complex64"):
+    """Creates an angular spectrum propagator for a field of size shape
+    (height, width). pixelSize is either a float or a tuple of (y, x) pixel
+    sizes. The propagator is not FFT shifted, so it can be multiplied
+    directly with the output of fft2, and uses the same sign convention as
+    PyHoloscope. Evanescent components are set to zero.
+    """
+    height, width = shape
+    if np.isscalar(pixelSize):
+        pixelSizeY = pixelSizeX = pixelSize
+    else:
+        pixelSizeY, pixelSizeX = pixelSize
+
+    alpha = wavelength * np.fft.fftfreq(width, d=pixelSizeX)
+    beta = wavelength * np.fft.fftfreq(height, d=pixelSizeY)
+    arg = 1 - alpha[np.newaxis, :] ** 2 - beta[:, np.newaxis] ** 2
+    propagating = arg > 0
+
+    prop = np.exp(
+        (-2j * np.pi * depth / wavelength) * np.sqrt(np.maximum(arg, 0))
+    ).astype(dtype)
+    prop[~propagating] = 0
+
+    return prop
+
+
+class PropagatorCache:
+    """LRU cache of propagators, bounded by total memory use in bytes.
+
+    Entries are looked up with a hashable key describing everything the
+    propagator depends on. The cache is safe to use from more than one thread.
+    """
+
+    def __init__(self, maxBytes=512 * 1024**2):
+        self.maxBytes = int(maxBytes)
+        self.entries = OrderedDict()
+        self.currentBytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, create):
+        """Returns the propagator stored for key. If there is no entry, calls
+        create() to generate it, stores the result and returns it.
+        """
+        with self.lock:
+            prop = self.entries.get(key)
+            if prop is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return prop
+            self.misses += 1
+
+        prop = create()
+
+        with self.lock:
+            if key not in self.entries and prop.nbytes <= self.maxBytes:
+                self.entries[key] = prop
+                self.currentBytes += prop.nbytes
+                self.evict()
+        return prop
+
+    def evict(self):
+        """Removes least recently used entries until within the memory cap.
+        Caller must hold the lock.
+        """
+        while self.currentBytes > self.maxBytes and self.entries:
+            key, prop = self.entries.popitem(last=False)
+            self.currentBytes -= prop.nbytes
+
+    def set_max_bytes(self, maxBytes):
+        """Changes the memory cap, evicting entries if necessary."""
+        with self.lock:
+            self.maxBytes = int(maxBytes)
+            self.evict()
+
+    def clear(self):
+        """Removes all entries. Hit and miss counters are not reset."""
+        with self.lock:
+            self.entries.clear()
+            self.currentBytes = 0
+
+    def reset_stats(self):
+        with self.lock:
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """Returns a dictionary of cache usage statistics."""
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hitRate": self.hits / total if total > 0 else 0.0,
+                "entries": len(self.entries),
+                "bytes": self.currentBytes,
+                "maxBytes": self.maxBytes,
+            }
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getstate__(self):
+        # The processor is pickled whenever settings are sent to the processing
+        # core, so we do not send the cached propagators or the lock with it
+        state = self.__dict__.copy()
+        state["entries"] = OrderedDict()
+        state["currentBytes"] = 0
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming export of depth stacks.
+
+Refocused amplitude images are generated in small batches and written to
+disk as they are produced, so peak memory depends only on the image size and
+batch size, not on the number of depths. Stacks are written either as BigTIFF
+(requires tifffile) or, if the filename ends in .npy, as a memory-mapped
+NumPy array.
+
+"""
+
+import copy
+import os
+import threading
+
+import numpy as np
+import scipy.fft
+
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
+from processors.propagator_cache import angular_spectrum_propagator
+
+
+class TiffStackWriter:
+    """Writes a stack to a BigTIFF file one plane at a time."""
+
+    def __init__(self, filename, shape, numPlanes, dtype):
+        if tifffile is None:
+            raise ImportError("tifffile is required to export tif stacks.")
+        self.writer = tifffile.TiffWriter(filename, bigtiff=True)
+
+    def write(self, plane):
+        self.writer.write(plane, contiguous=True)
+
+    def close(self):
+        self.writer.close()
+
+
+class NpyStackWriter:
+    """Writes a stack to a memory-mapped .npy file one plane at a time."""
+
+    def __init__(self, filename, shape, numPlanes, dtype):
+        self.stack = np.lib.format.open_memmap(
+            filename, mode="w+", dtype=dtype, shape=(numPlanes,) + tuple(shape)
+        )
+        self.idx = 0
+
+    def write(self, plane):
+        self.stack[self.idx] = plane
+        self.idx += 1
+
+    def close(self):
+        self.stack.flush()
+        del self.stack
+
+
+def open_stack_writer(filename, shape, numPlanes, dtype):
+    """Returns a writer for the format given by the extension of filename."""
+    if os.path.splitext(filename)[1].lower() == ".npy":
+        return NpyStackWriter(filename, shape, numPlanes, dtype)
+    else:
+        return TiffStackWriter(filename, shape, numPlanes, dtype)
+
+
+class DepthStackExport:
+    """Refocuses a hologram to a range of depths and streams the amplitudes
+    to a file.
+
+    Arguments:
+        processor  : HoloProcessor
+                     processor providing the current reconstruction settings,
+                     which is copied so that the export can run on another
+                     thread
+        hologram   : ndarray
+                     raw hologram
+        depthRange : tuple of (float, float)
+                     min and max depths
+        numDepths  : int
+                     number of equally spaced depths
+        filename   : str
+                     .tif for BigTIFF, .npy for a NumPy array
+
+    Keyword Arguments:
+        autoContrast : boolean
+                       if True, amplitudes are scaled to 16 bit using the min
+                       and max over the whole stack, which requires two passes.
+                       Otherwise 32 bit float amplitudes are written (default)
+        batchSize    : int
+                       number of depths refocused at once (default 4)
+    """
+
+    def __init__(self, processor, hologram, depthRange, numDepths, filename, **kwargs):
+        # A private copy, as refocusing changes the state of the processor
+        # and its Holo, which are also used on the GUI thread
+        self.processor = copy.deepcopy(processor)
+        self.hologram = hologram.astype("float32")
+        self.depths = np.linspace(depthRange[0], depthRange[1], max(int(numDepths), 1))
+        self.filename = filename
+        self.autoContrast = kwargs.get("autoContrast", False)
+        self.batchSize = max(int(kwargs.get("batchSize", 4)), 1)
+        self.cancelEvent = threading.Event()
+        self.fieldFFT = None
+        self.fieldPixelSize = None
+
+    def cancel(self):
+        self.cancelEvent.set()
+
+    def is_cancelled(self):
+        return self.cancelEvent.is_set()
+
+    def field_fft(self):
+        """Returns the FFT of the pre-propagation field and its pixel size.
+        These only need to be found once, even if there are two passes.
+        """
+        if self.fieldFFT is None:
+            field = self.processor.pre_propagation_field(self.hologram)
+            self.fieldFFT = scipy.fft.fft2(field)
+            self.fieldPixelSize = self.processor.field_pixel_size(
+                np.shape(self.hologram), np.shape(field)
+            )
+        return self.fieldFFT, self.fieldPixelSize
+
+    def planes(self):
+        """Generator yielding the refocused amplitude for each depth in turn."""
+        if self.processor.use_propagator_cache():
+            fieldFFT, pixelSize = self.field_fft()
+            wavelength = self.processor.holo.wavelength
+            for idx in range(0, len(self.depths), self.batchSize):
+                batch = np.stack(
+                    [
+                        angular_spectrum_propagator(
+                            np.shape(fieldFFT), wavelength, pixelSize, depth
+                        )
+                        for depth in self.depths[idx : idx + self.batchSize]
+                    ]
+                )
+                batch *= fieldFFT
+                amps = np.abs(scipy.fft.ifft2(batch, axes=(-2, -1), overwrite_x=True))
+                for amp in amps:
+                    yield amp.astype("float32")
+        else:
+            # Settings the cached path does not support
+            holo = self.processor.holo
+            holo.refocus = True
+            for depth in self.depths:
+                holo.depth = depth
+                yield np.abs(holo.process(self.hologram)).astype("float32")
+
+    def amplitude_range(self, progress):
+        """First pass for auto contrast, returns (min, max) amplitude over the
+        stack, or None if cancelled.
+        """
+        minVal = np.inf
+        maxVal = -np.inf
+        for idx, amp in enumerate(self.planes()):
+            if self.is_cancelled():
+                return None
+            minVal = min(minVal, float(np.min(amp)))
+            maxVal = max(maxVal, float(np.max(amp)))
+            if progress is not None:
+                progress((idx + 1) / len(self.depths) / 2)
+        return minVal, maxVal
+
+    def run(self, progress=None):
+        """Exports the stack, returning True if complete. If cancelled the
+        partially written file is deleted and False is returned. If progress
+        is provided it is called as progress(fraction) after each plane.
+        """
+        numPasses = 1
+        if self.autoContrast:
+            valRange = self.amplitude_range(progress)
+            if valRange is None:
+                return False
+            minVal, maxVal = valRange
+            scale = (2**16 - 1) / (maxVal - minVal) if maxVal > minVal else 0
+            numPasses = 2
+
+        writer = None
+        complete = False
+        try:
+            for idx, amp in enumerate(self.planes()):
+                if self.is_cancelled():
+                    return False
+                if self.autoContrast:
+                    amp = ((amp - minVal) * scale).astype("uint16")
+                if writer is None:
+                    writer = open_stack_writer(
+                        self.filename, np.shape(amp), len(self.depths), amp.dtype
+                    )
+                writer.write(amp)
+                if progress is not None:
+                    progress((idx + 1 + (numPasses - 1) * len(self.depths))
+                             / len(self.depths) / numPasses)
+            complete = True
+        finally:
+            if writer is not None:
+                writer.close()
+            if not complete and os.path.exists(self.filename):
+                os.remove(self.filename)
+
+        return True
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""
+Low-overhead timing of the stages of processing a frame.
+
+The time since the previous mark is recorded for each named stage, into a
+ring buffer covering the last few hundred frames, from which rolling means
+and percentiles are calculated. Summaries can be published to shared memory
+so that they can be read by the GUI when processing is on another core, and
+per-frame timings can optionally be logged to a CSV or JSON lines file.
+
+"""
+
+import json
+import os
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+# Summary columns stored for each stage
+SUMMARY_FIELDS = ["mean", "p50", "p95", "fraction"]
+
+
+class StageTimer:
+    """Records the time taken by each stage of processing.
+
+    Arguments:
+        stages     : list of str
+                     names of stages in the order they are performed
+
+    Keyword Arguments:
+        window     : int
+                     number of recent frames used for statistics (default 200)
+    """
+
+    def __init__(self, stages, window=200):
+        self.stages = list(stages)
+        self.stageIdx = {stage: idx for idx, stage in enumerate(self.stages)}
+        self.window = int(window)
+        self.times = np.zeros((self.window, len(self.stages)))
+        self.frameTimes = np.zeros(self.window)
+        self.numFrames = 0
+        self.current = np.zeros(len(self.stages))
+        self.frameStart = 0
+        self.lastMark = 0
+        self.logFile = None
+        self.logFilename = None
+        self.sharedMemory = None
+        self.shareName = None
+        self.publishInterval = 0.25
+        self.lastPublish = 0
+
+    def start_frame(self):
+        self.current[:] = 0
+        self.frameStart = self.lastMark = time.perf_counter()
+
+    def mark(self, stage):
+        """Records the time since the previous mark against stage."""
+        now = time.perf_counter()
+        self.current[self.stageIdx[stage]] += now - self.lastMark
+        self.lastMark = now
+
+    def end_frame(self):
+        """Stores the timings of the frame in the ring buffer and writes them
+        to the log and shared memory if enabled.
+        """
+        frameTime = time.perf_counter() - self.frameStart
+        row = self.numFrames % self.window
+        self.times[row] = self.current
+        self.frameTimes[row] = frameTime
+        self.numFrames += 1
+
+        if self.logFilename is not None:
+            self.log(frameTime)
+        if self.shareName is not None and self.frameStart - self.lastPublish > self.publishInterval:
+            self.lastPublish = self.frameStart
+            self.publish()
+
+    def recent(self):
+        num = min(self.numFrames, self.window)
+        return self.times[:num], self.frameTimes[:num]
+
+    def summary_array(self):
+        """Returns an array of (stages, SUMMARY_FIELDS), times in seconds."""
+        times, frameTimes = self.recent()
+        out = np.zeros((len(self.stages), len(SUMMARY_FIELDS)))
+        if len(times) == 0:
+            return out
+        out[:, 0] = np.mean(times, axis=0)
+        out[:, 1:3] = np.percentile(times, [50, 95], axis=0).T
+        total = np.sum(frameTimes)
+        if total > 0:
+            out[:, 3] = np.sum(times, axis=0) / total
+        return out
+
+    def summary(self):
+        """Returns a dictionary of stage: {mean, p50, p95, fraction}."""
+        return summary_dict(self.stages, self.summary_array())
+
+    def fps(self):
+        times, frameTimes = self.recent()
+        if len(frameTimes) == 0 or np.mean(frameTimes) == 0:
+            return 0
+        return 1 / np.mean(frameTimes)
+
+    def reset(self):
+        self.numFrames = 0
+
+    def set_log_file(self, filename):
+        """Starts logging each frame's stage timings to filename, CSV unless
+        the extension is .json, in which case one JSON object is written per
+        line. Pass None to stop logging.
+        """
+        self.close_log()
+        self.logFilename = filename
+
+    def log(self, frameTime):
+        if self.logFile is None:
+            newFile = not os.path.exists(self.logFilename)
+            self.logFile = open(self.logFilename, "a", buffering=1)
+            if newFile and not self.is_json_log():
+                self.logFile.write(",".join(["time", "total"] + self.stages) + "\n")
+
+        if self.is_json_log():
+            record = {"time": time.time(), "total": frameTime}
+            record.update(zip(self.stages, self.current.tolist()))
+            self.logFile.write(json.dumps(record) + "\n")
+        else:
+            values = [frameTime] + self.current.tolist()
+            self.logFile.write(
+                f"{time.time():.3f}," + ",".join(f"{v:.6g}" for v in values) + "\n"
+            )
+
+    def is_json_log(self):
+        return os.path.splitext(self.logFilename)[1].lower() == ".json"
+
+    def close_log(self):
+        if self.logFile is not None:
+            self.logFile.close()
+        self.logFile = None
+        self.logFilename = None
+
+    def set_share_name(self, shareName):
+        """Publishes the summary every publishInterval seconds to shared
+        memory created by a TelemetryReader with this name.
+        """
+        self.shareName = shareName
+        self.sharedMemory = None
+
+    def publish(self):
+        if self.sharedMemory is None:
+            try:
+                self.sharedMemory = shared_memory.SharedMemory(name=self.shareName)
+            except FileNotFoundError:
+                return
+        shared = np.ndarray(
+            (len(self.stages) + 1, len(SUMMARY_FIELDS)),
+            dtype="float64",
+            buffer=self.sharedMemory.buf,
+        )
+        shared[1:] = self.summary_array()
+        shared[0, 0] = self.fps()
+        shared[0, 1] = self.numFrames
+
+    def __getstate__(self):
+        # Timings, open files and shared memory stay with each process. Copies
+        # do not log, so that two processes never append to the same file.
+        state = self.__dict__.copy()
+        state["times"] = np.zeros_like(self.times)
+        state["frameTimes"] = np.zeros_like(self.frameTimes)
+        state["numFrames"] = 0
+        state["logFile"] = None
+        state["logFilename"] = None
+        state["sharedMemory"] = None
+        return state
+
+
+def summary_dict(stages, summary):
+    return {
+        stage: dict(zip(SUMMARY_FIELDS, summary[idx].tolist()))
+        for idx, stage in enumerate(stages)
+    }
+
+
+def dominant_stage(summary):
+    """Returns the name of the stage with the largest mean time, or None."""
+    if not summary:
+        return None
+    stage = max(summary, key=lambda s: summary[s]["mean"])
+    if summary[stage]["mean"] <= 0:
+        return None
+    return stage
+
+
+class TelemetryReader:
+    """Creates shared memory for a StageTimer running in another process to
+    publish to, and reads the summaries it publishes.
+    """
+
+    def __init__(self, stages, shareName=None):
+        self.stages = list(stages)
+        size = (len(self.stages) + 1) * len(SUMMARY_FIELDS) * 8
+        if shareName is None:
+            shareName = f"holosnake_telemetry_{os.getpid()}"
+        try:
+            self.sharedMemory = shared_memory.SharedMemory(name=shareName, create=True, size=size)
+        except FileExistsError:
+            self.sharedMemory = shared_memory.SharedMemory(name=shareName)
+        self.shareName = shareName
+        self.shared = np.ndarray(
+            (len(self.stages) + 1, len(SUMMARY_FIELDS)),
+            dtype="float64",
+            buffer=self.sharedMemory.buf,
+        )
+        self.shared[:] = 0
+
+    def fps(self):
+        return float(self.shared[0, 0])
+
+    def num_frames(self):
+        return int(self.shared[0, 1])
+
+    def summary(self):
+        return summary_dict(self.stages, self.shared[1:].copy())
+
+    def close(self):
+        self.shared = None
+        self.sharedMemory.close()
+        try:
+            self.sharedMemory.unlink()
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+Parametric model of the tilt (and other low order aberrations) in a phase
+map.
+
+The tilt is fitted as a low order polynomial in coordinates normalised to
+the field of view, so the same model can be used to correct phase maps of
+any size, for example after the downsampling factor or off-axis crop radius
+is changed. The correction for each output shape is generated when first
+needed and cached. A TiltEstimator can re-fit the model from live frames on
+a background thread.
+
+"""
+
+import threading
+import time
+
+import numpy as np
+
+import pyholoscope as pyh
+
+
+def polynomial_terms(order):
+    """Returns a list of (i, j) exponents of the terms x^i y^j with
+    i + j <= order.
+    """
+    return [(i, total - i) for total in range(order + 1) for i in range(total, -1, -1)]
+
+
+class TiltModel:
+    """Polynomial phase surface over the field of view.
+
+    Arguments:
+        coefficients : array of float
+                       coefficient of each term of polynomial_terms(order)
+
+    Keyword Arguments:
+        order        : int
+                       polynomial order, 1 for a plane (default 1)
+    """
+
+    maxCached = 8
+
+    def __init__(self, coefficients, order=1):
+        self.order = int(order)
+        self.coefficients = np.asarray(coefficients, dtype="float64")
+        self.cache = {}
+
+    @classmethod
+    def fit(cls, phase, order=1, maxSamples=65536):
+        """Fits a model to an unwrapped phase map by least squares. Only a
+        regular subsample of at most maxSamples pixels is used.
+        """
+        rows, cols = np.shape(phase)
+        step = max(int(np.ceil(np.sqrt(rows * cols / maxSamples))), 1)
+        y, x = np.mgrid[0:rows:step, 0:cols:step]
+        samples = np.asarray(phase)[::step, ::step]
+        valid = np.isfinite(samples)
+        design = cls.design_matrix(x[valid] / cols, y[valid] / rows, order)
+        coefficients = np.linalg.lstsq(design, samples[valid].astype("float64"), rcond=None)[0]
+        return cls(coefficients, order=order)
+
+    @staticmethod
+    def design_matrix(x, y, order):
+        return np.stack([x**i * y**j for i, j in polynomial_terms(order)], axis=-1)
+
+    def correction(self, shape, dtype="float32"):
+        """Returns the tilt for a phase map of shape, from the cache if
+        possible. The returned array must not be modified.
+        """
+        key = (tuple(shape), np.dtype(dtype).str)
+        correction = self.cache.get(key)
+        if correction is None:
+            rows, cols = shape
+            # Evaluated separably as a sum over terms of outer products
+            x = np.arange(cols) / cols
+            y = np.arange(rows) / rows
+            correction = np.zeros((rows, cols), dtype="float64")
+            for (i, j), coefficient in zip(polynomial_terms(self.order), self.coefficients):
+                correction += coefficient * np.outer(y**j, x**i)
+            correction = correction.astype(dtype)
+            correction.flags.writeable = False
+            if len(self.cache) >= self.maxCached:
+                self.cache.pop(next(iter(self.cache)))
+            self.cache[key] = correction
+        return correction
+
+    def __getstate__(self):
+        # Corrections are regenerated as needed rather than pickled
+        state = self.__dict__.copy()
+        state["cache"] = {}
+        return state
+
+
+class TiltEstimator:
+    """Re-fits a TiltModel from live phase maps on a background thread, no
+    more often than every interval seconds.
+
+    Keyword Arguments:
+        order      : int
+                     polynomial order (default 1)
+        interval   : float
+                     minimum time between estimates in seconds (default 5)
+        maxSize    : int
+                     phase maps are subsampled to no more than this size
+                     along each dimension before unwrapping (default 512)
+    """
+
+    def __init__(self, order=1, interval=5.0, maxSize=512):
+        self.order = order
+        self.interval = interval
+        self.maxSize = maxSize
+        self.lastSubmitted = 0
+        self.thread = None
+        self.latest = None
+        self.lock = threading.Lock()
+
+    def busy(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def submit(self, phase, unwrapped=False):
+        """Starts a new estimate from phase if the previous one has finished
+        and interval has passed. Returns True if an estimate was started.
+        """
+        now = time.perf_counter()
+        if self.busy() or now - self.lastSubmitted < self.interval:
+            return False
+        self.lastSubmitted = now
+        step = max(int(np.ceil(max(np.shape(phase)) / self.maxSize)), 1)
+        sample = np.array(phase[::step, ::step])
+        self.thread = threading.Thread(
+            target=self.estimate, args=(sample, unwrapped), daemon=True
+        )
+        self.thread.start()
+        return True
+
+    def estimate(self, phase, unwrapped):
+        if not unwrapped:
+            phase = pyh.phase_unwrap(phase)
+        model = TiltModel.fit(phase, order=self.order)
+        with self.lock:
+            self.latest = model
+
+    def take(self):
+        """Returns the newest model and forgets it, or None if there is no
+        new model since the last call."""
+        with self.lock:
+            model = self.latest
+            self.latest = None
+        return model
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["thread"] = None
+        state["latest"] = None
+        state["lock"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+"""
+Qt thread which runs an auto focus search in the background so that the
+GUI remains responsive, reporting progress and the best depth found so far.
+
+"""
+
+from PyQt5.QtCore import QThread, pyqtSignal
+
+
+class AutoFocusThread(QThread):
+    """Runs a FocusSearch (see processors.auto_focus) on a separate thread.
+
+    Signals:
+        progress   : (float, float) fraction complete and best depth so far
+        focusFound : (float) best depth, emitted when the search completes
+        cancelled  : emitted instead of focusFound if the search is cancelled
+    """
+
+    progress = pyqtSignal(float, float)
+    focusFound = pyqtSignal(float)
+    cancelled = pyqtSignal()
+
+    def __init__(self, search, parent=None):
+        super().__init__(parent)
+        self.search = search
+
+    def run(self):
+        depth = self.search.run(self.report_progress)
+        if self.search.is_cancelled() or depth is None:
+            self.cancelled.emit()
+        else:
+            self.focusFound.emit(float(depth))
+
+    def report_progress(self, fraction, bestDepth):
+        if bestDepth is not None:
+            self.progress.emit(float(fraction), float(bestDepth))
+
+    def cancel(self):
+        """Requests the search stops after the current trial depth."""
+        self.search.cancel()
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+Backpressure policies for the queue of raw frames between the acquisition
+thread and the image processor.
+
+By default CAS only removes frames once the raw image queue is full, so when
+processing is slower than the camera the processor always works on the
+oldest frame in the queue and the display lags by the whole buffer. Applying
+a policy regularly limits how many frames can wait in the queue, bounding
+the display latency at the cost of processing fewer frames.
+
+"""
+
+import queue
+
+
+class QueuePolicy:
+    """Limits the depth of the raw frame queue.
+
+    Policies:
+        DROP_OLDEST : oldest frames are removed so that no more than maxDepth
+                      frames are waiting
+        LATEST_ONLY : only the most recent frame is kept
+        EVERY_NTH   : as DROP_OLDEST, and the processor only processes every
+                      Nth frame (see HoloProcessor.processEveryN)
+    """
+
+    DROP_OLDEST = "Drop Oldest"
+    LATEST_ONLY = "Latest Only"
+    EVERY_NTH = "Every Nth Frame"
+    POLICIES = [DROP_OLDEST, LATEST_ONLY, EVERY_NTH]
+
+    policy = DROP_OLDEST
+    maxDepth = 5
+    numDropped = 0
+
+    def __init__(self, policy=DROP_OLDEST, maxDepth=5):
+        self.policy = policy
+        self.maxDepth = maxDepth
+        self.numDropped = 0
+
+    def target_depth(self):
+        if self.policy == self.LATEST_ONLY:
+            return 1
+        return max(int(self.maxDepth), 1)
+
+    def apply(self, frameQueue, lock=None):
+        """Removes the oldest frames from frameQueue until no more than the
+        target depth are waiting. Returns the number of frames removed.
+        """
+        target = self.target_depth()
+        if frameQueue.qsize() <= target:
+            return 0
+
+        removed = 0
+        if lock is not None:
+            lock.acquire()
+        try:
+            while frameQueue.qsize() > target:
+                try:
+                    frameQueue.get_nowait()
+                except queue.Empty:
+                    break
+                removed += 1
+        finally:
+            if lock is not None:
+                lock.release()
+
+        self.numDropped += removed
+        return removed
+
+    def reset(self):
+        self.numDropped = 0
+
+
+def estimate_latency(queueDepth, processingStepTime, displayInterval):
+    """Returns an estimate of the time in seconds from a frame being acquired
+    to its reconstruction being displayed. A new frame waits behind the frames
+    already in the queue, is processed, and then waits on average half a GUI
+    update interval to be displayed.
+    """
+    return (queueDepth + 1) * processingStepTime + displayInterval / 2
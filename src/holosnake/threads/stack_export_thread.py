@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+"""
+Qt thread which streams a depth stack export to disk in the background so
+that the GUI remains responsive, reporting progress as planes are written.
+
+"""
+
+from PyQt5.QtCore import QThread, pyqtSignal
+
+
+class StackExportThread(QThread):
+    """Runs a DepthStackExport (see processors.stack_export) or
+    AllInFocusExport (see processors.edof) on a separate thread.
+
+    Signals:
+        progress : (int) percentage complete
+        exported : (bool) True if the export completed, False if cancelled
+        failed   : (str) error message if the export raised an exception
+    """
+
+    progress = pyqtSignal(int)
+    exported = pyqtSignal(bool)
+    failed = pyqtSignal(str)
+
+    def __init__(self, export, parent=None):
+        super().__init__(parent)
+        self.export = export
+
+    def run(self):
+        try:
+            self.exported.emit(self.export.run(self.report_progress))
+        except Exception as e:
+            self.failed.emit(str(e))
+
+    def report_progress(self, fraction):
+        self.progress.emit(int(100 * fraction))
+
+    def cancel(self):
+        """Requests the export stops after the current plane."""
+        self.export.cancel()